@@ -1,4 +1,7 @@
 
 import gcm
+from dispatch import MulticastDispatcher, BatchResult
+from async_gcm import AsyncGCM
+from retry import MulticastRetrier
 
 GCM = gcm.GCM
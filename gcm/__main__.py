@@ -0,0 +1,3 @@
+from stream import main
+
+main()
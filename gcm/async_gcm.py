@@ -0,0 +1,306 @@
+import threading
+
+from gcm import GCM, GCM_bulk_result, GCMException, GCMAuthenticationException, GCMCancelledException, \
+    GCMMissingRegistrationException, GCMNotRegisteredException, GCMRetriableException, GCMUnavailableException, \
+    require_ids
+from dispatch import BoundedExecutor, Future, Scheduler
+
+
+class AsyncGCM(GCM):
+    """
+    Non-blocking GCM client: every request method returns a Future at once instead of the result.
+    At most max_concurrency requests are on the wire at a time, over the pooled connections, and
+    retry backoff is a timer on a shared Scheduler rather than a sleeping thread.
+
+    gcm = AsyncGCM(API_KEY, max_concurrency=16)
+    future = gcm.request_json(reg_ids, data)
+    future.add_done_callback(on_sent)
+    """
+    def __init__(self, api_key, max_concurrency=8, scheduler=None, **kwargs):
+        kwargs.setdefault('pool_size', max_concurrency)
+        GCM.__init__(self, api_key, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.scheduler = scheduler or Scheduler()
+        # unbounded queue: callbacks on the timer thread must never block on submit
+        self._executor = BoundedExecutor(max_concurrency, max_pending=0)
+
+    def close(self):
+        """
+        Stop the workers and timers and close the idle connections.
+        """
+        self._executor.shutdown(wait=False, cancel_pending=True)
+        self.scheduler.stop()
+        GCM.close(self)
+
+    def request_plaintext(self, registration_id, data=None, collapse_key=None,
+                            delay_while_idle=False, time_to_live=None, tries=5):
+        """
+        Plaintext request with the same retry policy as GCM.request_plaintext, minus the blocking.
+        The registration store is applied as GCM.request_plaintext does.
+
+        @return Future of the canonical id (or None); fails with IOError once tries are exhausted,
+                and with GCMNotRegisteredException if the registration store knows the id is dead
+        :raises GCMMissingRegistrationException: if registration_id is not provided
+        """
+        if not registration_id:
+            raise GCMMissingRegistrationException("Missing registration_id")
+
+        if tries == 0:
+            raise GCMException('number of tries 0: why did you call this?')
+
+        return self._plaintext(registration_id, data, collapse_key, delay_while_idle, time_to_live, tries)
+
+    def _plaintext(self, registration_id, data, collapse_key, delay_while_idle, time_to_live, tries):
+        store = self.registration_store
+        send_to = registration_id
+        if store is not None:
+            send_to = store.lookup(registration_id)
+            if send_to is None:
+                future = Future()
+                future.set_exception(GCMNotRegisteredException("Registration id is not valid anymore"))
+                return future
+
+        payload = self.construct_payload(
+            send_to, data, collapse_key,
+            delay_while_idle, time_to_live, False
+        )
+        return self._submit_with_retry(lambda: self._send_plaintext(payload, registration_id, send_to), tries)
+
+    def request_plaintext_batch(self, messages, collapse_key=None, delay_while_idle=False,
+                                  time_to_live=None, tries=5):
+        """
+        Plaintext requests to many devices, each with its own data, up to max_concurrency at a time.
+        Each device is retried on its own schedule, as request_plaintext does, so a device in
+        backoff holds up nobody else.
+
+        :param messages: iterable of (registration_id, data) pairs, consumed as sends complete
+        @return Future of a list of PlaintextResult, in the order of messages; fails only on
+                authentication errors, which no device can get past
+        """
+        if tries == 0:
+            raise GCMException('number of tries 0: why did you call this?')
+        return _PlaintextBatch(self, iter(messages), collapse_key, delay_while_idle, time_to_live, tries).start()
+
+    def _send_plaintext(self, payload, registration_id, send_to):
+        response = self.make_request(payload, is_json=False)
+        if self.registration_store is None:
+            return self.handle_plaintext_response(response)
+        return self._record_plaintext_response(response, registration_id, send_to)
+
+    def _submit_with_retry(self, send, tries):
+        outer = Future()
+        outer.set_running_or_notify_cancel()
+        delays = self.backoff_delays()
+        state = {'attempt': 0}
+
+        def attempt():
+            state['attempt'] += 1
+            self._executor.submit(send).add_done_callback(finished)
+
+        def finished(inner):
+            error = _error_of(inner)
+            if error is None:
+                outer.set_result(inner.result())
+            elif isinstance(error, GCMUnavailableException) and state['attempt'] < tries:
+                try:
+                    delay = next(delays)
+                    if self.listener is not None:
+                        self.listener.retry_scheduled(delay, 1)
+                    self.scheduler.call_later(delay, attempt)
+                except RuntimeError:
+                    outer.set_exception(GCMCancelledException("client was closed"))
+            elif isinstance(error, GCMUnavailableException):
+                outer.set_exception(IOError("Failed to make GCM request after %d attempts" % state['attempt']))
+            else:
+                outer.set_exception(error)
+
+        attempt()
+        return outer
+
+    def request_json(self, registration_ids, data=None, collapse_key=None,
+                        delay_while_idle=False, time_to_live=None):
+        """
+        JSON multicast request; as with GCM.request_json, retries are left to the caller.
+
+        @return Future of the GCM_response_wrapper
+        """
+        return self._executor.submit(GCM.request_json, self, registration_ids, data, collapse_key,
+                                     delay_while_idle, time_to_live)
+
+    def send_bulk(self, registration_ids, data=None, collapse_key=None,
+                    delay_while_idle=False, time_to_live=None):
+        """
+        Concurrent GCM.send_bulk: keeps 2 * max_concurrency batches queued, pulling the next
+        batch from registration_ids as each one completes.
+
+        @return Future of the GCM_bulk_result; fails on the first GCMNoRetryException
+        :raises GCMMissingRegistrationException: if registration_ids is empty
+        """
+        template = self.payload_template(data, collapse_key, delay_while_idle, time_to_live)
+        return _BulkSend(self, require_ids(registration_ids), template).start()
+
+    def _send_json(self, payload, batch):
+        return self.wrap_response(self.make_request(payload, is_json=True), batch)
+
+
+def _error_of(future):
+    """
+    exception of a finished future, counting cancellation as a GCMCancelledException.
+    """
+    if future.cancelled():
+        return GCMCancelledException("send was cancelled")
+    return future.exception()
+
+
+class PlaintextResult(object):
+    """
+    outcome of the plaintext send to one device: its canonical id if GCM returned one, or the
+    exception that ended it (GCMNotRegisteredException, GCMInvalidRegistrationException, IOError
+    once retries ran out, ...).
+    """
+    __slots__ = ('registration_id', 'canonical_id', 'error')
+
+    def __init__(self, registration_id, canonical_id=None, error=None):
+        self.registration_id = registration_id
+        self.canonical_id = canonical_id
+        self.error = error
+
+    def is_ok(self):
+        return self.error is None
+
+
+class _PlaintextBatch(object):
+    """
+    state of one AsyncGCM.request_plaintext_batch call, driven by completion callbacks.
+    """
+    def __init__(self, gcm, messages, collapse_key, delay_while_idle, time_to_live, tries):
+        self.gcm = gcm
+        self.messages = messages
+        self.options = (collapse_key, delay_while_idle, time_to_live)
+        self.tries = tries
+        self.window = 2 * gcm.max_concurrency
+        self.results = []
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.exhausted = False
+
+    def start(self):
+        self._pump()
+        return self.future
+
+    def _pump(self):
+        while True:
+            submit = []
+            with self.lock:
+                try:
+                    while not self.exhausted and not self.future.done() and self.outstanding < self.window:
+                        try:
+                            registration_id, data = next(self.messages)
+                        except StopIteration:
+                            self.exhausted = True
+                            break
+                        self.results.append(PlaintextResult(registration_id))
+                        self.outstanding += 1
+                        submit.append((len(self.results) - 1, registration_id, data))
+                except Exception as e:
+                    self.exhausted = True
+                    self.future.set_exception(e)
+                    return
+                if self.exhausted and self.outstanding == 0 and not self.future.done():
+                    self.future.set_result(self.results)
+            finished = False
+            for index, registration_id, data in submit:
+                try:
+                    if not registration_id:
+                        raise GCMMissingRegistrationException("Missing registration_id")
+                    inner = self.gcm._plaintext(registration_id, data, *(self.options + (self.tries,)))
+                except Exception as e:
+                    inner = Future()
+                    inner.set_exception(e)
+                if inner.done():
+                    # failed at once (missing id, oversize data, dead id): recorded here, as a done
+                    # callback would recurse into _pump once per message
+                    self._record(index, inner)
+                    finished = True
+                else:
+                    inner.add_done_callback(lambda inner, index=index: self._finished(index, inner))
+            if not finished:
+                return
+
+    def _finished(self, index, inner):
+        self._record(index, inner)
+        self._pump()
+
+    def _record(self, index, inner):
+        error = _error_of(inner)
+        with self.lock:
+            self.outstanding -= 1
+            if error is None:
+                self.results[index].canonical_id = inner.result()
+            else:
+                self.results[index].error = error
+                if isinstance(error, GCMAuthenticationException) and not self.future.done():
+                    self.future.set_exception(error)
+
+
+class _BulkSend(object):
+    """
+    state of one AsyncGCM.send_bulk call, driven by completion callbacks.
+    """
+    def __init__(self, gcm, registration_ids, template):
+        self.gcm = gcm
+        self.template = template
+        self.window = 2 * gcm.max_concurrency
+        self.result = GCM_bulk_result()
+        self.payloads = gcm.bulk_payloads(registration_ids, template, self.result)
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.exhausted = False
+
+    def start(self):
+        self._pump()
+        return self.future
+
+    def _pump(self):
+        submit = []
+        with self.lock:
+            try:
+                while not self.exhausted and not self.future.done() and self.outstanding < self.window:
+                    try:
+                        submit.append(next(self.payloads))
+                        self.outstanding += 1
+                    except StopIteration:
+                        self.exhausted = True
+            except Exception as e:
+                self.exhausted = True
+                self.future.set_exception(e)
+                return
+            if self.exhausted and self.outstanding == 0 and not self.future.done():
+                self.future.set_result(self.result)
+        for batch, payload in submit:
+            self.gcm._executor.submit(self.gcm._send_json, payload, batch).add_done_callback(
+                lambda inner, batch=batch: self._finished(batch, inner))
+
+    def _finished(self, batch, inner):
+        error = _error_of(inner)
+        with self.lock:
+            self.outstanding -= 1
+            try:
+                # undelivered ids are forgotten as sent, so that they can be sent again
+                if error is None:
+                    response = inner.result()
+                    self.result.add_response(response, batch)
+                    self.gcm.forget_sent(response.get_resend_ids(batch), self.template)
+                elif isinstance(error, GCMRetriableException):
+                    self.result.add_unsent(batch)
+                    self.gcm.forget_sent(batch, self.template)
+                else:
+                    raise error
+            except Exception as e:
+                if not self.future.done():
+                    self.future.set_exception(e)
+        self._pump()
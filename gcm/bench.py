@@ -0,0 +1,221 @@
+"""
+Throughput benchmark for the send path, against a local MockGCMServer.
+
+    python -m gcm.bench --ids 20000 --latency 0.005 --unavailable 0.01 --modes json,bulk,concurrent
+
+For each mode prints requests/sec, ids/sec, p50/p99 request latency in ms, and CPU ms and body KB on
+the wire per 1000 ids; --gzip compresses requests and responses.
+With --import-runs, first measures how long `import gcm` takes in a fresh interpreter, and
+with --codec-runs, how long each installed JSON codec takes to encode and decode 1000 id messages.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from gcm import GCM, GCM_response_wrapper, PayloadTemplate
+from async_gcm import AsyncGCM
+from dispatch import MulticastDispatcher
+from jsoncodec import available_codecs
+from metrics import SendListener
+from mock_server import MockGCMServer
+from retry import MulticastRetrier
+
+
+class LatencyRecorder(SendListener):
+    """
+    keeps the exact latency of every request, for percentiles finer than Histogram buckets
+    """
+    def __init__(self):
+        self.latencies = []
+
+    def request_end(self, is_json, status, elapsed, error):
+        self.latencies.append(elapsed)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+IMPORT_SCRIPT = """
+import sys, time, json
+start = time.time()
+import gcm
+print(json.dumps({'secs': time.time() - start, 'modules': sorted(sys.modules)}))
+"""
+
+
+def import_time(runs=10):
+    """
+    time `import gcm` in runs fresh interpreters, interpreter startup excluded.
+    @return (median secs, sorted names of the modules loaded by the last run)
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    times = []
+    for i in range(runs):
+        result = json.loads(subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], env=env))
+        times.append(result['secs'])
+    return percentile(times, 50), result['modules']
+
+
+def codec_times(codec, runs, data):
+    """
+    @return (secs to encode, secs to decode) a 1000 id payload and response with codec, best of runs
+    """
+    reg_ids = ['reg-%08d' % i for i in xrange(1000)]
+    template = PayloadTemplate(data, codec=codec)
+    response = MockGCMServer(canonical_rate=0.1, not_registered_rate=0.1, seed=1).json_reply(reg_ids)
+    encode = decode = float('inf')
+    for i in range(runs):
+        start = time.time()
+        template.encode(reg_ids)
+        middle = time.time()
+        GCM_response_wrapper(response, codec).counts()
+        end = time.time()
+        encode, decode = min(encode, middle - start), min(decode, end - middle)
+    return encode, decode
+
+
+def run_json(gcm, reg_ids, data, options):
+    for start in xrange(0, len(reg_ids), gcm.MAX_REGISTRATION_IDS):
+        try:
+            gcm.request_json(reg_ids[start:start + gcm.MAX_REGISTRATION_IDS], data)
+        except Exception:
+            pass
+
+
+def run_plaintext(gcm, reg_ids, data, options):
+    for reg_id in reg_ids[:options.plaintext_ids]:
+        try:
+            gcm.request_plaintext(reg_id, data, tries=1)
+        except Exception:
+            pass
+    return min(len(reg_ids), options.plaintext_ids)
+
+
+def run_plaintext_batch(gcm, reg_ids, data, options):
+    messages = ((reg_id, data) for reg_id in reg_ids[:options.plaintext_ids])
+    gcm.request_plaintext_batch(messages, tries=3).result()
+    return min(len(reg_ids), options.plaintext_ids)
+
+
+def run_bulk(gcm, reg_ids, data, options):
+    gcm.send_bulk(iter(reg_ids), data)
+
+
+def run_concurrent(gcm, reg_ids, data, options):
+    dispatcher = MulticastDispatcher(gcm, max_workers=options.workers)
+    for batch in dispatcher.dispatch(iter(reg_ids), data):
+        pass
+    dispatcher.shutdown()
+
+
+def run_async(gcm, reg_ids, data, options):
+    gcm.send_bulk(iter(reg_ids), data).result()
+
+
+def run_retry(gcm, reg_ids, data, options):
+    MulticastRetrier(gcm, max_attempts=3, max_workers=options.workers).send(iter(reg_ids), data)
+
+
+MODES = [
+    ('json', run_json),
+    ('plaintext', run_plaintext),
+    ('plaintext_batch', run_plaintext_batch),
+    ('bulk', run_bulk),
+    ('concurrent', run_concurrent),
+    ('async', run_async),
+    ('retry', run_retry),
+]
+
+
+def bench(mode, server, options):
+    """
+    @return dict of the measurements for one mode
+    """
+    recorder = LatencyRecorder()
+    if mode in ('async', 'plaintext_batch'):
+        gcm = AsyncGCM('bench', url=server.url, max_concurrency=options.workers, listener=recorder,
+                       compress=options.gzip)
+    else:
+        gcm = GCM('bench', url=server.url, pool_size=options.workers, listener=recorder, compress=options.gzip)
+    gcm.BACKOFF_INITIAL_DELAY_MS = options.backoff_ms
+    reg_ids = ['reg-%08d' % i for i in xrange(options.ids)]
+    data = {'message': 'x' * options.data_bytes}
+
+    start, start_cpu = time.time(), cpu_time()
+    num_ids = dict(MODES)[mode](gcm, reg_ids, data, options) or len(reg_ids)
+    elapsed, cpu = time.time() - start, cpu_time() - start_cpu
+    gcm.close()
+
+    return {
+        'mode': mode,
+        'requests': len(recorder.latencies),
+        'requests_per_sec': len(recorder.latencies) / elapsed,
+        'ids_per_sec': num_ids / elapsed,
+        'p50_ms': percentile(recorder.latencies, 50) * 1000,
+        'p99_ms': percentile(recorder.latencies, 99) * 1000,
+        'cpu_ms_per_1000_ids': cpu * 1000 * 1000 / num_ids,
+        'wire_kb_per_1000_ids': (gcm.pool.bytes_sent + gcm.pool.bytes_received) / 1024.0 * 1000 / num_ids,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark python-gcm against a local mock GCM server')
+    parser.add_argument('--ids', type=int, default=20000, help='recipients per mode')
+    parser.add_argument('--plaintext-ids', type=int, default=500, help='recipients for the plaintext modes')
+    parser.add_argument('--data-bytes', type=int, default=200, help='size of the message data')
+    parser.add_argument('--workers', type=int, default=8, help='concurrency for concurrent/async/retry modes')
+    parser.add_argument('--latency', type=float, default=0.0, help='server latency per request, secs')
+    parser.add_argument('--unavailable', type=float, default=0.0, help='rate of Unavailable results')
+    parser.add_argument('--error-5xx', type=float, default=0.0, help='rate of 503 responses')
+    parser.add_argument('--canonical', type=float, default=0.0, help='rate of canonical id results')
+    parser.add_argument('--not-registered', type=float, default=0.0, help='rate of NotRegistered results')
+    parser.add_argument('--backoff-ms', type=int, default=10, help='initial retry backoff, ms')
+    parser.add_argument('--modes', default=','.join(name for name, fn in MODES),
+                        help='comma separated subset of: %s' % ', '.join(name for name, fn in MODES))
+    parser.add_argument('--gzip', action='store_true', help='gzip request bodies and responses')
+    parser.add_argument('--import-runs', type=int, default=0, help='times to measure `import gcm`, 0 to skip')
+    parser.add_argument('--codec-runs', type=int, default=0,
+                        help='times to encode and decode 1000 id messages with each JSON codec, 0 to skip')
+    options = parser.parse_args(argv)
+
+    if options.import_runs:
+        secs, modules = import_time(options.import_runs)
+        heavy = [name for name in modules if name.split('.')[0] == 'django']
+        print('import gcm: %.1f ms, %d modules loaded%s' % (
+            secs * 1000, len(modules), ' (including django!)' if heavy else ''))
+
+    if options.codec_runs:
+        print('%-12s %12s %12s' % ('codec', 'encode us', 'decode us'))
+        for codec in available_codecs():
+            encode, decode = codec_times(codec, options.codec_runs, {'message': 'x' * options.data_bytes})
+            print('%-12s %12.1f %12.1f' % (codec.name, encode * 1e6, decode * 1e6))
+
+    server = MockGCMServer(latency=options.latency, unavailable_rate=options.unavailable,
+                           error_5xx_rate=options.error_5xx, canonical_rate=options.canonical,
+                           not_registered_rate=options.not_registered, gzip_responses=options.gzip,
+                           seed=1).start()
+    try:
+        print('%-15s %9s %10s %11s %9s %9s %14s %14s' % (
+            'mode', 'requests', 'req/s', 'ids/s', 'p50 ms', 'p99 ms', 'cpu ms/1k ids', 'wire KB/1k ids'))
+        for mode in options.modes.split(','):
+            result = bench(mode.strip(), server, options)
+            print('%(mode)-15s %(requests)9d %(requests_per_sec)10.1f %(ids_per_sec)11.1f '
+                  '%(p50_ms)9.2f %(p99_ms)9.2f %(cpu_ms_per_1000_ids)14.2f %(wire_kb_per_1000_ids)14.1f' % result)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
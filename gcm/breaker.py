@@ -0,0 +1,86 @@
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """
+    Fail-fast guard around GCM requests during an outage. After failure_threshold consecutive
+    failures (retriable errors or authentication errors) the circuit opens and GCM.make_request
+    raises GCMCircuitOpenException without touching the network. After reset_timeout secs it goes
+    half-open and lets half_open_probes requests through: a success closes it, a failure reopens it.
+
+    gcm = GCM(API_KEY, breaker=CircuitBreaker.shared(API_KEY))
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, half_open_probes=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, api_key, **kwargs):
+        """
+        @return the process-wide breaker for api_key, created with kwargs on first use
+        """
+        with cls._registry_lock:
+            breaker = cls._registry.get(api_key)
+            if breaker is None:
+                breaker = cls._registry[api_key] = cls(**kwargs)
+            return breaker
+
+    def allow(self):
+        """
+        @return True if a request may be sent now; in half-open state this claims a probe
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.time() < self._opened_at + self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probes = 0
+            if self.state == self.HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    return False
+                self._probes += 1
+            return True
+
+    def available(self):
+        """
+        @return True if allow() would let a request through now, without claiming a probe
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.time() >= self._opened_at + self.reset_timeout
+            return self.state == self.CLOSED or self._probes < self.half_open_probes
+
+    def retry_in(self):
+        """
+        @return secs until the circuit lets a probe through, 0 if it is not open
+        """
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self._opened_at + self.reset_timeout - time.time())
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.time()
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import threading
+import time
+from collections import deque
+
+from gcm import GCM_response_wrapper, PayloadTemplate
+
+# outcome of a send the Deduplicator suppressed, alongside the statuses of GCM_response_wrapper.outcomes()
+DUPLICATE = GCM_response_wrapper.DUPLICATE
+
+
+def payload_key(data):
+    """
+    @return digest identifying data regardless of key order, to group recipients by payload
+    """
+    return hashlib.md5(json.dumps(data, sort_keys=True, separators=(',', ':'))).digest()
+
+
+def message_key(data, collapse_key=None):
+    """
+    :param data: dict of the message, or a PayloadTemplate (whose collapse_key is then used)
+    @return digest identifying a message by its collapse_key and data
+    """
+    if isinstance(data, PayloadTemplate):
+        data, collapse_key = data.data, data.collapse_key
+    if isinstance(collapse_key, unicode):
+        collapse_key = collapse_key.encode('utf-8')
+    return hashlib.md5('%s\0%s' % (collapse_key or '', payload_key(data))).digest()
+
+
+class Deduplicator(object):
+    """
+    Drops repeated sends of the same message to the same device: the first send of a
+    (reg_id, collapse_key, data) triple goes through, and repeats within window secs are left out,
+    whether they are in the same batch or in a later one. Give it to GCM(deduplicator=...) and
+    send_bulk, MulticastRetrier and MulticastDispatcher.dispatch apply it to the ids they are
+    given; request_json and request_plaintext do not, as their callers map results by position.
+    Ids left out are reported in the result as DUPLICATE outcomes, and ids that end up undelivered
+    (resend_ids, ids given up on) are forgotten, so that sending them again is not a repeat.
+
+    A triple is remembered by an 8 byte digest and its expiry, in a dict and a queue in the order
+    sent: under 200 bytes each, so under 20 MB for the default max_entries. Past max_entries the oldest
+    are evicted early, so memory stays bounded at the cost of letting an older duplicate through.
+    suppressed counts the sends left out.
+
+    dedup = Deduplicator(window=60)
+    gcm = GCM(API_KEY, deduplicator=dedup)
+    """
+    def __init__(self, window=60, max_entries=100000):
+        self.window = window
+        self.max_entries = max_entries
+        self.suppressed = 0
+        self._expires = {}      # digest => expires_at
+        self._order = deque()   # digests, in the order sent
+        self._times = deque()   # their expires_at, the very objects held in _expires
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._expires)
+
+    def _key(self, reg_id, message):
+        if isinstance(reg_id, unicode):
+            reg_id = reg_id.encode('utf-8')
+        return hashlib.md5(message + reg_id).digest()[:8]
+
+    def _expire(self, now):
+        expires, order, times = self._expires, self._order, self._times
+        while order:
+            if times[0] > now and len(expires) <= self.max_entries:
+                return
+            key, expires_at = order.popleft(), times.popleft()
+            # unless forgotten or sent again since
+            if expires.get(key) is expires_at:
+                del expires[key]
+
+    def message(self, data, collapse_key=None):
+        """
+        @return message_key(data, collapse_key), for check()
+        """
+        return message_key(data, collapse_key)
+
+    def check(self, reg_id, message):
+        """
+        :param message: message_key() of what is sent
+        @return True if reg_id is to be sent message, False if it was sent within the window;
+                either way it is remembered from now on as sent
+        """
+        key = self._key(reg_id, message)
+        now = time.time()
+        with self._lock:
+            expires_at = self._expires.get(key)
+            if expires_at is not None and expires_at > now:
+                self.suppressed += 1
+                return False
+            expires_at = self._expires[key] = now + self.window
+            self._order.append(key)
+            self._times.append(expires_at)
+            self._expire(now)
+            return True
+
+    def apply(self, reg_ids, data, collapse_key=None, result=None):
+        """
+        :param result: GCM_bulk_result to fold the ids left out into, as DUPLICATE outcomes
+        @return generator over the reg_ids not sent this message within the window
+        """
+        message = self.message(data, collapse_key)
+        for reg_id in reg_ids:
+            if self.check(reg_id, message):
+                yield reg_id
+            elif result is not None:
+                result.add_outcomes([(reg_id, DUPLICATE, None)])
+
+    def forget(self, reg_ids, data, collapse_key=None):
+        """
+        let these reg_ids be sent this message again, e.g. the resend_ids of a send that gave up
+        """
+        message = message_key(data, collapse_key)
+        with self._lock:
+            for reg_id in reg_ids:
+                self._expires.pop(self._key(reg_id, message), None)
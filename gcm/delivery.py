@@ -0,0 +1,312 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from gcm import GCM_bulk_result, GCM_response_wrapper, GCMException, \
+    GCMMissingRegistrationException, PayloadTemplate
+from dispatch import BoundedExecutor, Future
+from retry import MulticastRetrier
+
+
+class DeliveryResult(GCM_bulk_result):
+    """
+    GCM_bulk_result of one message put on a DeliveryQueue, plus the ids it was never sent to:
+        * superseded: a newer message with the same collapse_key for the device replaced it
+        * expired: its deadline passed before it could be sent
+    """
+    def __init__(self):
+        GCM_bulk_result.__init__(self)
+        self.superseded = []
+        self.expired = []
+
+
+class _Message(object):
+    def __init__(self, num_ids, deadline):
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.result = DeliveryResult()
+        self.remaining = num_ids
+        self.deadline = deadline
+        # the ids of one message are resolved from several sends at once, and superseded from callers
+        self.lock = threading.Lock()
+
+    def resolved(self, outcome):
+        """
+        fold in the outcome of one of its ids, a (reg_id, status, extra) triple
+        """
+        with self.lock:
+            self.result.add_outcomes([outcome])
+            self._resolved()
+
+    def dropped(self, reg_id, reason):
+        """
+        :param reason: 'superseded' or 'expired', the DeliveryResult list to add reg_id to
+        """
+        with self.lock:
+            getattr(self.result, reason).append(reg_id)
+            self._resolved()
+
+    def _resolved(self):
+        self.remaining -= 1
+        if self.remaining == 0 and not self.future.done():
+            self.future.set_result(self.result)
+
+    def fail(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class _Entry(object):
+    """
+    one device in a group, and the messages (identical payloads) waiting to reach it
+    """
+    def __init__(self, reg_id):
+        self.reg_id = reg_id
+        self.messages = []
+
+
+class _Group(object):
+    """
+    pending messages with the same payload and priority, sent together as multicasts
+    """
+    def __init__(self, key, priority, template):
+        self.key = key
+        self.priority = priority
+        self.template = template
+        self.entries = OrderedDict()  # reg_id => _Entry
+        self.created = time.time()
+        self.deadline = None
+
+    def add(self, reg_id, message):
+        entry = self.entries.get(reg_id)
+        if entry is None:
+            entry = self.entries[reg_id] = _Entry(reg_id)
+        entry.messages.append(message)
+        if message.deadline is not None and (self.deadline is None or message.deadline < self.deadline):
+            self.deadline = message.deadline
+        return entry
+
+
+class _Fanout(GCM_bulk_result):
+    """
+    hands the outcome of each id in a multicast to the messages waiting on it. Outcomes come back
+    under the id sent, which the registration store may have rewritten: they are reported under the
+    id each message was queued with, a delivery to a rewritten id as CANONICAL.
+    """
+    def __init__(self, entries):
+        GCM_bulk_result.__init__(self)
+        self.entries = entries  # id sent => entries sent to it
+
+    def add_response(self, response, reg_ids, resends=True):
+        self.num_batches += 1
+        self.add_outcomes(self.response_outcomes(response, reg_ids, resends))
+
+    def add_outcomes(self, outcomes):
+        for sent_id, status, extra in outcomes:
+            for entry in self.entries.pop(sent_id, ()):
+                outcome = (entry.reg_id, status, extra)
+                if entry.reg_id != sent_id and status == GCM_response_wrapper.SUCCESS:
+                    outcome = (entry.reg_id, GCM_response_wrapper.CANONICAL, sent_id)
+                for message in entry.messages:
+                    message.resolved(outcome)
+
+    def add_resends(self, reg_ids):
+        self.add_outcomes((reg_id, GCM_response_wrapper.RESEND, 'Unavailable') for reg_id in reg_ids)
+
+
+class DeliveryQueue(object):
+    """
+    Background delivery for code that must not wait on GCM, such as request handlers: send()
+    queues a message and returns a Future of its DeliveryResult at once.
+
+    Queued messages with the same data, collapse_key, delay_while_idle, time_to_live and priority
+    are merged into multicasts of up to 1000 ids; a group goes out when it is full, after waiting
+    linger secs for company, or sooner if a deadline is near. HIGH priority groups are sent before
+    NORMAL and LOW ones. A queued message for a device is superseded by a newer one with the same
+    collapse_key: only the newest is sent, as GCM would only show that one anyway.
+
+    A message's deadline is time_to_live (or deadline, if sooner) after it was queued: past it the
+    message is dropped, and the time_to_live sent to GCM is what is left of it. Unavailable ids
+    are retried by a MulticastRetrier within the same deadline. Outcomes are reported under the ids
+    queued, even when the gcm's registration store rewrites them.
+
+    queue = DeliveryQueue(GCM(API_KEY, pool_size=4), max_workers=4)
+    queue.send(reg_ids, {'msg': 'hi'}, collapse_key='inbox', time_to_live=3600, priority=DeliveryQueue.HIGH)
+    queue.close()
+    """
+    HIGH, NORMAL, LOW = 0, 1, 2
+
+    def __init__(self, gcm, max_workers=4, linger=0.05, max_attempts=3):
+        self.gcm = gcm
+        self.linger = linger
+        self.max_attempts = max_attempts
+        self._groups = {}
+        self._latest = {}  # (reg_id, collapse_key) => (group, entry) still queued
+        self._condition = threading.Condition()
+        self._closed = False
+        self._executor = BoundedExecutor(max_workers)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, registration_ids, data=None, collapse_key=None, delay_while_idle=False,
+               time_to_live=None, priority=NORMAL, deadline=None):
+        """
+        :param registration_ids: one registration id, or a list of them
+        :param deadline: secs to deliver within, when sooner than time_to_live
+        @return Future of the DeliveryResult
+        :raises GCMMessageTooBigException, GCMInvalidTtlException, GCMNoCollapseKeyException: as PayloadTemplate
+        """
+        if isinstance(registration_ids, basestring):
+            registration_ids = [registration_ids]
+        if not registration_ids:
+            raise GCMMissingRegistrationException("Missing registration_ids")
+        if not data:
+            raise GCMException('no data to send')
+
+        key = (priority, json.dumps(data, sort_keys=True), collapse_key, delay_while_idle, time_to_live)
+        limits = [secs for secs in (time_to_live, deadline) if secs is not None]
+        message = _Message(len(registration_ids), time.time() + min(limits) if limits else None)
+        with self._condition:
+            if self._closed:
+                raise GCMException('delivery queue is closed')
+            group = self._groups.get(key)
+            if group is None:
+                template = PayloadTemplate(data, collapse_key, delay_while_idle, time_to_live,
+                                           codec=self.gcm.json_codec)
+                group = self._groups[key] = _Group(key, priority, template)
+            for reg_id in registration_ids:
+                if collapse_key is not None:
+                    self._supersede(reg_id, collapse_key, group)
+                entry = group.add(reg_id, message)
+                if collapse_key is not None:
+                    self._latest[(reg_id, collapse_key)] = (group, entry)
+            self._condition.notify()
+        return message.future
+
+    def _supersede(self, reg_id, collapse_key, group):
+        queued = self._latest.get((reg_id, collapse_key))
+        if queued is None or queued[0] is group:
+            return
+        old_group, entry = queued
+        del old_group.entries[reg_id]
+        for message in entry.messages:
+            message.dropped(reg_id, 'superseded')
+        if not old_group.entries:
+            del self._groups[old_group.key]
+
+    def pending(self):
+        """
+        @return number of (device, payload) pairs waiting to be sent
+        """
+        with self._condition:
+            return sum(len(group.entries) for group in self._groups.values())
+
+    def _ready_at(self, group):
+        if len(group.entries) >= self.gcm.MAX_REGISTRATION_IDS or self._closed:
+            return 0
+        ready_at = group.created + self.linger
+        if group.deadline is not None:
+            ready_at = min(ready_at, group.deadline - self.linger)
+        return ready_at
+
+    def _take_ready(self):
+        """
+        wait for groups that are due and take them off the queue, highest priority first
+        """
+        with self._condition:
+            while True:
+                if not self._groups:
+                    if self._closed:
+                        return None
+                    self._condition.wait()
+                    continue
+                now = time.time()
+                ready = [group for group in self._groups.values() if self._ready_at(group) <= now]
+                if ready:
+                    break
+                self._condition.wait(min(self._ready_at(group) for group in self._groups.values()) - now)
+            for group in ready:
+                del self._groups[group.key]
+                collapse_key = group.template.collapse_key
+                if collapse_key is not None:
+                    for reg_id in group.entries:
+                        del self._latest[(reg_id, collapse_key)]
+            ready.sort(key=lambda group: (group.priority, group.created))
+            return ready
+
+    def _run(self):
+        while True:
+            groups = self._take_ready()
+            if groups is None:
+                self._executor.shutdown(wait=True)
+                return
+            size = self.gcm.MAX_REGISTRATION_IDS
+            for group in groups:
+                entries = group.entries.values()
+                for start in xrange(0, len(entries), size):
+                    self._executor.submit(self._send, group.template, entries[start:start + size])
+
+    def _send(self, template, entries):
+        now = time.time()
+        live = []
+        for entry in entries:
+            messages = [message for message in entry.messages if message.deadline is None or message.deadline > now]
+            for message in entry.messages:
+                if message not in messages:
+                    message.dropped(entry.reg_id, 'expired')
+            if messages:
+                entry.messages = messages
+                live.append(entry)
+        if not live:
+            return
+
+        deadline = min([message.deadline for entry in live for message in entry.messages
+                        if message.deadline is not None] or [None])
+        if deadline is not None and template.time_to_live is not None:
+            # at least 1: a time_to_live of 0 is left out of the payload, and GCM would keep
+            # the message for its default of 4 weeks
+            time_to_live = max(1, min(template.time_to_live, int(deadline - now)))
+            if time_to_live != template.time_to_live:
+                template = PayloadTemplate(template.data, template.collapse_key, template.delay_while_idle,
+                                           time_to_live, codec=template.codec)
+        retrier = MulticastRetrier(self.gcm, self.max_attempts,
+                                   None if deadline is None else max(0, deadline - now))
+        fanout = _Fanout(self._lookup(live))
+        if not fanout.entries:
+            return
+        try:
+            retrier.send(list(fanout.entries), template, result=fanout, lookup=False)
+        except Exception as e:
+            for entries in fanout.entries.values():
+                for entry in entries:
+                    for message in entry.messages:
+                        message.fail(e)
+
+    def _lookup(self, entries):
+        """
+        rewrite the ids of entries through the gcm's registration store, resolving dead ones
+        @return OrderedDict( id to send to: entries )
+        """
+        store = self.gcm.registration_store
+        by_sent_id = OrderedDict()
+        for entry in entries:
+            sent_id = entry.reg_id if store is None else store.lookup(entry.reg_id)
+            if sent_id is None:
+                for message in entry.messages:
+                    message.resolved((entry.reg_id, GCM_response_wrapper.UNREGISTER, 'NotRegistered'))
+                continue
+            by_sent_id.setdefault(sent_id, []).append(entry)
+        return by_sent_id
+
+    def close(self, wait=True):
+        """
+        send everything still queued without lingering, then stop.
+        :param wait: block until every send has finished
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if wait:
+            self._thread.join()
@@ -0,0 +1,361 @@
+import heapq
+import threading
+import time
+import Queue
+from collections import deque
+from itertools import islice
+
+from gcm import GCM_bulk_result, GCMCancelledException, GCMTimeoutException, GCMRetriableException
+
+
+class Future(object):
+    """
+    Result of a send that completes on another thread (python 2 has no concurrent.futures).
+    """
+    PENDING, RUNNING, CANCELLED, FINISHED = range(4)
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = self.PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def cancel(self):
+        """
+        cancel the send if it has not started yet.
+        @return True if cancelled
+        """
+        with self._condition:
+            if self._state == self.CANCELLED:
+                return True
+            if self._state != self.PENDING:
+                return False
+            self._state = self.CANCELLED
+            self._condition.notify_all()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == self.CANCELLED
+
+    def running(self):
+        return self._state == self.RUNNING
+
+    def done(self):
+        return self._state in (self.CANCELLED, self.FINISHED)
+
+    def set_running_or_notify_cancel(self):
+        """
+        @return False if the future was cancelled and the work should be skipped
+        """
+        with self._condition:
+            if self._state == self.CANCELLED:
+                return False
+            self._state = self.RUNNING
+            return True
+
+    def set_result(self, result):
+        with self._condition:
+            self._result = result
+            self._state = self.FINISHED
+            self._condition.notify_all()
+        self._run_callbacks()
+
+    def set_exception(self, exception):
+        with self._condition:
+            self._exception = exception
+            self._state = self.FINISHED
+            self._condition.notify_all()
+        self._run_callbacks()
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self.done():
+                self._condition.wait(timeout)
+            if self._state == self.CANCELLED:
+                raise GCMCancelledException("send was cancelled")
+            if self._state != self.FINISHED:
+                raise GCMTimeoutException("send did not finish within %s secs" % timeout)
+
+    def result(self, timeout=None):
+        """
+        block until the send finishes.
+        :raises GCMCancelledException, GCMTimeoutException, or whatever the send raised
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        call fn(future) once done; immediately if it already is.
+        """
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _run_callbacks(self):
+        with self._condition:
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                pass
+
+
+class BoundedExecutor(object):
+    """
+    Fixed set of worker threads fed from a bounded queue: submit() blocks once
+    max_pending calls are waiting, which pushes back on a producer that is faster than GCM.
+    max_pending defaults to max_workers; 0 means unbounded.
+    """
+    def __init__(self, max_workers=4, max_pending=None):
+        if max_pending is None:
+            max_pending = max_workers
+        self._queue = Queue.Queue(maxsize=max_pending)
+        self._shutdown = False
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        if self._shutdown:
+            raise RuntimeError('cannot submit after shutdown')
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+        stop the workers once the queue drains; with cancel_pending, queued calls are cancelled first.
+        """
+        self._shutdown = True
+        if cancel_pending:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item is not None:
+                    item[0].cancel()
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+class Scheduler(object):
+    """
+    One timer thread that runs callbacks once their delay expires, so waiting for a retry
+    costs a heap entry instead of a sleeping thread. Callbacks should be quick: hand real work
+    to an executor.
+    """
+    def __init__(self):
+        self._heap = []
+        self._condition = threading.Condition()
+        self._counter = 0
+        self._thread = None
+        self._stopped = False
+
+    def call_later(self, delay, fn, *args):
+        """
+        run fn(*args) on the timer thread after delay secs.
+        @return handle to pass to cancel()
+        """
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError('scheduler is stopped')
+            self._counter += 1
+            entry = [time.time() + delay, self._counter, fn, args]
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return entry
+
+    def cancel(self, handle):
+        handle[2] = None
+
+    def pending(self):
+        with self._condition:
+            return len([entry for entry in self._heap if entry[2] is not None])
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    wait = self._heap[0][0] - time.time()
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                if self._stopped:
+                    return
+                entry = heapq.heappop(self._heap)
+            fn, args = entry[2], entry[3]
+            if fn is None:
+                continue
+            try:
+                fn(*args)
+            except Exception:
+                pass
+
+    def stop(self):
+        """
+        drop every pending callback and stop the timer thread.
+        """
+        with self._condition:
+            self._stopped = True
+            self._heap = []
+            self._condition.notify()
+
+
+class BatchResult(object):
+    """
+    outcome of one multicast batch: either a GCM_response_wrapper or the exception that ended it.
+    registration_ids are the ids sent, and given_ids the same ids as given to dispatch, which differ
+    where the registration store rewrote them.
+    """
+    __slots__ = ('index', 'registration_ids', 'response', 'error', 'given_ids')
+
+    def __init__(self, index, registration_ids, response=None, error=None, given_ids=None):
+        self.index = index
+        self.registration_ids = registration_ids
+        self.response = response
+        self.error = error
+        self.given_ids = registration_ids if given_ids is None else given_ids
+
+    def is_ok(self):
+        return self.error is None
+
+    def is_retriable(self):
+        """
+        True if the whole batch may be resent: a GCMRetriableException, or a cancelled batch.
+        """
+        return isinstance(self.error, (GCMRetriableException, GCMCancelledException))
+
+
+class MulticastDispatcher(object):
+    """
+    Keeps up to max_in_flight multicast batches in flight against GCM over a thread pool.
+    Give the GCM instance a pool_size of at least max_workers so every worker gets a connection.
+
+    dispatcher = MulticastDispatcher(GCM(API_KEY, pool_size=8), max_workers=8)
+    for batch in dispatcher.dispatch(reg_ids, data):
+        if batch.is_ok(): ...
+        elif batch.is_retriable(): ...
+    dispatcher.shutdown()
+    """
+    def __init__(self, gcm, max_workers=4, max_in_flight=None):
+        self.gcm = gcm
+        self.max_in_flight = max_in_flight or 2 * max_workers
+        self._executor = BoundedExecutor(max_workers, self.max_in_flight)
+        self._lock = threading.Lock()
+        self._running = set()  # cancellation events of the dispatches in progress
+
+    def submit(self, registration_ids, data=None, collapse_key=None,
+                 delay_while_idle=False, time_to_live=None):
+        """
+        send a single batch of at most 1000 ids without blocking on the response.
+        :param data: dict mapping of key-value pairs of messages, or a PayloadTemplate
+        @return Future of the GCM_response_wrapper
+        """
+        return self._executor.submit(self.gcm.request_json, registration_ids, data, collapse_key,
+                                     delay_while_idle, time_to_live)
+
+    def dispatch(self, registration_ids, data=None, collapse_key=None,
+                   delay_while_idle=False, time_to_live=None, result=None):
+        """
+        Split registration_ids (any iterable) into batches and send them concurrently.
+        Failures are reported per batch and never abort the others. The payload is encoded
+        once, as a PayloadTemplate, and only the ids of each batch are encoded per request.
+
+        :param result: GCM_bulk_result to report the ids left out of every batch to: those the
+                       registration store knows are dead as UNREGISTER, repeats as DUPLICATE
+        @return generator of BatchResult, in the order the batches were cut
+        """
+        template = self.gcm.payload_template(data, collapse_key, delay_while_idle, time_to_live)
+        if result is None:
+            result = GCM_bulk_result()
+        ids = self.gcm.filter_ids(registration_ids, template, result=result)
+        cancelled = threading.Event()
+        with self._lock:
+            self._running.add(cancelled)
+        in_flight = deque()
+        index = 0
+        try:
+            while not cancelled.is_set():
+                batch = list(islice(ids, self.gcm.MAX_REGISTRATION_IDS))
+                if not batch:
+                    break
+                if len(in_flight) >= self.max_in_flight:
+                    yield self._collect(template, *in_flight.popleft())
+                in_flight.append((index, batch, result.given_ids(batch), self.submit(batch, template)))
+                index += 1
+            if cancelled.is_set():
+                for item in in_flight:
+                    item[3].cancel()
+            while in_flight:
+                yield self._collect(template, *in_flight.popleft())
+        finally:
+            with self._lock:
+                self._running.discard(cancelled)
+            # the caller stopped iterating early: don't send what nobody will look at
+            for item in in_flight:
+                if item[3].cancel():
+                    self.gcm.forget_sent(item[1], template)
+
+    def _collect(self, template, index, batch, given_ids, future):
+        try:
+            response = future.result()
+        except Exception as e:
+            # not delivered: the caller may dispatch the batch again
+            self.gcm.forget_sent(batch, template)
+            return BatchResult(index, batch, error=e, given_ids=given_ids)
+        if self.gcm.deduplicator is not None:
+            self.gcm.forget_sent(response.get_resend_ids(batch), template)
+        return BatchResult(index, batch, response=response, given_ids=given_ids)
+
+    def cancel(self):
+        """
+        stop cutting new batches in the dispatches in progress; batches not yet started are
+        reported as cancelled. Later dispatches are not affected.
+        """
+        with self._lock:
+            for cancelled in self._running:
+                cancelled.set()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_pending=True)
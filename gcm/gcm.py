@@ -1,13 +1,25 @@
 # from https://github.com/geeknam/python-gcm on 30 aug 2012
 import urllib
-import urllib2
 import json
+import logging
 import time
 import random
-from django.utils.encoding import smart_str
+import threading
+from array import array
+from bisect import bisect_left
+from email.utils import parsedate_tz, mktime_tz
+from itertools import chain, islice
+from jsoncodec import default_codec
+from transport import HTTPConnectionPool
 
 GCM_URL = 'https://android.googleapis.com/gcm/send'
 
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# GCM rejects messages whose data exceeds this many bytes with MessageTooBig
+MAX_DATA_BYTES = 4096
+
 
 class GCMException(Exception): pass
 class GCMNoRetryException(Exception): pass
@@ -19,14 +31,40 @@ class GCMAuthenticationException(GCMNoRetryException): pass
 class GCMTooManyRegIdsException(GCMNoRetryException): pass
 class GCMNoCollapseKeyException(GCMNoRetryException): pass
 class GCMInvalidTtlException(GCMNoRetryException): pass
+class GCMCancelledException(GCMException): pass
+class GCMTimeoutException(GCMException): pass
+
+class GCMCircuitOpenException(GCMRetriableException):
+    # secs until the circuit breaker lets a probe request through
+    retry_after = None
 
 # Exceptions from Google responses
 class GCMMissingRegistrationException(GCMNoRetryException): pass
 class GCMMismatchSenderIdException(GCMNoRetryException): pass
 class GCMNotRegisteredException(GCMNoRetryException): pass
-class GCMMessageTooBigException(GCMNoRetryException): pass
+class GCMMessageTooBigException(GCMNoRetryException):
+    # when raised before sending: list( (key, bytes) ) of the data, biggest first
+    key_sizes = None
 class GCMInvalidRegistrationException(GCMNoRetryException): pass
-class GCMUnavailableException(GCMRetriableException): pass
+class GCMUnavailableException(GCMRetriableException):
+    # secs GCM asked us to wait before retrying (Retry-After header), or None
+    retry_after = None
+
+
+def parse_retry_after(value):
+    """
+    Retry-After is either a number of secs or an HTTP date.
+    @return secs to wait from now, or None if missing or unparseable
+    """
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0, mktime_tz(parsed) - time.time())
 
 class GCM(object):
 
@@ -34,8 +72,46 @@ class GCM(object):
     BACKOFF_INITIAL_DELAY_MS = 1000
     MAX_BACKOFF_DELAY_MS = 1024000
 
-    def __init__(self, api_key):
+    # GCM accepts at most this many registration_ids per multicast request
+    MAX_REGISTRATION_IDS = 1000
+
+    def __init__(self, api_key, url=GCM_URL, pool_size=4, idle_timeout=30.0,
+                 max_requests_per_connection=1000, timeout=None, listener=None, limiter=None,
+                 breaker=None, registration_store=None, json_codec=None, compress=False,
+                 deduplicator=None):
+        """
+        :param url: GCM endpoint; override to point at a stand-in server
+        :param pool_size: number of keep-alive connections kept open to GCM
+        :param idle_timeout: secs before an unused connection is dropped
+        :param max_requests_per_connection: requests sent over one connection before it is recycled
+        :param timeout: socket timeout in secs
+        :param listener: metrics.SendListener notified of requests, retries and results
+        :param limiter: ratelimit.TokenBucket or ConcurrencyLimiter every request must pass, may be shared
+        :param breaker: breaker.CircuitBreaker to fail fast during outages, e.g. CircuitBreaker.shared(api_key)
+        :param registration_store: regstore.RegistrationStore of canonical and dead ids, applied to batch
+                                   sends and request_plaintext
+        :param json_codec: jsoncodec.JSONCodec for payloads and responses, by default the fastest installed
+        :param compress: gzip request bodies of 1KB and up (GCM responses are gunzipped regardless)
+        :param deduplicator: dedup.Deduplicator dropping repeats of a message to the same device, applied
+                             to batch sends
+        """
         self.api_key = api_key
+        self.listener = listener
+        self.limiter = limiter
+        self.breaker = breaker
+        self.registration_store = registration_store
+        self.deduplicator = deduplicator
+        self.json_codec = json_codec or default_codec()
+        self.url = url
+        self.pool = HTTPConnectionPool(url, maxsize=pool_size, idle_timeout=idle_timeout,
+                                       max_requests=max_requests_per_connection, timeout=timeout,
+                                       compress=compress)
+
+    def close(self):
+        """
+        Close the idle keep-alive connections held by this instance.
+        """
+        self.pool.close()
 
     def construct_payload(self, registration_ids, data=None, collapse_key=None,
                             delay_while_idle=False, time_to_live=None, is_json=True):
@@ -45,13 +121,27 @@ class GCM(object):
         Helps appending 'data.' prefix to the plaintext data: 'hello' => 'data.hello'
 
         :return constructed dict or JSON payload
+        :raises GCMMessageTooBigException: if data is over MAX_DATA_BYTES
         :raises GCMInvalidTtlException: if time_to_live is invalid
         :raises GCMNoCollapseKeyException: if collapse_key is missing when time_to_live is used
         """
+        if is_json:
+            return PayloadTemplate(data, collapse_key, delay_while_idle, time_to_live,
+                                   codec=self.json_codec).encode(registration_ids)
+
+        payload = self._payload_dict(registration_ids, data, collapse_key,
+                                     delay_while_idle, time_to_live, is_json)
+        if data:
+            check_data_size(sum(len(_utf8(k)) + len(_utf8(v)) for k, v in data.items()), data)
+        return payload
 
-        if time_to_live:
-            if time_to_live > 2419200 or time_to_live < 0:
-                raise GCMInvalidTtlException("Invalid time to live value")
+    def _payload_dict(self, registration_ids, data=None, collapse_key=None,
+                        delay_while_idle=False, time_to_live=None, is_json=True):
+        """
+        Validate the parameters and build the (not yet encoded) payload dict for construct_payload.
+        The caller's data dict is left untouched.
+        """
+        validate_options(collapse_key, time_to_live)
 
         if is_json:
             payload = {'registration_ids': registration_ids}
@@ -60,24 +150,10 @@ class GCM(object):
         else:
             payload = {'registration_id': registration_ids}
             if data:
-                for k in data.keys():
-                    data['data.%s' % k] = data.pop(k)
-                payload.update(data)
-
-        if delay_while_idle:
-            payload['delay_while_idle'] = delay_while_idle
-
-        if time_to_live:
-            payload['time_to_live'] = time_to_live
-            if collapse_key is None:
-                raise GCMNoCollapseKeyException("collapse_key is required when time_to_live is provided")
-
-        if collapse_key:
-            payload['collapse_key'] = collapse_key
-
-        if is_json:
-            payload = json.dumps(payload)
+                for k, v in data.items():
+                    payload['data.%s' % k] = v
 
+        payload.update(_options_dict(collapse_key, delay_while_idle, time_to_live))
         return payload
 
     def make_request(self, data, is_json=True):
@@ -88,37 +164,141 @@ class GCM(object):
         :raises GCMMalformedJsonException: if malformed JSON request found
         :raises GCMAuthenticationException: if there was a problem with authentication, invalid api key
         :raises GCMConnectionException: if GCM is screwed
+        :raises GCMCircuitOpenException: if the circuit breaker is open; nothing was sent
         """
 
         headers = {
             'Authorization': 'key=%s' % self.api_key,
         }
-        # Default Content-Type is defaulted to application/x-www-form-urlencoded;charset=UTF-8
         if is_json:
             headers['Content-Type'] = 'application/json'
-
-        if not is_json:
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded;charset=UTF-8'
             data = urllib.urlencode(data)
-        req = urllib2.Request(GCM_URL, data, headers)
 
+        breaker = self.breaker
+        if breaker is None:
+            return self._limited_send(data, headers, is_json)
+        if not breaker.allow():
+            e = GCMCircuitOpenException("GCM circuit breaker is open after %d consecutive failures" % breaker.failures)
+            e.retry_after = breaker.retry_in()
+            raise e
         try:
-            response = urllib2.urlopen(req).read()
-        except urllib2.HTTPError as e:
-            if e.code == 400:
-                raise GCMMalformedJsonException("JSON could not be parsed (400)")
-            elif e.code == 401:
-                raise GCMAuthenticationException("Authentication error (401)")
-            elif e.code == 503 or e.code == 500:
-                raise GCMUnavailableException("Unavailable (%d)" % e.code)
-            else:
-                raise GCMConnectionException("Http error connecting to GCM: %s" % smart_str(e))
+            response = self._limited_send(data, headers, is_json)
+        except (GCMRetriableException, GCMAuthenticationException):
+            breaker.record_failure()
+            raise
+        except Exception:
+            # GCM answered, even if it did not like the request
+            breaker.record_success()
+            raise
+        breaker.record_success()
+        return response
+
+    def _limited_send(self, data, headers, is_json):
+        limiter = self.limiter
+        if limiter is None:
+            return self._send(data, headers, is_json)
+        limiter.acquire()
+        try:
+            return self._send(data, headers, is_json)
+        finally:
+            limiter.release()
+
+    def _send(self, data, headers, is_json):
+        listener = self.listener
+        if listener is None:
+            status, response_headers, response = self._post(data, headers)
+            self._raise_for_status(status, response_headers)
+            return response
+
+        listener.request_start(is_json, len(data))
+        start = time.time()
+        status = None
+        try:
+            status, response_headers, response = self._post(data, headers)
+            self._raise_for_status(status, response_headers)
+        except Exception as e:
+            listener.request_end(is_json, status, time.time() - start, e)
+            raise
+        listener.request_end(is_json, status, time.time() - start, None)
+        return response
+
+    def _post(self, data, headers):
+        try:
+            return self.pool.request(data, headers)
         except IOError as e:
             raise GCMConnectionException("IOError attempting GCM push: %s" % smart_str(e))
-
         except Exception as e:
             raise GCMConnectionException("Error attempting GCM push: %s" % smart_str(e))
 
-        return response
+    def _raise_for_status(self, status, response_headers):
+        if status == 400:
+            raise GCMMalformedJsonException("JSON could not be parsed (400)")
+        elif status == 401:
+            raise GCMAuthenticationException("Authentication error (401)")
+        elif status == 503 or status == 500:
+            e = GCMUnavailableException("Unavailable (%d)" % status)
+            e.retry_after = parse_retry_after(response_headers.get('retry-after'))
+            raise e
+        elif status != 200:
+            raise GCMConnectionException("Http error connecting to GCM: HTTP Error %d" % status)
+
+    def wrap_response(self, response, reg_ids=None):
+        """
+        Parse a JSON multicast response, reporting its outcome counts to the listener and, given the
+        reg_ids it answers, its canonical and dead ids to the registration store.
+        @return GCM_response_wrapper
+        """
+        wrapper = GCM_response_wrapper(response, self.json_codec)
+        if self.listener is not None:
+            self.listener.results(wrapper.counts())
+        if self.registration_store is not None and reg_ids:
+            self.registration_store.update(wrapper, reg_ids)
+        return wrapper
+
+    def filter_ids(self, registration_ids, data=None, collapse_key=None, result=None, lookup=True):
+        """
+        :param data: the message (dict or PayloadTemplate) to be sent, for the deduplicator
+        :param result: GCM_bulk_result to fold the ids left out into, under the ids given: UNREGISTER for
+                       ids the registration store knows are dead, DUPLICATE for those the deduplicator
+                       leaves out. The ids the store rewrites are noted in it, so that their outcomes are
+                       reported under the ids given too.
+        :param lookup: False if registration_ids were already looked up in the registration store
+        @return iterator over registration_ids as rewritten by the registration store, if there is one,
+                less those the deduplicator says were sent data recently
+        """
+        store = self.registration_store if lookup else None
+        dedup = self.deduplicator if data is not None else None
+        if store is None and dedup is None:
+            return iter(registration_ids)
+        message = dedup.message(data, collapse_key) if dedup is not None else None
+        return self._filter_ids(registration_ids, store, dedup, message, result)
+
+    def _filter_ids(self, registration_ids, store, dedup, message, result):
+        for reg_id in registration_ids:
+            sent_id = reg_id
+            if store is not None:
+                sent_id = store.lookup(reg_id)
+                if sent_id is None:
+                    if result is not None:
+                        result.add_outcomes([(reg_id, GCM_response_wrapper.UNREGISTER, 'NotRegistered')])
+                    continue
+            if dedup is not None and not dedup.check(sent_id, message):
+                if result is not None:
+                    result.add_outcomes([(reg_id, GCM_response_wrapper.DUPLICATE, None)])
+                continue
+            if sent_id != reg_id and result is not None:
+                result.add_rewritten(reg_id, sent_id)
+            yield sent_id
+
+    def forget_sent(self, registration_ids, data, collapse_key=None):
+        """
+        let the deduplicator pass registration_ids for data again, as they were not delivered after all,
+        e.g. the resend_ids of a send
+        """
+        if self.deduplicator is not None and registration_ids:
+            self.deduplicator.forget(registration_ids, data, collapse_key)
 
     def raise_error(self, error):
         if error == 'InvalidRegistration':
@@ -161,6 +341,33 @@ class GCM(object):
         else:
             return []
 
+    def _record_plaintext_response(self, response, registration_id, send_to):
+        """
+        handle_plaintext_response, teaching the registration store the outcome.
+        @return the canonical id, also when it came from the store rather than from GCM
+        """
+        store = self.registration_store
+        try:
+            canonical_id = self.handle_plaintext_response(response)
+        except (GCMNotRegisteredException, GCMInvalidRegistrationException):
+            store.record_unregistered(registration_id)
+            raise
+        if canonical_id:
+            store.record_canonical(registration_id, canonical_id)
+            return canonical_id
+        if send_to != registration_id:
+            return send_to
+
+    def backoff_delays(self):
+        """
+        jittered exponential backoff: yields the secs to wait before each retry, starting
+        around BACKOFF_INITIAL_DELAY_MS and doubling up to MAX_BACKOFF_DELAY_MS.
+        """
+        backoff = self.BACKOFF_INITIAL_DELAY_MS
+        while True:
+            yield float(backoff / 2 + random.randrange(backoff)) / 1000
+            backoff = min(2 * backoff, self.MAX_BACKOFF_DELAY_MS)
+
     def request_plaintext(self, registration_id, data=None, collapse_key=None,
                             delay_while_idle=False, time_to_live=None, tries=5):
         """
@@ -180,24 +387,31 @@ class GCM(object):
         if tries == 0:
             raise GCMException('number of tries 0: why did you call this?')
 
+        store = self.registration_store
+        send_to = registration_id
+        if store is not None:
+            send_to = store.lookup(registration_id)
+            if send_to is None:
+                raise GCMNotRegisteredException("Registration id is not valid anymore")
+
         payload = self.construct_payload(
-            registration_id, data, collapse_key,
+            send_to, data, collapse_key,
             delay_while_idle, time_to_live, False
         )
 
         attempt = 0
-        backoff = self.BACKOFF_INITIAL_DELAY_MS
+        delays = self.backoff_delays()
         for attempt in range(tries):
             try:
                 response = self.make_request(payload, is_json=False)
-                return self.handle_plaintext_response(response)
+                if store is None:
+                    return self.handle_plaintext_response(response)
+                return self._record_plaintext_response(response, registration_id, send_to)
             except GCMUnavailableException:
-                sleep_time = backoff / 2 + random.randrange(backoff)
-                time.sleep(float(sleep_time) / 1000)
-                if 2 * backoff < self.MAX_BACKOFF_DELAY_MS:
-                    backoff *= 2
-                else:
-                    backoff = self.MAX_BACKOFF_DELAY_MS
+                delay = next(delays)
+                if self.listener is not None:
+                    self.listener.retry_scheduled(delay, 1)
+                time.sleep(delay)
 
         raise IOError("Failed to make GCM request after %d attempts" % attempt)
 
@@ -209,23 +423,219 @@ class GCM(object):
 
         :param time_to_live secs
         :param registration_ids: list of the registration ids
-        :param data: dict mapping of key-value pairs of messages
+        :param data: dict mapping of key-value pairs of messages, or a PayloadTemplate
         :return custom response object that includes lists of successes, retry failures, canonical_ids, etc
         :raises GCMMissingRegistrationException: if the list of registration_ids exceeds 1000 items
         """
         if not registration_ids:
             raise GCMMissingRegistrationException("Missing registration_ids")
-        if len(registration_ids) > 1000:
+        if len(registration_ids) > self.MAX_REGISTRATION_IDS:
             raise GCMTooManyRegIdsException("Exceeded number of registration_ids")
+
+        payload = self.payload_template(data, collapse_key, delay_while_idle, time_to_live).encode(registration_ids)
+        response = self.make_request(payload, is_json=True)
+        return self.wrap_response(response, registration_ids)
+
+    def payload_template(self, data=None, collapse_key=None, delay_while_idle=False, time_to_live=None):
+        """
+        @return data itself if it is already a PayloadTemplate, else a new one from these options
+        :raises GCMException: if there is no data to send
+        """
+        if isinstance(data, PayloadTemplate):
+            return data
         if not data or len(data) == 0:
             raise GCMException('no data to send')
+        return PayloadTemplate(data, collapse_key, delay_while_idle, time_to_live, codec=self.json_codec)
+
+    def bulk_payloads(self, registration_ids, template, result=None):
+        """
+        Lazily cut registration_ids into batches of MAX_REGISTRATION_IDS and encode each with template.
+        Dead ids known to the registration store are dropped and stale ones rewritten, and repeats
+        are dropped by the deduplicator.
+
+        :param result: GCM_bulk_result to report the dead ids and repeats to, under the ids given
+        @return generator of (batch list of the ids sent, JSON payload)
+        """
+        ids = self.filter_ids(registration_ids, template, result=result)
+        while True:
+            batch = list(islice(ids, self.MAX_REGISTRATION_IDS))
+            if not batch:
+                return
+            yield batch, template.encode(batch)
+
+    def send_bulk(self, registration_ids, data=None, collapse_key=None,
+                    delay_while_idle=False, time_to_live=None):
+        """
+        Multicast one message to any number of devices. The ids are consumed lazily and sent
+        in batches of MAX_REGISTRATION_IDS; the shared part of the payload is encoded only once.
+        Batches failing with a GCMRetriableException are reported as resends.
+
+        :param registration_ids: iterable of registration ids, e.g. a generator over millions of rows
+        :param data: dict mapping of key-value pairs of messages, or a PayloadTemplate
+        :return GCM_bulk_result merged over all batches
+        :raises GCMMissingRegistrationException: if registration_ids is empty
+        :raises GCMNoRetryException: on fatal errors such as authentication failure
+        """
+        template = self.payload_template(data, collapse_key, delay_while_idle, time_to_live)
+        registration_ids = require_ids(registration_ids)
+
+        result = GCM_bulk_result()
+        for batch, payload in self.bulk_payloads(registration_ids, template, result):
+            try:
+                response = self.wrap_response(self.make_request(payload, is_json=True), batch)
+            except GCMRetriableException:
+                result.add_unsent(batch)
+                # so that they can be sent again
+                self.forget_sent(batch, template)
+            else:
+                result.add_response(response, batch)
+                self.forget_sent(response.get_resend_ids(batch), template)
+        return result
+
+
+def require_ids(registration_ids):
+    """
+    @return an iterator over registration_ids, which may be a generator
+    :raises GCMMissingRegistrationException: if there are none
+    """
+    ids = iter(registration_ids)
+    try:
+        first = next(ids)
+    except StopIteration:
+        raise GCMMissingRegistrationException("Missing registration_ids")
+    return chain([first], ids)
+
+
+def validate_options(collapse_key=None, time_to_live=None):
+    """
+    :raises GCMInvalidTtlException: if time_to_live is invalid
+    :raises GCMNoCollapseKeyException: if collapse_key is missing when time_to_live is used
+    """
+    if time_to_live:
+        if time_to_live > 2419200 or time_to_live < 0:
+            raise GCMInvalidTtlException("Invalid time to live value")
+        if collapse_key is None:
+            raise GCMNoCollapseKeyException("collapse_key is required when time_to_live is provided")
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def smart_str(value):
+    """
+    value as a UTF-8 byte string, for error messages; a stdlib stand-in for django's smart_str,
+    so that importing gcm does not import django.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    try:
+        return str(value)
+    except UnicodeEncodeError:
+        if isinstance(value, Exception):
+            # an exception whose args are unicode: format each one on its own
+            return ' '.join(smart_str(arg) for arg in value.args)
+        return unicode(value).encode('utf-8')
+
+
+def data_key_sizes(data):
+    """
+    approximate encoded bytes contributed by each key of data, to find what makes a message too big.
+    @return list( (key, bytes) ), biggest first
+    """
+    sizes = [(k, len(_utf8(json.dumps({k: v}, ensure_ascii=False))) - 2) for k, v in data.items()]
+    sizes.sort(key=lambda item: item[1], reverse=True)
+    return sizes
+
+
+def check_data_size(size, data, limit=MAX_DATA_BYTES):
+    """
+    :param size: encoded size of data in bytes, as already measured by the caller
+    :raises GCMMessageTooBigException: if size is over limit, listing the biggest keys
+    """
+    if size <= limit:
+        return
+    key_sizes = data_key_sizes(data)
+    e = GCMMessageTooBigException("Message data is %d bytes, over the %d byte limit; biggest keys: %s" % (
+        size, limit, ', '.join('%s (%d)' % (_utf8(k), n) for k, n in key_sizes[:3])))
+    e.key_sizes = key_sizes
+    raise e
+
+
+def _options_dict(collapse_key=None, delay_while_idle=False, time_to_live=None):
+    options = {}
+    if delay_while_idle:
+        options['delay_while_idle'] = delay_while_idle
+    if time_to_live:
+        options['time_to_live'] = time_to_live
+    if collapse_key:
+        options['collapse_key'] = collapse_key
+    return options
+
+
+class PayloadTemplate(object):
+    """
+    A JSON multicast message validated and encoded once, for sending to many batches of ids:
+    data, collapse_key, delay_while_idle and time_to_live are pre-encoded, and encode() only
+    splices the registration_ids array in front of them. data_size is the encoded size of data.
+
+    template = PayloadTemplate(data, collapse_key='news', time_to_live=3600)
+    gcm.send_bulk(reg_ids, template)
+
+    codec is the jsoncodec.JSONCodec to encode with, by default the fastest installed.
+
+    :raises GCMMessageTooBigException: if data encodes to more than max_data_bytes
+    :raises GCMInvalidTtlException: if time_to_live is invalid
+    :raises GCMNoCollapseKeyException: if collapse_key is missing when time_to_live is used
+    """
+    def __init__(self, data=None, collapse_key=None, delay_while_idle=False, time_to_live=None,
+                 max_data_bytes=MAX_DATA_BYTES, codec=None):
+        validate_options(collapse_key, time_to_live)
+        self.codec = codec = codec or default_codec()
+        self.data = data
+        self.collapse_key = collapse_key
+        self.delay_while_idle = delay_while_idle
+        self.time_to_live = time_to_live
+
+        # encode data once, as UTF-8, both to measure it and to send it
+        fields = ['%s: %s' % (codec.dumps(k), codec.dumps(v))
+                  for k, v in _options_dict(collapse_key, delay_while_idle, time_to_live).items()]
+        self.data_size = 0
+        if data:
+            encoded = _utf8(codec.dumps(data, ensure_ascii=False))
+            self.data_size = len(encoded)
+            check_data_size(self.data_size, data, max_data_bytes)
+            fields.append('"data": ' + encoded)
+        self.suffix = ''.join(', ' + field for field in fields) + '}'
+
+    def encode(self, registration_ids):
+        """
+        @return the JSON payload for this batch of registration ids
+        """
+        return '{"registration_ids": ' + self.codec.dumps(registration_ids) + self.suffix
+
+
+# GCM error codes seen so far; responses keep an index into this table per failed result line
+# instead of a string, so each code is stored once however many responses carry it
+_error_codes = [None]
+_error_index = {None: 0}
+_error_lock = threading.Lock()
+
+
+def _intern_error(error):
+    index = _error_index.get(error)
+    if index is None:
+        with _error_lock:
+            index = _error_index.get(error)
+            if index is None:
+                _error_codes.append(error)
+                index = _error_index[error] = len(_error_codes) - 1
+    return index
 
-        payload = self.construct_payload(
-            registration_ids, data, collapse_key,
-            delay_while_idle, time_to_live
-        )
-        response = self.make_request(payload, is_json=True)
-        return GCM_response_wrapper(response)
 
 class GCM_response_wrapper(object):
     """
@@ -234,21 +644,106 @@ class GCM_response_wrapper(object):
         * unregister any dead IDs from get_unregister_errors
         * reset any replacement IDs returned from get_canonical_ids()
         * resend messages that could not be sent (after exponential backoff time) from get_resend_ids()
+
+    The results are classified in a single pass when the response is parsed, into one status code
+    and an index into a table of error codes per result line, and the line numbers of each status;
+    the parsed JSON is then dropped. The getters only map those line numbers back onto the reg_ids
+    you sent, so each costs as much as the ids it returns.
     """
-    def __init__(self, json_response):
-        self.my_json = json.loads(json_response)
+    # statuses yielded by outcomes()
+    SUCCESS = 'success'
+    CANONICAL = 'canonical'
+    UNREGISTER = 'unregister'
+    RESEND = 'resend'
+    ERROR = 'error'
+
+    # status code of a result line => status
+    STATUSES = (SUCCESS, CANONICAL, UNREGISTER, RESEND, ERROR)
+
+    # not a result line: the id was left out by the gcm's deduplicator
+    DUPLICATE = 'duplicate'
+
+    UNREGISTER_ERRORS = frozenset(['NotRegistered', 'InvalidRegistration'])
+
+    __slots__ = ('multicast_id', 'num_success', 'num_failure', 'num_canonical',
+                 '_statuses', '_errors', '_lines', '_delivered', '_canonical_ids', '_warned')
+
+    def __init__(self, json_response, codec=None):
+        """
+        :param json_response: the response body, as read from the socket
+        :param codec: jsoncodec.JSONCodec to decode with, by default the fastest installed
+        """
+        response = (codec or default_codec()).loads(json_response)
+        self.multicast_id = response.get('multicast_id')
+        self.num_success = response['success']
+        self.num_failure = response['failure']
+        self.num_canonical = response['canonical_ids']
+        self._warned = False
+        self._classify(response.get('results', ()))
+
+    def _classify(self, results):
+        self._statuses = statuses = array('b')
+        self._errors = errors = array('H')
+        self._lines = lines = tuple(array('H') for status in self.STATUSES)  # status code => line numbers
+        self._delivered = delivered = array('H')  # line numbers of status 0 or 1
+        self._canonical_ids = canonical_ids = {}  # line number => canonical id
+        for i, item in enumerate(results):
+            error = None
+            if 'message_id' in item:
+                if 'registration_id' in item:
+                    status = 1
+                    canonical_ids[i] = item['registration_id']
+                else:
+                    status = 0
+            else:
+                error = item.get('error')
+                if error == 'Unavailable':
+                    status = 3
+                elif error in self.UNREGISTER_ERRORS:
+                    status = 2
+                else:
+                    status = 4
+            statuses.append(status)
+            errors.append(_intern_error(error))
+            lines[status].append(i)
+            if status < 2:
+                delivered.append(i)
 
     def has_error(self):
-        return self.my_json['failure'] > 0
+        return self.num_failure > 0
 
     def has_canonical(self):
-        return self.my_json['canonical_ids'] > 0
+        return self.num_canonical > 0
 
     def has_success(self):
-        return self.my_json['success'] > 0
+        return self.num_success > 0
 
     def has_resends(self):
-        return self.has_error() and len(self._get_resends()) > 0
+        return len(self._lines[3]) > 0
+
+    def _num_usable(self, reg_ids):
+        """
+        number of leading result lines that can be matched to reg_ids; logs a length mismatch once.
+        """
+        num_incoming = len(reg_ids)
+        num_results = len(self._statuses)
+        if num_incoming != num_results and not self._warned:
+            self._warned = True
+            log.warning('expected number of incoming reg_ids: %i to equal number of results: %i',
+                        num_incoming, num_results)
+        return min(num_incoming, num_results)
+
+    def _usable_lines(self, reg_ids, lines):
+        """
+        the line numbers of lines that can be matched to reg_ids
+        """
+        limit = self._num_usable(reg_ids)
+        if limit < len(self._statuses):
+            return lines[:bisect_left(lines, limit)]
+        return lines
+
+    def _select(self, reg_ids, lines):
+        return [reg_ids[i] for i in self._usable_lines(reg_ids, lines)]
 
     def get_successes(self, reg_ids):
         """
@@ -258,22 +753,7 @@ class GCM_response_wrapper(object):
             return []
         if not self.has_success():
             return []
-
-        num_incoming = len(reg_ids)
-        num_results = len(self.my_json['results'])
-        if num_incoming != num_results:
-          print('expected number of incoming reg_ids: %i to equal number of results: %i' % (num_incoming, num_results))
-
-        successes = []
-        i = 0
-        for item in self.my_json['results']:
-            if item.has_key('message_id'):
-                if i < num_incoming:
-                    successes.append(reg_ids[i])
-                else:
-                    break
-            i += 1
-        return successes
+        return self._select(reg_ids, self._delivered)
 
     def get_unregister_errors(self, reg_ids):
         """
@@ -284,22 +764,7 @@ class GCM_response_wrapper(object):
             return []
         if not self.has_error():
             return []
-
-        num_incoming = len(reg_ids)
-        num_results = len(self.my_json['results'])
-        if num_incoming != num_results:
-          print('expected number of incoming reg_ids: %i to equal number of results: %i' % (num_incoming, num_results))
-
-        errors = []
-        i = 0
-        for item in self.my_json['results']:
-            if item.has_key('error') and (item['error'] == 'NotRegistered' or item['error'] == 'InvalidRegistration'):
-                if i < num_incoming:
-                    errors.append(reg_ids[i])
-                else:
-                    break
-            i += 1
-        return errors
+        return self._select(reg_ids, self._lines[2])
 
     def _get_resends(self):
         """
@@ -308,14 +773,7 @@ class GCM_response_wrapper(object):
         """
         if not self.has_error():
             return []
-
-        errors = []
-        i = 0
-        for item in self.my_json['results']:
-            if item.has_key('error') and item['error'] == 'Unavailable':
-                errors.append((i, item['error']))
-            i += 1
-        return errors
+        return [(i, 'Unavailable') for i in self._lines[3]]
 
     def get_resend_ids(self, reg_ids):
         """
@@ -324,19 +782,9 @@ class GCM_response_wrapper(object):
         """
         if not reg_ids or len(reg_ids) == 0:
             return []
-        num_incoming = len(reg_ids)
-        num_results = len(self.my_json['results'])
-        if num_incoming != num_results:
-            print('expected number of incoming reg_ids: %i to equal number of results: %i' % (num_incoming, num_results))
-
-        resends = self._get_resends()
-        ids = []
-        for (line_num, err) in resends:
-            if line_num < num_incoming:
-                ids.append(reg_ids[line_num])
-            else:
-                break
-        return ids
+        if not self.has_error():
+            return []
+        return self._select(reg_ids, self._lines[3])
 
     def get_canonical_ids(self, reg_ids):
         """
@@ -347,19 +795,136 @@ class GCM_response_wrapper(object):
             return []
         if not self.has_canonical():
             return []
+        canonical_ids = self._canonical_ids
+        return [(reg_ids[i], canonical_ids[i]) for i in self._usable_lines(reg_ids, self._lines[1])]
 
-        num_incoming = len(reg_ids)
-        num_results = len(self.my_json['results'])
-        if num_incoming != num_results:
-            print('expected number of incoming reg_ids: %i to equal number of results: %i' % (num_incoming, num_results))
-
-        canonical = []
-        i = 0
-        for item in self.my_json['results']:
-            if item.has_key('registration_id'):
-                if i < num_incoming:
-                    canonical.append((reg_ids[i], item['registration_id']))
-                else:
-                    break
-            i += 1
-        return canonical
+    def counts(self):
+        """
+        @return dict( status: number of results ), statuses as in outcomes(); canonical ids are
+                counted under CANONICAL rather than SUCCESS
+        """
+        return dict((status, len(self._lines[code])) for code, status in enumerate(self.STATUSES))
+
+    def outcomes(self, reg_ids):
+        """
+        one entry per reg_id, in the order sent. extra is the canonical id for CANONICAL,
+        and the GCM error code for UNREGISTER, RESEND and ERROR.
+        @return iterator of (reg_id, status, extra)
+        """
+        if not reg_ids or len(reg_ids) == 0:
+            return
+        limit = self._num_usable(reg_ids)
+        for i in xrange(limit):
+            status = self._statuses[i]
+            extra = self._canonical_ids[i] if status == 1 else _error_codes[self._errors[i]]
+            yield reg_ids[i], self.STATUSES[status], extra
+
+
+class GCM_bulk_result(object):
+    """
+    merged outcome of every batch sent by GCM.send_bulk. Each batch response is folded in
+    and dropped, so only the per-id lists below are kept:
+        * successes: ids that were delivered
+        * canonical_ids: list( (old_id, canonical_id) ) to reset in your database
+        * unregister_errors: dead ids to remove
+        * resend_ids: ids to retry later, either Unavailable or in a batch that failed outright
+        * duplicates: ids not sent as the deduplicator saw them sent the same message recently
+
+    Ids are those given to the send: an id the registration store rewrote is reported under the id
+    given, as CANONICAL (given id, id sent) once delivered.
+    """
+    def __init__(self):
+        self.num_batches = 0
+        self.successes = []
+        self.canonical_ids = []
+        self.unregister_errors = []
+        self.resend_ids = []
+        self.duplicates = []
+        self._rewritten = {}  # id sent => ids given that the registration store rewrote to it, in order
+
+    def add_rewritten(self, reg_id, sent_id):
+        """
+        reg_id is sent as sent_id, its canonical id in the registration store
+        """
+        self._rewritten.setdefault(sent_id, []).append(reg_id)
+
+    def _given_id(self, sent_id):
+        given = self._rewritten.get(sent_id)
+        if not given:
+            return sent_id
+        reg_id = given.pop(0)
+        if not given:
+            del self._rewritten[sent_id]
+        return reg_id
+
+    def given_ids(self, sent_ids):
+        """
+        @return sent_ids, each mapped back to the id given if the registration store rewrote it; for
+                ids with a final outcome, as each is mapped back only once
+        """
+        if not self._rewritten:
+            return sent_ids
+        return [self._given_id(sent_id) for sent_id in sent_ids]
+
+    def response_outcomes(self, response, reg_ids, resends=True):
+        """
+        response.outcomes(reg_ids) under the ids given; a delivery to a rewritten id is CANONICAL
+        :param resends: False to leave out RESEND outcomes
+        @return iterator of (reg_id, status, extra)
+        """
+        outcomes = response.outcomes(reg_ids)
+        if not resends:
+            outcomes = (outcome for outcome in outcomes if outcome[1] != GCM_response_wrapper.RESEND)
+        if self._rewritten:
+            outcomes = self._restore(outcomes)
+        return outcomes
+
+    def _restore(self, outcomes):
+        for sent_id, status, extra in outcomes:
+            reg_id = self._given_id(sent_id)
+            if reg_id != sent_id and status == GCM_response_wrapper.SUCCESS:
+                yield reg_id, GCM_response_wrapper.CANONICAL, sent_id
+            else:
+                yield reg_id, status, extra
+
+    def add_response(self, response, reg_ids, resends=True):
+        """
+        :param resends: False if the caller deals with the Unavailable ids itself
+        """
+        self.num_batches += 1
+        if self._rewritten:
+            self.add_outcomes(self.response_outcomes(response, reg_ids, resends))
+            return
+        self.successes.extend(response.get_successes(reg_ids))
+        self.canonical_ids.extend(response.get_canonical_ids(reg_ids))
+        self.unregister_errors.extend(response.get_unregister_errors(reg_ids))
+        if resends:
+            self.add_resends(response.get_resend_ids(reg_ids))
+
+    def add_unsent(self, reg_ids):
+        self.num_batches += 1
+        self.add_resends(self.given_ids(reg_ids))
+
+    def add_resends(self, reg_ids):
+        self.resend_ids.extend(reg_ids)
+
+    def add_outcomes(self, outcomes):
+        """
+        fold in (reg_id, status, extra) triples as yielded by GCM_response_wrapper.outcomes(), or
+        with status DUPLICATE
+        """
+        for reg_id, status, extra in outcomes:
+            if status == GCM_response_wrapper.SUCCESS:
+                self.successes.append(reg_id)
+            elif status == GCM_response_wrapper.CANONICAL:
+                self.successes.append(reg_id)
+                self.canonical_ids.append((reg_id, extra))
+            elif status == GCM_response_wrapper.UNREGISTER:
+                self.unregister_errors.append(reg_id)
+            elif status == GCM_response_wrapper.RESEND:
+                self.resend_ids.append(reg_id)
+            elif status == GCM_response_wrapper.DUPLICATE:
+                self.duplicates.append(reg_id)
+
+    def has_resends(self):
+        return len(self.resend_ids) > 0
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from itertools import islice
+
+from gcm import GCM_bulk_result, GCM_response_wrapper, GCMMessageTooBigException, PayloadTemplate, \
+    validate_options
+from dedup import payload_key
+from dispatch import BoundedExecutor
+from retry import MulticastRetrier
+
+
+class _Group(object):
+    def __init__(self, data):
+        self.data = data
+        self.positions = OrderedDict()  # id to send to => positions in the window of its records
+        self.rewritten = set()          # positions whose id the registration store rewrote
+
+
+class _GroupOutcomes(GCM_bulk_result):
+    """
+    routes the outcome of each id in a group to the records sent to it
+    """
+    def __init__(self, group, outcomes):
+        GCM_bulk_result.__init__(self)
+        self.group = group
+        self.outcomes = outcomes
+
+    def add_response(self, response, reg_ids, resends=True):
+        self.num_batches += 1
+        self.add_outcomes(self.response_outcomes(response, reg_ids, resends))
+
+    def add_outcomes(self, outcomes):
+        for reg_id, status, extra in outcomes:
+            for pos in self.group.positions.get(reg_id, ()):
+                if status == GCM_response_wrapper.SUCCESS and pos in self.group.rewritten:
+                    # delivered to the id the store rewrote the record's to
+                    self.outcomes[pos] = (GCM_response_wrapper.CANONICAL, reg_id)
+                else:
+                    self.outcomes[pos] = (status, extra)
+
+    def add_resends(self, reg_ids):
+        self.add_outcomes((reg_id, GCM_response_wrapper.RESEND, 'Unavailable') for reg_id in reg_ids)
+
+
+class PayloadGrouper(object):
+    """
+    Sends personalized messages, one data dict per recipient, with as few requests as possible:
+    records whose data is identical (by payload_key) are grouped and multicast to up to 1000 ids
+    per request, and the rest go out as single-recipient sends. Groups are sent concurrently, each
+    with the retries of a MulticastRetrier.
+
+    Records are read window at a time, so memory is bounded however many there are; identical
+    payloads further apart than that are sent in separate multicasts.
+
+    grouper = PayloadGrouper(GCM(API_KEY, pool_size=8), max_workers=8)
+    for user, status, extra in grouper.send(users, split=lambda user: (user.reg_id, {'unread': str(user.unread)})):
+        ...
+
+    num_multicasts counts the groups multicast, num_singles the ids sent to one at a time.
+    """
+    def __init__(self, gcm, max_workers=4, max_attempts=5, window=100000, min_group_size=2):
+        self.gcm = gcm
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.window = window
+        self.min_group_size = min_group_size
+        self.num_multicasts = 0
+        self.num_singles = 0
+
+    def send(self, records, collapse_key=None, delay_while_idle=False, time_to_live=None, split=None):
+        """
+        :param records: iterable of (registration_id, data) pairs, or of any records that split
+                        turns into such pairs
+        @return generator of (record, status, extra) in the order of records, with the statuses and
+                extras of GCM_response_wrapper.outcomes(); RESEND for ids still Unavailable when
+                retries ran out, DUPLICATE for records the gcm's deduplicator left out, UNREGISTER
+                for ids the registration store knows are dead, and CANONICAL for ids it rewrote
+        :raises GCMNoRetryException: on fatal errors such as authentication failure
+        """
+        validate_options(collapse_key, time_to_live)
+        options = (collapse_key, delay_while_idle, time_to_live)
+        records = iter(records)
+        while True:
+            window = list(islice(records, self.window))
+            if not window:
+                return
+            outcomes = self._send_window([split(record) if split else record for record in window], options)
+            for record, (status, extra) in zip(window, outcomes):
+                yield record, status, extra
+
+    def _send_window(self, pairs, options):
+        outcomes = [None] * len(pairs)
+        store = self.gcm.registration_store
+        groups = {}
+        for pos, (reg_id, data) in enumerate(pairs):
+            sent_id = reg_id
+            if store is not None:
+                sent_id = store.lookup(reg_id)
+                if sent_id is None:
+                    outcomes[pos] = (GCM_response_wrapper.UNREGISTER, 'NotRegistered')
+                    continue
+            key = payload_key(data)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = _Group(data)
+            group.positions.setdefault(sent_id, []).append(pos)
+            if sent_id != reg_id:
+                group.rewritten.add(pos)
+
+        for group in groups.values():
+            if len(group.positions) >= self.min_group_size:
+                self.num_multicasts += 1
+            else:
+                self.num_singles += len(group.positions)
+
+        executor = BoundedExecutor(self.max_workers, max_pending=0)
+        try:
+            futures = [executor.submit(self._send_group, group, outcomes, options) for group in groups.values()]
+            for future in futures:
+                future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_pending=True)
+        return outcomes
+
+    def _send_group(self, group, outcomes, options):
+        try:
+            template = PayloadTemplate(group.data, *options, codec=self.gcm.json_codec)
+        except GCMMessageTooBigException:
+            for positions in group.positions.values():
+                for pos in positions:
+                    outcomes[pos] = (GCM_response_wrapper.ERROR, 'MessageTooBig')
+            return
+        if len(group.positions) < self.min_group_size:
+            # too few to be worth a multicast: one request per recipient
+            for reg_id in group.positions:
+                self._send_ids(group, [reg_id], template, outcomes)
+        else:
+            self._send_ids(group, list(group.positions), template, outcomes)
+
+    def _send_ids(self, group, reg_ids, template, outcomes):
+        # looked up in _send_window already: the outcomes must come back under these ids
+        retrier = MulticastRetrier(self.gcm, self.max_attempts)
+        retrier.send(reg_ids, template, result=_GroupOutcomes(group, outcomes), lookup=False)
+        for reg_id in reg_ids:
+            for pos in group.positions[reg_id]:
+                if outcomes[pos] is None:
+                    # GCM answered with fewer results than ids
+                    outcomes[pos] = (GCM_response_wrapper.ERROR, 'MissingResult')
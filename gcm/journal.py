@@ -0,0 +1,148 @@
+import os
+import time
+from collections import deque
+
+
+class SendJournal(object):
+    """
+    Durable progress of a campaign over a list of registration ids that is read in the same
+    order on every run (a file, a sorted query), so a crashed campaign resumes where it stopped
+    instead of notifying everybody twice.
+
+    Ids are known by their position in the input. The journal is an append-only text file of:
+
+        W <pos>          every id before pos has a final outcome (the watermark)
+        A <pos>          the id at pos has a final outcome (delivered, canonical, dead or a fatal error)
+        F <pos> <id>     the id at pos was still Unavailable when retries ran out
+
+    Writes are buffered and fsynced every sync_every records or sync_interval secs, whichever
+    comes first; a crash loses at most that window, whose ids are sent again on resume.
+
+    journal = SendJournal('campaign.journal')
+    send_stream(gcm, open_registration_ids(path), 'results/', data, journal=journal)
+
+    :param path: journal file; an existing one is loaded and compacted
+    """
+    def __init__(self, path, sync_every=1000, sync_interval=1.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.watermark = 0
+        self._acked = set()      # positions at or past the watermark with a final outcome
+        self._failed = {}        # position => id given up on, re-queued by resume()
+        self._outstanding = {}   # id => deque of positions sent and awaiting an outcome
+        self._unsynced = 0
+        self._synced_at = time.time()
+        self._load()
+        self._compact()
+        self._file = open(path, 'a')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # torn last line after a crash
+                fields = line.rstrip('\n').split('\t')
+                kind, pos = fields[0], int(fields[1])
+                if kind == 'W':
+                    self.watermark = max(self.watermark, pos)
+                    self._acked = set(p for p in self._acked if p >= self.watermark)
+                elif kind == 'A':
+                    self._failed.pop(pos, None)
+                    if pos >= self.watermark:
+                        self._acked.add(pos)
+                elif kind == 'F':
+                    # re-queued from _failed, not sent again in its place as well
+                    self._failed[pos] = fields[2]
+                    if pos >= self.watermark:
+                        self._acked.add(pos)
+
+    def _compact(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('W\t%d\n' % self.watermark)
+            for pos in sorted(self._acked):
+                f.write('A\t%d\n' % pos)
+            for pos, reg_id in sorted(self._failed.items()):
+                f.write('F\t%d\t%s\n' % (pos, reg_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+    def resume(self, registration_ids):
+        """
+        @return generator over what is left to send: first the ids given up on by earlier runs,
+                then the ids of registration_ids without a final outcome yet. Outcomes for these
+                ids must be reported with acknowledge() or give_up(), under the ids yielded.
+        """
+        failed, self._failed = self._failed, {}
+        for pos, reg_id in sorted(failed.items()):
+            yield self._track(reg_id, pos)
+        for pos, reg_id in enumerate(registration_ids):
+            if pos < self.watermark or pos in self._acked:
+                continue
+            yield self._track(reg_id, pos)
+
+    def _track(self, reg_id, pos):
+        self._outstanding.setdefault(reg_id, deque()).append(pos)
+        return reg_id
+
+    def _position(self, reg_id):
+        positions = self._outstanding.get(reg_id)
+        if not positions:
+            return None
+        pos = positions.popleft()
+        if not positions:
+            del self._outstanding[reg_id]
+        return pos
+
+    def _resolve(self, pos):
+        if pos < self.watermark:
+            return
+        self._acked.add(pos)
+        while self.watermark in self._acked:
+            self._acked.discard(self.watermark)
+            self.watermark += 1
+
+    def acknowledge(self, reg_id):
+        """
+        reg_id, as resumed, has a final outcome: it is not sent again on resume
+        """
+        pos = self._position(reg_id)
+        if pos is not None:
+            self._resolve(pos)
+            self._record('A\t%d\n' % pos)
+
+    def give_up(self, reg_id):
+        """
+        reg_id, as resumed, is still Unavailable after the last attempt: resume sends it again
+        """
+        pos = self._position(reg_id)
+        if pos is not None:
+            self._resolve(pos)
+            self._failed[pos] = reg_id
+            self._record('F\t%d\t%s\n' % (pos, reg_id.encode('utf-8') if isinstance(reg_id, unicode) else reg_id))
+
+    def _record(self, line):
+        self._file.write(line)
+        self._unsynced += 1
+
+    def sync_due(self):
+        return self._unsynced >= self.sync_every or \
+            (self._unsynced and time.time() - self._synced_at >= self.sync_interval)
+
+    def sync(self):
+        """
+        write the watermark and fsync the journal
+        """
+        self._file.write('W\t%d\n' % self.watermark)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def close(self):
+        self.sync()
+        self._file.close()
@@ -0,0 +1,104 @@
+import json
+import os
+
+
+class JSONCodec(object):
+    """
+    Encodes payloads and decodes responses; this one with the stdlib json module. Subclasses wrap
+    faster libraries and raise ImportError from __init__ when theirs is not installed.
+    loads() takes the response body as the bytes read from the socket.
+    """
+    name = 'json'
+
+    def __reduce__(self):
+        # pickled by name, e.g. along with a PayloadTemplate sent to a worker process
+        return get_codec, (self.name,)
+
+    def dumps(self, obj, ensure_ascii=True):
+        return json.dumps(obj, ensure_ascii=ensure_ascii)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class UltraJSONCodec(JSONCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj, ensure_ascii=True):
+        return self._ujson.dumps(obj, ensure_ascii=ensure_ascii, escape_forward_slashes=False)
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+class SimpleJSONCodec(JSONCodec):
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self._simplejson = simplejson
+
+    def dumps(self, obj, ensure_ascii=True):
+        return self._simplejson.dumps(obj, ensure_ascii=ensure_ascii)
+
+    def loads(self, data):
+        return self._simplejson.loads(data)
+
+
+# in order of preference
+CODECS = (UltraJSONCodec, SimpleJSONCodec, JSONCodec)
+
+_default = None
+
+
+def get_codec(name=None):
+    """
+    :param name: 'ujson', 'simplejson' or 'json'; None for the fastest one installed, unless
+                 $GCM_JSON_CODEC names one
+    @return JSONCodec
+    :raises ImportError: if the named codec's library is not installed
+    """
+    name = name or os.environ.get('GCM_JSON_CODEC')
+    for cls in CODECS:
+        if name is None or cls.name == name:
+            try:
+                return cls()
+            except ImportError:
+                if name is not None:
+                    raise
+    raise ValueError('unknown JSON codec %r' % name)
+
+
+def available_codecs():
+    """
+    @return a JSONCodec for each library that is installed
+    """
+    codecs = []
+    for cls in CODECS:
+        try:
+            codecs.append(cls())
+        except ImportError:
+            pass
+    return codecs
+
+
+def default_codec():
+    """
+    @return the codec used when GCM(json_codec=...) is not given
+    """
+    global _default
+    if _default is None:
+        _default = get_codec()
+    return _default
+
+
+def set_default_codec(codec):
+    """
+    :param codec: JSONCodec, or the name of one
+    """
+    global _default
+    _default = get_codec(codec) if isinstance(codec, basestring) else codec
@@ -0,0 +1,180 @@
+import threading
+from bisect import bisect_left
+
+
+class SendListener(object):
+    """
+    Instrumentation hooks on the send path. Subclass and override what you need, then pass an
+    instance as GCM(api_key, listener=...). With no listener (the default) the hooks cost nothing.
+    Hooks may be called from several threads at once.
+    """
+    def request_start(self, is_json, num_bytes):
+        """
+        a request of num_bytes body bytes is about to be sent
+        """
+
+    def request_end(self, is_json, status, elapsed, error):
+        """
+        :param status: HTTP status, None if no response was received
+        :param elapsed: secs since request_start
+        :param error: the exception make_request is about to raise, or None
+        """
+
+    def retry_scheduled(self, delay, num_ids):
+        """
+        num_ids registration ids will be resent after delay secs
+        """
+
+    def results(self, counts):
+        """
+        :param counts: dict of outcome counts of one multicast response, keyed by the
+                       GCM_response_wrapper statuses (SUCCESS, CANONICAL, UNREGISTER, RESEND, ERROR)
+        """
+
+
+class CompositeListener(SendListener):
+    """
+    forwards every hook to several listeners, e.g. a metrics collector and a tracer.
+    """
+    def __init__(self, listeners):
+        self.listeners = list(listeners)
+
+    def request_start(self, is_json, num_bytes):
+        for listener in self.listeners:
+            listener.request_start(is_json, num_bytes)
+
+    def request_end(self, is_json, status, elapsed, error):
+        for listener in self.listeners:
+            listener.request_end(is_json, status, elapsed, error)
+
+    def retry_scheduled(self, delay, num_ids):
+        for listener in self.listeners:
+            listener.retry_scheduled(delay, num_ids)
+
+    def results(self, counts):
+        for listener in self.listeners:
+            listener.results(counts)
+
+
+class Histogram(object):
+    """
+    Fixed-bucket histogram; percentiles are reported as the upper bound of the bucket they fall in.
+    """
+    # secs, roughly doubling from 1ms to 2 minutes
+    DEFAULT_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 60, 120)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = list(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        add the values of other, a Histogram with the same bounds
+        """
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0.0
+        rank = self.count * pct / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+
+class MetricsCollector(SendListener):
+    """
+    In-memory counters and histograms, ready to export:
+
+        counters: requests, request_bytes, errors, status_<code>, retries, retried_ids,
+                  and result_<status> for each per-recipient outcome
+        histograms: request_latency (secs), request_bytes, retry_delay (secs)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {
+            'request_latency': Histogram(),
+            'request_bytes': Histogram((256, 1024, 4096, 16384, 65536, 262144, 1048576)),
+            'retry_delay': Histogram(),
+        }
+
+    def __getstate__(self):
+        # picklable, e.g. to send a worker process's metrics to its parent
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def merge(self, other):
+        """
+        add the counters and histograms of other, e.g. one collected in another process
+        """
+        with self._lock:
+            for name, n in other.counters.items():
+                self._incr(name, n)
+            for name, histogram in other.histograms.items():
+                self.histograms[name].merge(histogram)
+
+    def _incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def request_start(self, is_json, num_bytes):
+        with self._lock:
+            self._incr('requests')
+            self._incr('request_bytes', num_bytes)
+            self.histograms['request_bytes'].add(num_bytes)
+
+    def request_end(self, is_json, status, elapsed, error):
+        with self._lock:
+            if status is not None:
+                self._incr('status_%d' % status)
+            if error is not None:
+                self._incr('errors')
+            self.histograms['request_latency'].add(elapsed)
+
+    def retry_scheduled(self, delay, num_ids):
+        with self._lock:
+            self._incr('retries')
+            self._incr('retried_ids', num_ids)
+            self.histograms['retry_delay'].add(delay)
+
+    def results(self, counts):
+        with self._lock:
+            for status, n in counts.items():
+                self._incr('result_%s' % status, n)
+
+    def snapshot(self):
+        """
+        @return dict of counter values plus <histogram>_count/_mean/_p50/_p99 entries
+        """
+        with self._lock:
+            values = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                values['%s_count' % name] = histogram.count
+                values['%s_mean' % name] = histogram.mean()
+                values['%s_p50' % name] = histogram.percentile(50)
+                values['%s_p99' % name] = histogram.percentile(99)
+            return values
@@ -0,0 +1,165 @@
+import BaseHTTPServer
+import SocketServer
+import json
+import random
+import socket
+import threading
+import time
+import urlparse
+import zlib
+
+
+class MockGCMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # write each response in one segment: unbuffered writes plus Nagle and delayed ACKs add ~40ms
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.open_sockets.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.open_sockets.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        gzipped = self.headers.getheader('content-encoding') == 'gzip'
+        if gzipped and server.accept_gzip:
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        with server.lock:
+            server.requests.append((self.headers, body))
+            server.connections.add(self.client_address)
+            reply = server.replies.pop(0) if server.replies else None
+        if server.latency:
+            time.sleep(server.latency)
+
+        headers = list(server.extra_headers)
+        if reply is not None:
+            status, reply = reply
+        elif gzipped and not server.accept_gzip:
+            status, reply = 415, ''
+        elif server.roll(server.error_5xx_rate):
+            status, reply = 503, ''
+            if server.retry_after is not None:
+                headers.append(('Retry-After', str(server.retry_after)))
+        elif self.headers.getheader('content-type') == 'application/json':
+            status, reply = 200, server.json_reply(json.loads(body)['registration_ids'])
+        else:
+            status, reply = 200, server.plaintext_reply(urlparse.parse_qs(body)['registration_id'][0])
+
+        if server.gzip_responses and len(reply) >= 256 and 'gzip' in (self.headers.getheader('accept-encoding') or ''):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            reply = compressor.compress(reply) + compressor.flush()
+            headers.append(('Content-Encoding', 'gzip'))
+
+        self.send_response(status)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockGCMServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local stand-in for GCM_URL, for tests and benchmarks. Point a client at it with GCM(key, url=server.url).
+
+    Each POST is answered with the next (status, body) queued in replies if there is one;
+    otherwise a whole request fails with 503 at error_5xx_rate, and each recipient of a JSON
+    request independently gets Unavailable, NotRegistered, a canonical id or plain success
+    at the given rates. Plaintext requests are answered the same way for their one recipient.
+
+    Gzipped request bodies are accepted (else answered with 415 if accept_gzip is False), and
+    with gzip_responses, replies of 256 bytes and up are gzipped for clients that accept it.
+
+    :param latency: secs to wait before answering each request
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0.0, unavailable_rate=0.0, error_5xx_rate=0.0, canonical_rate=0.0,
+                 not_registered_rate=0.0, retry_after=None, seed=None, accept_gzip=True, gzip_responses=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), MockGCMHandler)
+        self.latency = latency
+        self.unavailable_rate = unavailable_rate
+        self.error_5xx_rate = error_5xx_rate
+        self.canonical_rate = canonical_rate
+        self.not_registered_rate = not_registered_rate
+        self.retry_after = retry_after
+        self.accept_gzip = accept_gzip
+        self.gzip_responses = gzip_responses
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.requests = []  # (headers, body) of every request received
+        self.replies = []
+        self.extra_headers = []
+        self.connections = set()
+        self.open_sockets = set()
+        self.url = 'http://127.0.0.1:%d/gcm/send' % self.server_port
+        self._message_ids = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # end handler threads still waiting on idle keep-alive connections
+        with self.lock:
+            for sock in self.open_sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def roll(self, rate):
+        if not rate:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def _outcome(self):
+        with self.lock:
+            self._message_ids += 1
+            message_id = '0:%d' % self._message_ids
+            roll = self.random.random()
+        if roll < self.unavailable_rate:
+            return {'error': 'Unavailable'}
+        roll -= self.unavailable_rate
+        if roll < self.not_registered_rate:
+            return {'error': 'NotRegistered'}
+        roll -= self.not_registered_rate
+        if roll < self.canonical_rate:
+            return {'message_id': message_id, 'registration_id': 'canonical-%s' % message_id}
+        return {'message_id': message_id}
+
+    def json_reply(self, registration_ids):
+        results = [self._outcome() for i in registration_ids]
+        failure = len([r for r in results if 'error' in r])
+        return json.dumps({
+            'multicast_id': self._message_ids,
+            'success': len(results) - failure,
+            'failure': failure,
+            'canonical_ids': len([r for r in results if 'registration_id' in r]),
+            'results': results,
+        })
+
+    def plaintext_reply(self, registration_id):
+        result = self._outcome()
+        if 'error' in result:
+            return 'Error=%s' % result['error']
+        if 'registration_id' in result:
+            return 'id=%s\nregistration_id=%s' % (result['message_id'], result['registration_id'])
+        return 'id=%s' % result['message_id']
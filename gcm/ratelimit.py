@@ -0,0 +1,133 @@
+import threading
+import time
+
+from gcm import GCM_response_wrapper
+from metrics import SendListener
+
+
+class TokenBucket(object):
+    """
+    Rate limiter for requests to GCM: limit requests per sec on average, with bursts of up to burst.
+    Share one instance between GCM instances (GCM(key, limiter=bucket)) to limit a whole process.
+    """
+    def __init__(self, limit, burst=None):
+        self.limit = float(limit)
+        self.burst = burst or max(1.0, self.limit)
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._condition = threading.Condition()
+
+    def set_limit(self, limit):
+        with self._condition:
+            self._refill()
+            self.limit = float(limit)
+            self._condition.notify_all()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.limit)
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        """
+        take a token, waiting for one if need be.
+        @return False if none became available within timeout secs
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.limit
+                if deadline is not None:
+                    if time.time() + wait > deadline:
+                        return False
+                self._condition.wait(wait)
+
+    def release(self):
+        pass
+
+
+class ConcurrencyLimiter(object):
+    """
+    Caps the number of requests in flight at once; unlike a semaphore the limit can change at any time.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def set_limit(self, limit):
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self.active >= max(1, int(self.limit)):
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class AIMDController(SendListener):
+    """
+    Additive-increase/multiplicative-decrease control of a TokenBucket or ConcurrencyLimiter.
+    Install it as the GCM listener (or in a CompositeListener): each 5xx response, and each
+    multicast response with more than unavailable_threshold of its results Unavailable, multiplies
+    the limit by decrease (at most once per cooldown secs); every healthy response adds increase.
+
+    bucket = TokenBucket(50)
+    gcm = GCM(API_KEY, limiter=bucket, listener=AIMDController(bucket, min_limit=5, max_limit=200))
+    """
+    def __init__(self, limiter, min_limit, max_limit, increase=1.0, decrease=0.5,
+                 unavailable_threshold=0.05, cooldown=1.0):
+        self.limiter = limiter
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.unavailable_threshold = unavailable_threshold
+        self.cooldown = cooldown
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+
+    def request_end(self, is_json, status, elapsed, error):
+        if status is not None and status >= 500:
+            self.congested()
+        elif status == 200 and not is_json:
+            self.healthy()
+
+    def results(self, counts):
+        total = sum(counts.values())
+        if total and float(counts.get(GCM_response_wrapper.RESEND, 0)) / total > self.unavailable_threshold:
+            self.congested()
+        else:
+            self.healthy()
+
+    def congested(self):
+        with self._lock:
+            now = time.time()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limiter.set_limit(max(self.min_limit, self.limiter.limit * self.decrease))
+
+    def healthy(self):
+        with self._lock:
+            if self.limiter.limit < self.max_limit:
+                self.limiter.set_limit(min(self.max_limit, self.limiter.limit + self.increase))
@@ -0,0 +1,286 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from array import array
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def _key(reg_id):
+    """
+    8 byte digest standing in for a registration id (usually ~150 chars) in memory and on disk
+    """
+    if isinstance(reg_id, unicode):
+        reg_id = reg_id.encode('utf-8')
+    return hashlib.md5(reg_id).digest()[:8]
+
+
+class RegistrationStore(object):
+    """
+    Cache of what GCM told us about registration ids: canonical replacements and dead
+    (NotRegistered/InvalidRegistration) ids, called tombstones here. Give it to GCM(registration_store=...)
+    and batch sends rewrite stale ids to their canonical form and drop dead ones before the
+    payload is built, and learn from every response. Chains of replacements (A to B, then B to C
+    or B dead) are followed to their end.
+
+    Entries live in slots of parallel arrays, indexed by the 8 byte digest of their id; canonical
+    ids are interned, so ids sharing one are stored once. That is under 200 bytes an entry, plus
+    the canonical ids. Beyond max_entries the clock algorithm evicts an entry not looked up since
+    the hand last passed it, an approximation of least recently used.
+
+    Changes are handed to flush_callback in lists of flush_size, as (reg_id, canonical_id) pairs,
+    canonical_id None for a dead id, so your database gets one bulk update per batch instead of
+    one write per id. Call flush() when done to hand over the remainder. The callback runs on the
+    thread sending, outside the store's lock; if it raises, the error is logged and the changes are
+    kept for the next flush.
+
+    :param max_entries: entries are evicted beyond this
+    :param ttl: secs an entry is trusted, None for ever
+    :param path: file to persist entries to (append-only, reloaded on start), None to keep them in memory
+    """
+    # canonical replacements followed by lookup(), against cycles
+    MAX_HOPS = 8
+
+    def __init__(self, max_entries=1000000, ttl=None, path=None, flush_callback=None, flush_size=1000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.flush_callback = flush_callback
+        self.flush_size = flush_size
+        self._slots = {}                # digest => slot
+        self._keys = []                 # slot => digest, None if free
+        self._canonical = array('l')    # slot => index into _canonical_ids, -1 for a tombstone
+        self._expires = array('d')      # slot => expires_at, 0 for never
+        self._referenced = array('b')   # slot => looked up since the clock hand last passed
+        self._free = []                 # free slots
+        self._hand = 0
+        self._canonical_ids = []        # interned canonical ids, None if free
+        self._canonical_index = {}      # canonical id => index
+        self._canonical_refs = array('l')
+        self._free_canonical = []
+        self._pending = []
+        self._lock = threading.RLock()
+        self._file = None
+        if path is not None:
+            self._load()
+            self._file = open(path, 'a')
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        with open(self.path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 3:
+                    continue  # torn last line after a crash
+                key, canonical_id, expires_at = fields
+                expires_at = float(expires_at) if expires_at else None
+                if expires_at is not None and expires_at <= now:
+                    self._delete(key.decode('hex'))
+                    continue
+                self._set(key.decode('hex'), canonical_id or None, expires_at)
+
+    def _intern(self, canonical_id):
+        if canonical_id is None:
+            return -1
+        index = self._canonical_index.get(canonical_id)
+        if index is not None:
+            self._canonical_refs[index] += 1
+            return index
+        if self._free_canonical:
+            index = self._free_canonical.pop()
+            self._canonical_ids[index] = canonical_id
+            self._canonical_refs[index] = 1
+        else:
+            index = len(self._canonical_ids)
+            self._canonical_ids.append(canonical_id)
+            self._canonical_refs.append(1)
+        self._canonical_index[canonical_id] = index
+        return index
+
+    def _release(self, index):
+        if index < 0:
+            return
+        self._canonical_refs[index] -= 1
+        if self._canonical_refs[index] == 0:
+            del self._canonical_index[self._canonical_ids[index]]
+            self._canonical_ids[index] = None
+            self._free_canonical.append(index)
+
+    def _delete(self, key):
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return
+        self._release(self._canonical[slot])
+        self._keys[slot] = None
+        self._free.append(slot)
+
+    def _evict(self):
+        """
+        free the first slot the clock hand finds unreferenced, clearing references on its way
+        """
+        while True:
+            slot = self._hand
+            self._hand = (self._hand + 1) % len(self._keys)
+            if self._keys[slot] is None:
+                continue
+            if self._referenced[slot]:
+                self._referenced[slot] = 0
+                continue
+            self._delete(self._keys[slot])
+            return
+
+    def _set(self, key, canonical_id, expires_at):
+        index = self._intern(canonical_id)
+        slot = self._slots.get(key)
+        if slot is not None:
+            self._release(self._canonical[slot])
+        else:
+            if len(self._slots) >= self.max_entries:
+                self._evict()
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._keys)
+                self._keys.append(None)
+                self._canonical.append(-1)
+                self._expires.append(0)
+                self._referenced.append(0)
+            self._slots[key] = slot
+            self._keys[slot] = key
+            self._referenced[slot] = 0
+        self._canonical[slot] = index
+        self._expires[slot] = expires_at or 0
+
+    def _get(self, key):
+        """
+        @return (canonical_id or None for a tombstone, expires_at or None), or None if unknown
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        expires_at = self._expires[slot] or None
+        if expires_at is not None and expires_at <= time.time():
+            self._delete(key)
+            return None
+        self._referenced[slot] = 1
+        index = self._canonical[slot]
+        return (self._canonical_ids[index] if index >= 0 else None), expires_at
+
+    def _entries(self):
+        """
+        @return generator of (digest, canonical_id, expires_at) for every entry
+        """
+        for key, slot in self._slots.iteritems():
+            index = self._canonical[slot]
+            yield key, (self._canonical_ids[index] if index >= 0 else None), self._expires[slot] or None
+
+    def _record(self, reg_id, canonical_id):
+        expires_at = None if self.ttl is None else time.time() + self.ttl
+        pending = None
+        with self._lock:
+            key = _key(reg_id)
+            self._set(key, canonical_id, expires_at)
+            if self._file is not None:
+                self._file.write('%s\t%s\t%s\n' % (key.encode('hex'), canonical_id or '',
+                                                   '' if expires_at is None else repr(expires_at)))
+            if self.flush_callback is not None:
+                self._pending.append((reg_id, canonical_id))
+                if len(self._pending) >= self.flush_size:
+                    pending, self._pending = self._pending, []
+        if pending:
+            self._flush(pending)
+
+    def record_canonical(self, reg_id, canonical_id):
+        self._record(reg_id, canonical_id)
+
+    def record_unregistered(self, reg_id):
+        self._record(reg_id, None)
+
+    def update(self, response, reg_ids):
+        """
+        learn the canonical ids and dead ids of one GCM_response_wrapper
+        """
+        for old_id, canonical_id in response.get_canonical_ids(reg_ids):
+            self.record_canonical(old_id, canonical_id)
+        for dead_id in response.get_unregister_errors(reg_ids):
+            self.record_unregistered(dead_id)
+
+    def lookup(self, reg_id):
+        """
+        @return the id to send to: reg_id itself, its canonical id (following replacements of that),
+                or None if it is dead
+        """
+        with self._lock:
+            for hop in xrange(self.MAX_HOPS):
+                entry = self._get(_key(reg_id))
+                if entry is None:
+                    return reg_id
+                if entry[0] is None or entry[0] == reg_id:
+                    return entry[0]
+                reg_id = entry[0]
+        return reg_id
+
+    def apply(self, reg_ids):
+        """
+        @return generator over reg_ids with canonical ids substituted and dead ids left out
+        """
+        for reg_id in reg_ids:
+            reg_id = self.lookup(reg_id)
+            if reg_id is not None:
+                yield reg_id
+
+    def _flush(self, pending):
+        """
+        hand pending, taken off _pending, to flush_callback without holding the lock; what it fails
+        to take goes back to _pending
+        """
+        for start in xrange(0, len(pending), self.flush_size):
+            try:
+                self.flush_callback(pending[start:start + self.flush_size])
+            except Exception:
+                log.exception('flush_callback failed, %i changes kept for the next flush', len(pending) - start)
+                with self._lock:
+                    self._pending[:0] = pending[start:]
+                return
+
+    def flush(self):
+        """
+        hand pending changes to flush_callback and sync the file
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+        if pending:
+            self._flush(pending)
+
+    def compact(self):
+        """
+        rewrite the file with just the live entries
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            self._file.close()
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                for key, canonical_id, expires_at in self._entries():
+                    f.write('%s\t%s\t%s\n' % (key.encode('hex'), canonical_id or '',
+                                              '' if expires_at is None else repr(expires_at)))
+            os.rename(tmp, self.path)
+            self._file = open(self.path, 'a')
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
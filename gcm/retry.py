@@ -0,0 +1,173 @@
+import time
+from collections import deque
+from itertools import islice
+
+from gcm import GCM_bulk_result, GCMException, GCMRetriableException, require_ids
+from dispatch import BoundedExecutor, Future
+
+
+class _RetryPool(object):
+    """
+    ids waiting for the same attempt number, and the earliest time they may be resent: no
+    sooner than the backoff of the ids added last, so a stream of resends during an outage
+    keeps backing off instead of going out at once.
+    """
+    def __init__(self):
+        self.ids = deque()
+        self.ready_at = None
+
+    def add(self, ids, delay, retry_after=None):
+        ready_at = time.time() + max(delay, retry_after or 0)
+        self.ready_at = ready_at if self.ready_at is None else max(self.ready_at, ready_at)
+        self.ids.extend(ids)
+
+    def take(self, count):
+        batch = [self.ids.popleft() for i in xrange(min(count, len(self.ids)))]
+        if not self.ids:
+            self.ready_at = None
+        return batch
+
+
+class MulticastRetrier(object):
+    """
+    JSON multicast with built-in retries. Unavailable ids from every batch are pooled per attempt
+    number and resent as full batches of up to 1000 ids, after the same jittered exponential backoff
+    request_plaintext uses (and no sooner than a Retry-After header asks for).
+
+    retrier = MulticastRetrier(GCM(API_KEY), max_attempts=5, deadline=600)
+    result = retrier.send(reg_ids, data)
+    result.resend_ids  # ids still undelivered when attempts or the deadline ran out
+
+    :param max_attempts: sends per id, the first one included
+    :param deadline: secs; no retry is scheduled past this budget, None for no limit
+    :param max_workers: batches sent concurrently; 1 sends inline on the calling thread
+    """
+    def __init__(self, gcm, max_attempts=5, deadline=None, max_workers=1):
+        if max_attempts < 1:
+            raise GCMException('max_attempts must be at least 1')
+        self.gcm = gcm
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.max_workers = max_workers
+
+    def _delay(self, attempt):
+        """
+        backoff before the given retry attempt (1 for the first retry)
+        """
+        return next(islice(self.gcm.backoff_delays(), attempt - 1, None))
+
+    def send(self, registration_ids, data=None, collapse_key=None,
+               delay_while_idle=False, time_to_live=None, result=None, lookup=True):
+        """
+        :param registration_ids: any iterable of registration ids, consumed lazily
+        :param data: dict mapping of key-value pairs of messages, or a PayloadTemplate
+        :param result: GCM_bulk_result (or subclass, e.g. stream.OutcomeWriter) to fold outcomes into
+        :param lookup: False if registration_ids were already looked up in the gcm's registration store
+                       by the caller, which then maps outcomes back to the ids it was given itself
+        @return GCM_bulk_result whose resend_ids are the ids given up on
+        :raises GCMMissingRegistrationException: if registration_ids is empty
+        :raises GCMNoRetryException: on fatal errors such as authentication failure
+        """
+        template = self.gcm.payload_template(data, collapse_key, delay_while_idle, time_to_live)
+        size = self.gcm.MAX_REGISTRATION_IDS
+        deadline_at = None if self.deadline is None else time.time() + self.deadline
+        if result is None:
+            result = GCM_bulk_result()
+        fresh = self.gcm.filter_ids(require_ids(registration_ids), template, result=result, lookup=lookup)
+        pools = [_RetryPool() for i in range(self.max_attempts)]  # pools[0] is never used
+        in_flight = deque()
+        executor = BoundedExecutor(self.max_workers) if self.max_workers > 1 else None
+
+        def submit(attempt, batch):
+            payload = template.encode(batch)
+            if executor is not None:
+                future = executor.submit(self._send, payload, batch)
+            else:
+                future = Future()
+                try:
+                    future.set_result(self._send(payload, batch))
+                except Exception as e:
+                    future.set_exception(e)
+            in_flight.append((attempt, batch, future))
+
+        def give_up(reg_ids):
+            result.add_resends(result.given_ids(reg_ids))
+            # undelivered, so not a duplicate when sent again
+            self.gcm.forget_sent(reg_ids, template)
+
+        def collect():
+            attempt, batch, future = in_flight.popleft()
+            retry_after = None
+            try:
+                response = future.result()
+            except GCMRetriableException as e:
+                result.num_batches += 1
+                resends = batch
+                retry_after = getattr(e, 'retry_after', None)
+            except Exception:
+                self.gcm.forget_sent(batch, template)
+                raise
+            else:
+                result.add_response(response, batch, resends=False)
+                resends = response.get_resend_ids(batch)
+            if not resends:
+                return
+            if attempt + 1 >= self.max_attempts:
+                give_up(resends)
+            else:
+                pool = pools[attempt + 1]
+                pool.add(resends, self._delay(attempt + 1), retry_after)
+                if self.gcm.listener is not None:
+                    self.gcm.listener.retry_scheduled(max(0, pool.ready_at - time.time()), len(resends))
+
+        def full_pool(now):
+            for attempt in range(1, self.max_attempts):
+                pool = pools[attempt]
+                if len(pool.ids) >= size and pool.ready_at <= now:
+                    return attempt
+            return None
+
+        try:
+            while True:
+                if len(in_flight) >= self.max_workers:
+                    collect()
+                    continue
+                # a full retry batch whose backoff has elapsed goes first
+                now = time.time()
+                attempt = full_pool(now)
+                if attempt is not None and (deadline_at is None or now <= deadline_at):
+                    submit(attempt, pools[attempt].take(size))
+                    continue
+                batch = list(islice(fresh, size)) if fresh is not None else []
+                if batch:
+                    submit(0, batch)
+                    continue
+                fresh = None
+                if in_flight:
+                    collect()
+                    continue
+                # only partial retry batches left: wait for the earliest one
+                waiting = [(pools[i].ready_at, i) for i in range(1, self.max_attempts) if pools[i].ids]
+                if not waiting:
+                    break
+                ready_at, attempt = min(waiting)
+                if deadline_at is not None and ready_at > deadline_at:
+                    break
+                if ready_at > time.time():
+                    time.sleep(ready_at - time.time())
+                submit(attempt, pools[attempt].take(size))
+        except Exception:
+            self.gcm.forget_sent([reg_id for item in in_flight for reg_id in item[1]], template)
+            self.gcm.forget_sent([reg_id for pool in pools for reg_id in pool.ids], template)
+            raise
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_pending=True)
+
+        for pool in pools:
+            if pool.ids:
+                give_up(list(pool.ids))
+        return result
+
+    def _send(self, payload, batch):
+        return self.gcm.wrap_response(self.gcm.make_request(payload, is_json=True), batch)
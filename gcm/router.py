@@ -0,0 +1,344 @@
+import heapq
+import threading
+import time
+from collections import deque
+from itertools import chain, count, islice
+
+from gcm import GCM, GCM_bulk_result, GCM_response_wrapper, GCMCircuitOpenException, GCMException, \
+    GCMRetriableException, require_ids
+from breaker import CircuitBreaker
+from dispatch import Future
+from ratelimit import TokenBucket
+
+
+class RoutedResult(GCM_bulk_result):
+    """
+    GCM_bulk_result of one SenderRouter.send, plus mismatched: the ids GCM answered
+    MismatchSenderId for, i.e. registered with another app than key's
+    """
+    def __init__(self, key):
+        GCM_bulk_result.__init__(self)
+        self.key = key
+        self.mismatched = []
+
+    def add_response(self, response, reg_ids, resends=True):
+        self.num_batches += 1
+        self.add_outcomes(self.response_outcomes(response, reg_ids, resends))
+
+    def add_outcomes(self, outcomes):
+        for outcome in outcomes:
+            GCM_bulk_result.add_outcomes(self, [outcome])
+            if outcome[2] == 'MismatchSenderId':
+                self.mismatched.append(outcome[0])
+
+
+class Route(object):
+    """
+    one API key of a SenderRouter: its GCM client (and so its connection pool), rate limit,
+    circuit breaker and queue of messages. mismatches counts MismatchSenderId results for the key.
+    """
+    def __init__(self, key, gcm, limiter):
+        self.key = key
+        self.gcm = gcm
+        self.limiter = limiter
+        self.mismatches = 0
+        self.in_flight = 0
+        self.messages = deque()  # messages with ids not cut into batches yet
+        self.fresh = deque()     # the next batch cut from them, not sent yet
+        self.cutting = False     # a worker is cutting the next batch, outside the router's lock
+        self.retries = []        # heap of (ready_at, seq, batch) waiting out their backoff
+
+    def pending(self):
+        return len(self.messages) + len(self.fresh) + len(self.retries)
+
+
+class _Message(object):
+    def __init__(self, key, template, ids):
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.result = RoutedResult(key)
+        self.template = template
+        self.ids = ids      # iterator over the ids not cut into batches yet, None once they ran out
+        self.remaining = 0  # ids cut into batches and not resolved yet
+        self.lock = threading.Lock()  # batches of one message may be sent on several workers at once
+
+    def resolved(self, count):
+        self.remaining -= count
+        if self.remaining == 0 and self.ids is None and not self.future.done():
+            self.future.set_result(self.result)
+
+    def fail(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+# _ready: the route has no batch cut yet
+_CUT = object()
+
+
+class _Batch(object):
+    def __init__(self, message, reg_ids, attempt=0):
+        self.message = message
+        self.reg_ids = reg_ids
+        self.attempt = attempt
+
+
+class SenderRouter(object):
+    """
+    Sends for many apps, each with its own API key, from one set of worker threads. Every key gets
+    its own GCM client with its own keep-alive pool of pool_size connections, its own rate limit and
+    its own CircuitBreaker, so one app's quota or outage never holds up another's.
+
+    Messages are queued per key and cut into batches of up to 1000 ids only as they are sent, so
+    their ids are read lazily. Idle workers take the next batch from the keys in turn, skipping keys
+    that are out of tokens, have an open circuit or already have pool_size requests in flight: a key
+    with a million queued ids gets no more turns than one with a single batch. Unavailable ids are
+    requeued after the usual backoff, up to max_attempts sends.
+
+    router = SenderRouter(max_workers=8)
+    router.add_key('news', NEWS_API_KEY, rate=100)
+    router.add_key('chat', CHAT_API_KEY, rate=500, pool_size=8)
+    future = router.send('chat', reg_ids, {'msg': 'hi'})
+    future.result().mismatched  # ids that belong to another app
+    router.close()
+    """
+    def __init__(self, max_workers=8, max_attempts=5, **gcm_kwargs):
+        """
+        :param gcm_kwargs: passed to every key's GCM, e.g. url or timeout
+        """
+        self.max_attempts = max_attempts
+        self.gcm_kwargs = gcm_kwargs
+        self._routes = []
+        self._by_key = {}
+        self._turn = 0
+        self._seq = count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._threads = []
+        for i in range(max_workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def add_key(self, key, api_key, rate=None, pool_size=4, breaker=None, **gcm_kwargs):
+        """
+        :param key: name to send() under, e.g. the app's package name
+        :param rate: requests per sec allowed for this key, None for no limit; or a TokenBucket or
+                     ConcurrencyLimiter
+        :param breaker: CircuitBreaker for this key, by default a new one
+        @return the Route
+        """
+        if isinstance(rate, (int, long, float)):
+            rate = TokenBucket(rate)
+        kwargs = dict(self.gcm_kwargs, **gcm_kwargs)
+        gcm = GCM(api_key, pool_size=pool_size, breaker=breaker or CircuitBreaker(), **kwargs)
+        route = Route(key, gcm, rate)
+        with self._condition:
+            if key in self._by_key:
+                raise GCMException('key %r is already routed' % key)
+            self._by_key[key] = route
+            self._routes.append(route)
+        return route
+
+    def route(self, key):
+        return self._by_key[key]
+
+    def send(self, key, registration_ids, data=None, collapse_key=None, delay_while_idle=False,
+               time_to_live=None):
+        """
+        :param key: the key added with add_key whose API key to send with
+        :param registration_ids: any iterable of registration ids, consumed a batch at a time as
+                                 the batches are sent; it must not be shared with other threads
+        @return Future of the RoutedResult
+        :raises KeyError: if key was never added
+        :raises GCMMissingRegistrationException: if registration_ids is empty
+        """
+        route = self._by_key[key]
+        template = route.gcm.payload_template(data, collapse_key, delay_while_idle, time_to_live)
+        message = _Message(key, template, None)
+        ids = route.gcm.filter_ids(require_ids(registration_ids), template, result=message.result)
+        first = list(islice(ids, route.gcm.MAX_REGISTRATION_IDS))
+        if not first:
+            # every id was a duplicate
+            message.future.set_result(message.result)
+            return message.future
+        message.ids = chain(first, ids)
+        with self._condition:
+            if self._closed:
+                raise GCMException('router is closed')
+            route.messages.append(message)
+            self._condition.notify_all()
+        return message.future
+
+    def pending(self):
+        """
+        @return dict( key: number of messages and retry batches waiting to be sent )
+        """
+        with self._condition:
+            return dict((route.key, route.pending()) for route in self._routes)
+
+    def _ready(self, route, now):
+        """
+        @return the next batch of route that may be sent now, taking it off the queue; _CUT if one
+                has to be cut from its messages first; or None
+        """
+        # a half-open circuit lets through only the probes not yet taken
+        if route.in_flight >= route.gcm.pool.maxsize or not route.gcm.breaker.available():
+            return None
+        retry = route.retries and route.retries[0][0] <= now
+        if not retry and not route.fresh:
+            return _CUT if route.messages and not route.cutting else None
+        if route.limiter is not None and not route.limiter.acquire(timeout=0):
+            return None
+        if retry:
+            return heapq.heappop(route.retries)[2]
+        return route.fresh.popleft()
+
+    def _cut(self, route):
+        """
+        cut the next batch of route from its first message, or finish the message if its ids ran out.
+        Called holding the condition, which is released meanwhile: reading the caller's ids (and
+        looking them up) must not hold up the other keys.
+        """
+        message = route.messages[0]
+        route.cutting = True
+        reg_ids = []
+        self._condition.release()
+        try:
+            # only this worker reads the ids; the message's other batches resolve meanwhile
+            if not message.future.done():
+                try:
+                    reg_ids = list(islice(message.ids, route.gcm.MAX_REGISTRATION_IDS))
+                except Exception as e:
+                    message.fail(e)
+            with message.lock:
+                if reg_ids:
+                    message.remaining += len(reg_ids)
+                else:
+                    message.ids = None
+                    message.resolved(0)
+        finally:
+            self._condition.acquire()
+            route.cutting = False
+        if reg_ids:
+            route.fresh.append(_Batch(message, reg_ids))
+        else:
+            route.messages.popleft()
+        self._condition.notify_all()
+
+    def _take(self):
+        """
+        wait for a batch any key may send, giving each key a turn in order
+        @return (route, batch), or None once closed and drained
+        """
+        with self._condition:
+            while True:
+                now = time.time()
+                count = len(self._routes)
+                for i in range(count):
+                    route = self._routes[(self._turn + i) % count]
+                    batch = self._ready(route, now)
+                    if batch is _CUT:
+                        # then look again from the same turn
+                        self._cut(route)
+                        break
+                    if batch is not None:
+                        self._turn = (self._turn + i + 1) % count
+                        route.in_flight += 1
+                        return route, batch
+                else:
+                    if self._closed and not any(route.pending() or route.in_flight for route in self._routes):
+                        return None
+                    # woken by new batches and finished requests; otherwise poll for tokens, backoffs
+                    # and circuits to come around
+                    waits = [route.retries[0][0] - now for route in self._routes if route.retries]
+                    self._condition.wait(max(0.001, min(waits + [0.05])))
+
+    def _work(self):
+        while True:
+            taken = self._take()
+            if taken is None:
+                with self._condition:
+                    self._condition.notify_all()
+                return
+            route, batch = taken
+            try:
+                self._send(route, batch)
+            finally:
+                if route.limiter is not None:
+                    route.limiter.release()
+                with self._condition:
+                    route.in_flight -= 1
+                    self._condition.notify_all()
+
+    def _send(self, route, batch):
+        message = batch.message
+        if message.future.done():
+            return  # failed by another batch
+        try:
+            self._deliver(route, batch)
+        except Exception as e:
+            # fatal errors, and errors folding in the response or scheduling retries: the message's
+            # future must not be left waiting
+            message.fail(e)
+
+    def _deliver(self, route, batch):
+        message = batch.message
+        gcm = route.gcm
+        try:
+            response = gcm.wrap_response(gcm.make_request(message.template.encode(batch.reg_ids), is_json=True),
+                                         batch.reg_ids)
+        except GCMCircuitOpenException:
+            # another worker took the probe: nothing was sent, so not an attempt
+            self._requeue(route, batch, max(route.gcm.breaker.retry_in(), 0.01))
+            return
+        except GCMRetriableException as e:
+            with message.lock:
+                message.result.num_batches += 1
+            self._retry(route, batch, batch.reg_ids, getattr(e, 'retry_after', None))
+            return
+        resends = response.get_resend_ids(batch.reg_ids)
+        with message.lock:
+            num_mismatched = len(message.result.mismatched)
+            message.result.add_response(response, batch.reg_ids, resends=False)
+            num_mismatched = len(message.result.mismatched) - num_mismatched
+            message.resolved(len(batch.reg_ids) - len(resends))
+        if num_mismatched:
+            with self._condition:
+                route.mismatches += num_mismatched
+        if resends:
+            self._retry(route, batch, resends, None)
+
+    def _retry(self, route, batch, reg_ids, retry_after):
+        message = batch.message
+        attempt = batch.attempt + 1
+        if attempt >= self.max_attempts:
+            with message.lock:
+                message.result.add_resends(message.result.given_ids(reg_ids))
+                message.resolved(len(reg_ids))
+            route.gcm.forget_sent(reg_ids, message.template)
+            return
+        # same backoff per attempt as MulticastRetrier
+        delay = max(next(islice(route.gcm.backoff_delays(), attempt - 1, None)), retry_after or 0)
+        if route.gcm.listener is not None:
+            route.gcm.listener.retry_scheduled(delay, len(reg_ids))
+        self._requeue(route, _Batch(message, reg_ids, attempt), delay)
+
+    def _requeue(self, route, batch, delay):
+        with self._condition:
+            heapq.heappush(route.retries, (time.time() + delay, next(self._seq), batch))
+            self._condition.notify_all()
+
+    def close(self, wait=True):
+        """
+        send everything still queued, including retries, then stop the workers and close every pool.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+            for route in self._routes:
+                route.gcm.close()
@@ -0,0 +1,132 @@
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+from gcm import GCM, GCM_bulk_result, GCM_response_wrapper, GCMException, PayloadTemplate, require_ids
+from jsoncodec import default_codec
+from metrics import CompositeListener, MetricsCollector
+from retry import MulticastRetrier
+
+
+class _OutcomeList(GCM_bulk_result):
+    """
+    the outcomes of one chunk as (reg_id, status, extra) triples, to ship back to the parent process
+    """
+    def __init__(self):
+        GCM_bulk_result.__init__(self)
+        self.outcomes = []
+
+    def add_response(self, response, reg_ids, resends=True):
+        self.num_batches += 1
+        self.outcomes.extend(self.response_outcomes(response, reg_ids, resends))
+
+    def add_outcomes(self, outcomes):
+        self.outcomes.extend(outcomes)
+
+    def add_resends(self, reg_ids):
+        self.outcomes.extend((reg_id, GCM_response_wrapper.RESEND, 'Unavailable') for reg_id in reg_ids)
+
+
+# state of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(api_key, gcm_kwargs, template, max_attempts, deadline, max_workers, collect_metrics):
+    gcm = GCM(api_key, **gcm_kwargs)
+    _worker.update(gcm=gcm, template=template, collect_metrics=collect_metrics, listener=gcm.listener,
+                   retrier=MulticastRetrier(gcm, max_attempts, deadline, max_workers))
+
+
+def _send_chunk(registration_ids):
+    """
+    @return (num_batches, outcomes, MetricsCollector of this chunk or None)
+    """
+    gcm = _worker['gcm']
+    metrics = None
+    if _worker['collect_metrics']:
+        # alongside the listener given in gcm_kwargs, if any
+        metrics = MetricsCollector()
+        listener = _worker['listener']
+        gcm.listener = metrics if listener is None else CompositeListener([listener, metrics])
+    result = _OutcomeList()
+    _worker['retrier'].send(registration_ids, _worker['template'], result=result)
+    return result.num_batches, result.outcomes, metrics
+
+
+class ShardedSender(object):
+    """
+    Sends one message to a stream of recipients from several worker processes, so that encoding
+    payloads and parsing responses is spread over as many cores. The parent cuts registration_ids
+    into chunks of chunk_size; each worker sends its chunks with a MulticastRetrier over its own
+    GCM client, built from api_key and gcm_kwargs. The payload is encoded once in the parent and
+    handed to each worker once when it starts; chunks carry only ids.
+
+    Outcomes are folded into one result in the parent, in chunk order, and per-chunk metrics into
+    the parent's metrics collector. Limiters and breakers in gcm_kwargs are copied, not shared:
+    each worker gets its own.
+
+    sender = ShardedSender(API_KEY, processes=4, metrics=MetricsCollector(), pool_size=8)
+    result = sender.send(open_registration_ids('devices.txt'), data)
+
+    :param max_workers: batches each worker process sends concurrently
+    """
+    def __init__(self, api_key, processes=None, chunk_size=10000, max_attempts=5, deadline=None,
+                 max_workers=1, metrics=None, **gcm_kwargs):
+        self.api_key = api_key
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.gcm_kwargs = gcm_kwargs
+
+    def send(self, registration_ids, data=None, collapse_key=None,
+               delay_while_idle=False, time_to_live=None, result=None):
+        """
+        :param registration_ids: any iterable of registration ids, consumed lazily
+        :param data: dict mapping of key-value pairs of messages, or a PayloadTemplate
+        :param result: GCM_bulk_result (or subclass, e.g. stream.OutcomeWriter) to fold outcomes into
+        @return GCM_bulk_result whose resend_ids are the ids given up on
+        :raises GCMMissingRegistrationException: if registration_ids is empty
+        :raises GCMNoRetryException: on fatal errors in any worker
+        """
+        if isinstance(data, PayloadTemplate):
+            template = data
+        elif not data:
+            raise GCMException('no data to send')
+        else:
+            # encoded as the workers' GCM would, with the codec in gcm_kwargs
+            template = PayloadTemplate(data, collapse_key, delay_while_idle, time_to_live,
+                                       codec=self.gcm_kwargs.get('json_codec') or default_codec())
+        ids = require_ids(registration_ids)
+        if result is None:
+            result = GCM_bulk_result()
+        pool = multiprocessing.Pool(self.processes, _init_worker, (
+            self.api_key, self.gcm_kwargs, template, self.max_attempts, self.deadline,
+            self.max_workers, self.metrics is not None))
+        in_flight = deque()
+        try:
+            while True:
+                # two chunks per worker keep every worker busy without reading ahead unboundedly
+                if len(in_flight) >= 2 * self.processes:
+                    self._collect(in_flight.popleft(), result)
+                    continue
+                chunk = list(islice(ids, self.chunk_size))
+                if not chunk:
+                    break
+                in_flight.append(pool.apply_async(_send_chunk, (chunk,)))
+            while in_flight:
+                self._collect(in_flight.popleft(), result)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return result
+
+    def _collect(self, async_result, result):
+        num_batches, outcomes, metrics = async_result.get()
+        result.num_batches += num_batches
+        result.add_outcomes(outcomes)
+        if metrics is not None:
+            self.metrics.merge(metrics)
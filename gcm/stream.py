@@ -0,0 +1,254 @@
+"""
+Streaming bulk send: registration ids are read lazily from a file, sent in batches of 1000 and
+each id's outcome is appended to an output file as soon as its batch is answered, so memory use
+does not grow with the number of recipients. Run again with the same output directory to resume
+an interrupted campaign from its journal.
+
+    python -m gcm --api-key KEY --data '{"msg": "hi"}' --input ids.csv --field token --out results/
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+from gcm import GCM, GCM_bulk_result, GCM_response_wrapper, GCMException
+from journal import SendJournal
+from retry import MulticastRetrier
+
+FORMATS = ('lines', 'jsonl', 'csv')
+
+
+def read_registration_ids(lines, format='lines', field=None):
+    """
+    Lazily parse registration ids; blank lines and empty values are skipped.
+
+    :param lines: file object or any iterable of lines
+    :param format: 'lines' (one id per line), 'jsonl' (each line a JSON string, or an object with
+                   the id under field) or 'csv' (the id in column field: by name in the header row,
+                   or by index in a file without one)
+    :param field: defaults to 'registration_id'
+    @return generator of registration ids
+    """
+    if format == 'lines':
+        for line in lines:
+            reg_id = line.strip()
+            if reg_id:
+                yield reg_id
+    elif format == 'jsonl':
+        field = field or 'registration_id'
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            reg_id = record.get(field) if isinstance(record, dict) else record
+            if reg_id:
+                yield reg_id
+    elif format == 'csv':
+        rows = csv.reader(lines)
+        column = field or 'registration_id'
+        if not isinstance(column, int):
+            if not str(column).isdigit():
+                header = next(rows, [])
+                if column not in header:
+                    raise GCMException('no column %r in the header row %r; give the column by index '
+                                       'for a file without a header' % (column, header))
+                column = header.index(column)
+            column = int(column)
+        for row in rows:
+            if len(row) > column and row[column].strip():
+                yield row[column].strip()
+    else:
+        raise GCMException('unknown format %r, expected one of %s' % (format, ', '.join(FORMATS)))
+
+
+def open_registration_ids(path, format=None, field=None):
+    """
+    read_registration_ids over a file, the format guessed from its extension (.jsonl, .csv) if not given;
+    the file is closed once the ids run out.
+    """
+    if format is None:
+        extension = os.path.splitext(path)[1].lower().lstrip('.')
+        format = {'jsonl': 'jsonl', 'json': 'jsonl', 'csv': 'csv'}.get(extension, 'lines')
+    with open(path, 'rb' if format == 'csv' else 'r') as f:
+        for reg_id in read_registration_ids(f, format, field):
+            yield reg_id
+
+
+class OutcomeWriter(GCM_bulk_result):
+    """
+    GCM_bulk_result that appends outcomes to files in directory instead of keeping them in lists:
+
+        success.txt       reg_id
+        canonical.tsv     reg_id <tab> canonical_id
+        unregister.tsv    reg_id <tab> error (NotRegistered, InvalidRegistration)
+        failed.tsv        reg_id <tab> error (Unavailable after the last attempt, or another GCM error)
+        duplicate.txt     reg_id, left out by the gcm's deduplicator
+
+    counts holds the number of ids written to each file. Existing files are appended to.
+    With a journal.SendJournal, every outcome is also journaled, and the files are synced along
+    with the journal so that they hold at least every outcome it claims.
+    """
+    FILES = (
+        (GCM_response_wrapper.SUCCESS, 'success.txt'),
+        (GCM_response_wrapper.CANONICAL, 'canonical.tsv'),
+        (GCM_response_wrapper.UNREGISTER, 'unregister.tsv'),
+        (GCM_response_wrapper.ERROR, 'failed.tsv'),
+        (GCM_response_wrapper.DUPLICATE, 'duplicate.txt'),
+    )
+
+    def __init__(self, directory, journal=None):
+        GCM_bulk_result.__init__(self)
+        self.journal = journal
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.counts = dict((status, 0) for status, name in self.FILES)
+        self._files = dict((status, open(os.path.join(directory, name), 'a')) for status, name in self.FILES)
+
+    def _write(self, status, reg_id, extra=None):
+        if isinstance(reg_id, unicode):
+            reg_id = reg_id.encode('utf-8')
+        if extra is None:
+            self._files[status].write('%s\n' % reg_id)
+        else:
+            if isinstance(extra, unicode):
+                extra = extra.encode('utf-8')
+            self._files[status].write('%s\t%s\n' % (reg_id, extra))
+        self.counts[status] += 1
+
+    def add_response(self, response, reg_ids, resends=True):
+        self.num_batches += 1
+        self.add_outcomes(self.response_outcomes(response, reg_ids, resends))
+
+    def add_outcomes(self, outcomes):
+        journal = self.journal
+        for reg_id, status, extra in outcomes:
+            if status == GCM_response_wrapper.RESEND:
+                self._write(GCM_response_wrapper.ERROR, reg_id, extra)
+                if journal is not None:
+                    journal.give_up(reg_id)
+                continue
+            if status in (GCM_response_wrapper.SUCCESS, GCM_response_wrapper.DUPLICATE):
+                self._write(status, reg_id)
+            else:
+                self._write(status, reg_id, extra)
+            if journal is not None:
+                journal.acknowledge(reg_id)
+        self._checkpoint()
+
+    def add_resends(self, reg_ids):
+        for reg_id in reg_ids:
+            self._write(GCM_response_wrapper.ERROR, reg_id, 'Unavailable')
+            if self.journal is not None:
+                self.journal.give_up(reg_id)
+        self._checkpoint()
+
+    def _checkpoint(self):
+        if self.journal is not None and self.journal.sync_due():
+            self.sync()
+
+    def sync(self):
+        """
+        fsync the outcome files, then the journal
+        """
+        for f in self._files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        if self.journal is not None:
+            self.journal.sync()
+
+    def has_resends(self):
+        return self.counts[GCM_response_wrapper.ERROR] > 0
+
+    def flush(self):
+        for f in self._files.values():
+            f.flush()
+
+    def close(self):
+        if self.journal is not None:
+            self.sync()
+        for f in self._files.values():
+            f.close()
+
+
+def send_stream(gcm, registration_ids, directory, data=None, collapse_key=None,
+                  delay_while_idle=False, time_to_live=None, max_attempts=5, deadline=None, max_workers=1,
+                  journal=None):
+    """
+    Send one message to every id in registration_ids (any iterable, e.g. open_registration_ids(path)),
+    retrying Unavailable ids as MulticastRetrier does, and write every outcome under directory.
+    :param journal: journal.SendJournal; only the ids it has no final outcome for are sent
+    @return the closed OutcomeWriter, for its counts
+    :raises GCMNoRetryException: on fatal errors; outcomes written so far are kept
+    """
+    writer = OutcomeWriter(directory, journal)
+    if journal is not None:
+        registration_ids = journal.resume(registration_ids)
+    try:
+        MulticastRetrier(gcm, max_attempts=max_attempts, deadline=deadline, max_workers=max_workers).send(
+            registration_ids, data, collapse_key, delay_while_idle, time_to_live, result=writer)
+    finally:
+        writer.close()
+    return writer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Send a GCM message to every registration id in a file')
+    parser.add_argument('--api-key', default=os.environ.get('GCM_API_KEY'),
+                        help='defaults to $GCM_API_KEY')
+    parser.add_argument('--url', default=None, help='GCM endpoint, e.g. a mock server')
+    parser.add_argument('--input', required=True, help="file of registration ids, '-' for stdin")
+    parser.add_argument('--format', choices=FORMATS, default=None,
+                        help='input format, guessed from the file extension by default')
+    parser.add_argument('--field', default=None,
+                        help='jsonl key or csv column of the id: a header name, or an index if there is no '
+                             'header row; registration_id by default')
+    parser.add_argument('--out', required=True, help='directory for the outcome files')
+    parser.add_argument('--data', required=True, help='message data, a JSON object')
+    parser.add_argument('--collapse-key', default=None)
+    parser.add_argument('--time-to-live', type=int, default=None)
+    parser.add_argument('--delay-while-idle', action='store_true')
+    parser.add_argument('--attempts', type=int, default=5, help='sends per id, the first one included')
+    parser.add_argument('--deadline', type=float, default=None, help='secs after which no retry is scheduled')
+    parser.add_argument('--workers', type=int, default=1, help='batches sent concurrently')
+    parser.add_argument('--no-journal', action='store_true',
+                        help="don't keep a journal in the output directory to resume an interrupted run from")
+    options = parser.parse_args(argv)
+    if not options.api_key:
+        parser.error('--api-key or $GCM_API_KEY is required')
+    try:
+        data = json.loads(options.data)
+    except ValueError as e:
+        parser.error('--data is not valid JSON: %s' % e)
+    if not isinstance(data, dict) or not data:
+        parser.error('--data must be a non-empty JSON object')
+
+    if options.input == '-':
+        registration_ids = read_registration_ids(sys.stdin, options.format or 'lines', options.field)
+    else:
+        registration_ids = open_registration_ids(options.input, options.format, options.field)
+    kwargs = {'pool_size': max(4, options.workers)}
+    if options.url:
+        kwargs['url'] = options.url
+    journal = None
+    if not options.no_journal:
+        if not os.path.isdir(options.out):
+            os.makedirs(options.out)
+        journal = SendJournal(os.path.join(options.out, 'journal'))
+    gcm = GCM(options.api_key, **kwargs)
+    try:
+        writer = send_stream(gcm, registration_ids, options.out,
+                             data,
+                             options.collapse_key, options.delay_while_idle, options.time_to_live,
+                             options.attempts, options.deadline, options.workers, journal)
+    finally:
+        gcm.close()
+        if journal is not None:
+            journal.close()
+    print(' '.join('%s=%d' % (os.path.splitext(name)[0], writer.counts[status])
+                   for status, name in OutcomeWriter.FILES))
+
+
+if __name__ == '__main__':
+    main()
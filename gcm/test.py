@@ -1,8 +1,32 @@
 import unittest
 from gcm import *
 import json
-from mock import MagicMock
+from mock import MagicMock, patch
 import time
+import threading
+from mock_server import MockGCMServer
+from dispatch import MulticastDispatcher, Future
+from async_gcm import AsyncGCM
+from retry import MulticastRetrier, _RetryPool
+from metrics import MetricsCollector, Histogram
+from ratelimit import TokenBucket, ConcurrencyLimiter, AIMDController
+from breaker import CircuitBreaker
+from regstore import RegistrationStore
+from stream import main, read_registration_ids, send_stream
+from journal import SendJournal
+from sharded import ShardedSender, _init_worker, _send_chunk, _worker
+from delivery import DeliveryQueue
+from grouping import PayloadGrouper
+from dedup import DUPLICATE, Deduplicator
+from router import RoutedResult, SenderRouter
+from bench import import_time
+from jsoncodec import available_codecs, get_codec
+import pickle
+import urlparse
+import os
+import shutil
+import sys
+import tempfile
 
 
 # Helper method to return a different value for each call.
@@ -69,7 +93,8 @@ class GCMTest(unittest.TestCase):
                     {"error": "NotRegistered"}
             ]
         }
-        time.sleep = MagicMock()
+        self.addCleanup(patch.stopall)
+        patch('time.sleep').start()
 
     def test_construct_payload(self):
         res = self.gcm.construct_payload(
@@ -100,6 +125,52 @@ class GCMTest(unittest.TestCase):
         self.assertIn('data.param1', result)
         self.assertIn('data.param2', result)
 
+    def test_plaintext_payload_leaves_data_alone(self):
+        data = dict(self.data)
+        self.gcm.construct_payload(registration_ids='1234', data=data, is_json=False)
+        self.assertEqual(data, self.data)
+
+    def test_payload_template(self):
+        template = PayloadTemplate(self.data, collapse_key='foo', delay_while_idle=True, time_to_live=3600)
+        reg_ids = ['12', '145', '56']
+        self.assertEqual(json.loads(template.encode(reg_ids)),
+                         json.loads(self.gcm.construct_payload(reg_ids, self.data, 'foo', True, 3600)))
+        self.assertEqual(json.loads(PayloadTemplate().encode(reg_ids)), {'registration_ids': reg_ids})
+        self.assertIs(self.gcm.payload_template(template), template)
+
+        with self.assertRaises(GCMNoCollapseKeyException):
+            PayloadTemplate(self.data, time_to_live=3600)
+        with self.assertRaises(GCMInvalidTtlException):
+            PayloadTemplate(self.data, collapse_key='foo', time_to_live=-1)
+        with self.assertRaises(GCMException):
+            self.gcm.payload_template({})
+
+    def test_message_too_big(self):
+        data = {'small': 'x', 'big': 'y' * 3000, 'medium': 'z' * 1500}
+        self.gcm.make_request = MagicMock()
+        try:
+            self.gcm.request_json(registration_ids=['1'], data=data)
+        except GCMMessageTooBigException as e:
+            self.assertEqual([k for k, size in e.key_sizes], ['big', 'medium', 'small'])
+            self.assertIn('big (3009)', str(e))
+        else:
+            self.fail('expected GCMMessageTooBigException')
+        self.assertFalse(self.gcm.make_request.called)
+
+        with self.assertRaises(GCMMessageTooBigException):
+            self.gcm.request_plaintext(registration_id='1', data=data)
+        with self.assertRaises(GCMMessageTooBigException):
+            self.gcm.send_bulk(['1'], data)
+        self.assertFalse(self.gcm.make_request.called)
+
+    def test_data_size_counts_utf8_bytes(self):
+        template = PayloadTemplate({'msg': u'\u00e9' * 1000})
+        # separators differ between JSON codecs
+        self.assertEqual(template.data_size, len(template.codec.dumps({'msg': ''})) + 2000)
+        self.assertEqual(json.loads(template.encode(['1']))['data']['msg'], u'\u00e9' * 1000)
+        with self.assertRaises(GCMMessageTooBigException):
+            PayloadTemplate({'msg': u'\u00e9' * 1000}, max_data_bytes=1000)
+
     def test_limit_reg_ids(self):
         reg_ids = range(1003)
         self.assertTrue(len(reg_ids) > 1000)
@@ -212,5 +283,1416 @@ class GCMTest(unittest.TestCase):
         self.assertRaises(resp.get_canonical_ids([]))
         self.assertRaises(resp.get_resend_ids([]))
 
+    def test_json_wrapper_outcomes(self):
+        resp = GCM_response_wrapper(json.dumps(self.mock_results_mixed))
+        outcomes = list(resp.outcomes(self.mock_mixed_request_ids))
+        self.assertEqual(outcomes, [
+            ('4', GCM_response_wrapper.SUCCESS, None),
+            ('8', GCM_response_wrapper.RESEND, 'Unavailable'),
+            ('15', GCM_response_wrapper.UNREGISTER, 'InvalidRegistration'),
+            ('16', GCM_response_wrapper.SUCCESS, None),
+            ('23', GCM_response_wrapper.CANONICAL, '32'),
+            ('42', GCM_response_wrapper.UNREGISTER, 'NotRegistered'),
+        ])
+        self.assertEqual(resp.get_successes(self.mock_mixed_request_ids), ['4', '16', '23'])
+        self.assertEqual(resp.get_resend_ids(self.mock_mixed_request_ids), ['8'])
+        self.assertEqual(resp.get_canonical_ids(self.mock_mixed_request_ids), [('23', '32')])
+        # fewer ids than results: only the matching prefix is reported
+        self.assertEqual(resp.get_unregister_errors(['4', '8', '15']), ['15'])
+        self.assertEqual(resp.get_successes(['4', '8', '15', '16', '23']), ['4', '16', '23'])
+        self.assertEqual(resp.get_successes(['4', '8', '15', '16']), ['4', '16'])
+        self.assertEqual(resp.get_canonical_ids(['4', '8', '15', '16']), [])
+        self.assertEqual(len(list(resp.outcomes(['4', '8']))), 2)
+        self.assertEqual(resp.counts(), {'success': 2, 'canonical': 1, 'unregister': 2, 'resend': 1, 'error': 0})
+
+    def test_json_wrapper_is_compact(self):
+        resp = GCM_response_wrapper(json.dumps(self.mock_results_mixed))
+        self.assertFalse(hasattr(resp, '__dict__'))
+        self.assertFalse(hasattr(resp, 'my_json'))
+        other = GCM_response_wrapper(json.dumps(self.mock_results_mixed))
+        self.assertEqual(resp._errors, other._errors)
+        extras = [extra for reg_id, status, extra in other.outcomes(self.mock_mixed_request_ids)]
+        self.assertTrue(extras[5] is list(resp.outcomes(self.mock_mixed_request_ids))[5][2])
+
+        with patch('gcm.log') as log:
+            resp.get_successes(['4', '8'])
+            resp.get_resend_ids(['4', '8'])
+        self.assertEqual(log.warning.call_count, 1)
+
+    def test_send_bulk(self):
+        sent = []
+
+        def fake_request(payload, is_json=True):
+            batch = json.loads(payload)
+            self.assertEqual(batch['data'], self.data)
+            self.assertEqual(batch['collapse_key'], 'foo')
+            ids = batch['registration_ids']
+            sent.append(ids)
+            if len(sent) == 2:
+                raise GCMUnavailableException()
+            results = [{'message_id': '1'}] * (len(ids) - 3)
+            results += [{'error': 'Unavailable'}, {'error': 'NotRegistered'},
+                        {'message_id': '2', 'registration_id': 'new'}]
+            return json.dumps({'success': len(ids) - 2, 'failure': 2, 'canonical_ids': 1,
+                               'results': results})
+
+        self.gcm.make_request = MagicMock(side_effect=fake_request)
+        res = self.gcm.send_bulk((str(i) for i in xrange(2500)), self.data,
+                                 collapse_key='foo', time_to_live=60)
+
+        self.assertEqual([len(ids) for ids in sent], [1000, 1000, 500])
+        self.assertEqual(res.num_batches, 3)
+        self.assertEqual(len(res.successes), 998 + 498)
+        self.assertEqual(res.canonical_ids, [('999', 'new'), ('2499', 'new')])
+        self.assertEqual(res.unregister_errors, ['998', '2498'])
+        self.assertEqual(res.resend_ids, ['997'] + sent[1] + ['2497'])
+        self.assertTrue(res.has_resends())
+
+    def test_send_bulk_requires_ids(self):
+        with self.assertRaises(GCMMissingRegistrationException):
+            self.gcm.send_bulk(iter([]), self.data)
+
+    def test_json_codecs(self):
+        response = json.dumps(self.mock_results_mixed)
+        for codec in available_codecs():
+            gcm = GCM('123api', json_codec=codec)
+            payload = gcm.construct_payload(['1', '2'], {u'msg': u'caf\xe9 /'}, collapse_key='foo')
+            self.assertEqual(json.loads(payload), {'registration_ids': ['1', '2'], 'collapse_key': 'foo',
+                                                   'data': {'msg': u'caf\xe9 /'}})
+            res = gcm.wrap_response(response)
+            self.assertEqual(res.get_canonical_ids(self.mock_mixed_request_ids), [('23', '32')])
+            self.assertEqual(pickle.loads(pickle.dumps(codec)).name, codec.name)
+        self.assertEqual(get_codec('json').name, 'json')
+        with self.assertRaises(ValueError):
+            get_codec('yaml')
+
+    def test_import_without_django(self):
+        secs, modules = import_time(runs=1)
+        self.assertFalse([name for name in modules if name.split('.')[0] == 'django'])
+        self.assertEqual(smart_str(IOError(u'caf\xe9')), 'caf\xc3\xa9')
+        self.assertEqual(smart_str(u'\xe9'), '\xc3\xa9')
+
+
+class MulticastDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.gcm = GCM('123api')
+        self.data = {'param1': '1'}
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def fake_request_json(self, registration_ids, *args):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        threading.Event().wait(0.01)
+        with self.lock:
+            self.running -= 1
+        if registration_ids[0] == '1000':
+            raise GCMUnavailableException()
+        if registration_ids[0] == '2000':
+            raise GCMAuthenticationException()
+        return GCM_response_wrapper(json.dumps({
+            'success': len(registration_ids), 'failure': 0, 'canonical_ids': 0,
+            'results': [{'message_id': '1'}] * len(registration_ids)}))
+
+    def test_dispatch_order_and_failures(self):
+        self.gcm.request_json = self.fake_request_json
+        dispatcher = MulticastDispatcher(self.gcm, max_workers=4)
+        results = list(dispatcher.dispatch((str(i) for i in xrange(10500)), self.data))
+        dispatcher.shutdown()
+
+        self.assertEqual([r.index for r in results], range(11))
+        self.assertEqual([r.registration_ids[0] for r in results], [str(i * 1000) for i in range(11)])
+        self.assertTrue(results[1].is_retriable())
+        self.assertFalse(results[2].is_ok())
+        self.assertFalse(results[2].is_retriable())
+        self.assertEqual(len([r for r in results if r.is_ok()]), 9)
+        self.assertEqual(len(results[10].response.get_successes(results[10].registration_ids)), 500)
+        self.assertTrue(1 < self.max_running <= 4)
+
+    def test_cancel(self):
+        self.gcm.request_json = self.fake_request_json
+        dispatcher = MulticastDispatcher(self.gcm, max_workers=1, max_in_flight=3)
+        results = []
+        for result in dispatcher.dispatch((str(i) for i in xrange(100000)), self.data):
+            results.append(result)
+            dispatcher.cancel()
+        dispatcher.shutdown()
+        self.assertTrue(len(results) < 10)
+        self.assertTrue(any(isinstance(r.error, GCMCancelledException) for r in results))
+        # cancelling one dispatch leaves later ones alone
+        dispatcher = MulticastDispatcher(self.gcm, max_workers=1)
+        dispatcher.cancel()
+        self.assertEqual(len(list(dispatcher.dispatch((str(i) for i in xrange(2500)), self.data))), 3)
+        dispatcher.shutdown()
+
+    def test_dispatch_encodes_payload_once(self):
+        templates = []
+
+        def request_json(registration_ids, data, *args):
+            templates.append(data)
+            return self.fake_request_json(registration_ids, data)
+        self.gcm.request_json = request_json
+        template = self.gcm.payload_template(self.data)
+        dispatcher = MulticastDispatcher(self.gcm)
+        results = list(dispatcher.dispatch((str(i) for i in xrange(3000, 6000)), template))
+        dispatcher.shutdown()
+        self.assertTrue(all(r.is_ok() for r in results))
+        self.assertEqual(len(templates), 3)
+        self.assertTrue(all(t is template for t in templates))
+
+    def test_future(self):
+        future = Future()
+        self.assertTrue(future.cancel())
+        with self.assertRaises(GCMCancelledException):
+            future.result()
+        future = Future()
+        with self.assertRaises(GCMTimeoutException):
+            future.result(timeout=0.001)
+        done = []
+        future.add_done_callback(done.append)
+        future.set_result(3)
+        self.assertEqual(future.result(), 3)
+        self.assertEqual(done, [future])
+
+
+class MulticastRetrierTest(unittest.TestCase):
+    def setUp(self):
+        self.gcm = GCM('123api')
+        self.data = {'param1': '1'}
+        self.sent = []
+        self.sends = {}  # reg_id => times sent
+        self.addCleanup(patch.stopall)
+        patch('time.sleep').start()
+
+    def fake_request(self, payload, is_json=True):
+        """
+        every id ending in 7 is Unavailable on its first two sends; id '5' is not registered
+        """
+        ids = json.loads(payload)['registration_ids']
+        self.sent.append(ids)
+        results = []
+        for reg_id in ids:
+            self.sends[reg_id] = self.sends.get(reg_id, 0) + 1
+            if reg_id.endswith('7') and self.sends[reg_id] <= 2:
+                results.append({'error': 'Unavailable'})
+            elif reg_id == '5':
+                results.append({'error': 'NotRegistered'})
+            else:
+                results.append({'message_id': '1'})
+        return json.dumps({'success': 1, 'failure': 1, 'canonical_ids': 0, 'results': results})
+
+    def test_retry_pool_backs_off_late_ids(self):
+        pool = _RetryPool()
+        pool.add(['1'], 0)
+        # ids added once the pool is due still wait out their own backoff
+        pool.add(['2'], 60)
+        self.assertTrue(pool.ready_at > time.time() + 50)
+
+    def test_resends_merged_into_full_batches(self):
+        # long enough that no retry is due while the fresh batches are still going out,
+        # and without jitter so each round of retries is due after the previous one
+        self.gcm.backoff_delays = lambda: iter([600, 1200, 2400, 4800])
+        self.gcm.make_request = MagicMock(side_effect=self.fake_request)
+        res = MulticastRetrier(self.gcm).send((str(i) for i in xrange(25000)), self.data)
+
+        # 25 fresh batches, then the 2500 ids ending in 7 resent twice in batches of 1000
+        self.assertEqual([len(ids) for ids in self.sent], [1000] * 25 + [1000, 1000, 500] * 2)
+        self.assertEqual(len(res.successes), 24999)
+        self.assertEqual(res.unregister_errors, ['5'])
+        self.assertEqual(res.resend_ids, [])
+        # each retry round waits for its backoff
+        self.assertTrue(time.sleep.call_count >= 2)
+
+    def test_gives_up_after_max_attempts(self):
+        self.gcm.make_request = MagicMock(side_effect=self.fake_request)
+        res = MulticastRetrier(self.gcm, max_attempts=2).send([str(i) for i in xrange(20)], self.data)
+        self.assertEqual(sorted(res.resend_ids), ['17', '7'])
+        self.assertEqual(len(self.sent), 2)
+
+    def test_deadline(self):
+        self.gcm.make_request = MagicMock(side_effect=self.fake_request)
+        res = MulticastRetrier(self.gcm, deadline=0).send([str(i) for i in xrange(20)], self.data)
+        self.assertEqual(sorted(res.resend_ids), ['17', '7'])
+        self.assertEqual(len(self.sent), 1)
+
+    def test_retry_after_header(self):
+        error = GCMUnavailableException()
+        error.retry_after = 120
+        returns = [error, json.dumps({'success': 1, 'failure': 0, 'canonical_ids': 0,
+                                      'results': [{'message_id': '1'}]})]
+        self.gcm.make_request = MagicMock(side_effect=create_side_effect(returns))
+        res = MulticastRetrier(self.gcm).send(['1'], self.data)
+        self.assertEqual(res.successes, ['1'])
+        self.assertTrue(time.sleep.call_args[0][0] > 100)
+
+    def test_concurrent_workers(self):
+        self.gcm.make_request = MagicMock(side_effect=self.fake_request)
+        res = MulticastRetrier(self.gcm, max_workers=4).send((str(i) for i in xrange(5000)), self.data)
+        self.assertEqual(len(res.successes), 4999)
+        self.assertEqual(res.resend_ids, [])
+
+    def test_fatal_error(self):
+        self.gcm.make_request = MagicMock(side_effect=GCMAuthenticationException())
+        with self.assertRaises(GCMAuthenticationException):
+            MulticastRetrier(self.gcm).send(['1'], self.data)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('30'), 30)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+
+
+class GCMTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockGCMServer().start()
+        self.gcm = GCM('123api', url=self.server.url)
+        self.data = {'param1': '1'}
+
+    def tearDown(self):
+        self.gcm.close()
+        self.server.stop()
+
+    def test_keep_alive_reuses_connection(self):
+        for i in range(5):
+            self.gcm.request_plaintext(registration_id='1234', data=dict(self.data))
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.gcm.pool.num_connections, 1)
+        self.assertEqual(len(self.server.connections), 1)
+        headers, body = self.server.requests[0]
+        self.assertEqual(headers.getheader('authorization'), 'key=123api')
+        self.assertIn('data.param1=1', body)
+
+    def test_max_requests_per_connection(self):
+        gcm = GCM('123api', url=self.server.url, max_requests_per_connection=2)
+        for i in range(5):
+            gcm.request_plaintext(registration_id='1234', data=dict(self.data))
+        self.assertEqual(gcm.pool.num_connections, 3)
+
+    def test_idle_timeout(self):
+        gcm = GCM('123api', url=self.server.url, idle_timeout=0)
+        gcm.request_plaintext(registration_id='1234', data=dict(self.data))
+        gcm.pool._idle[0].last_used -= 1
+        gcm.request_plaintext(registration_id='1234', data=dict(self.data))
+        self.assertEqual(gcm.pool.num_connections, 2)
+
+    def test_reconnects_dead_socket(self):
+        self.gcm.request_plaintext(registration_id='1234', data=dict(self.data))
+        # simulate the server dropping the kept-alive socket
+        self.gcm.pool._idle[0].connection.sock.close()
+        self.gcm.request_plaintext(registration_id='1234', data=dict(self.data))
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.gcm.pool.num_connections, 2)
+
+    def test_http_error_mapping(self):
+        self.server.replies = [(400, ''), (401, ''), (500, ''), (503, ''), (404, '')]
+        reg_ids = ['1', '2']
+        for exc in [GCMMalformedJsonException, GCMAuthenticationException,
+                    GCMUnavailableException, GCMUnavailableException, GCMConnectionException]:
+            with self.assertRaises(exc):
+                self.gcm.request_json(registration_ids=reg_ids, data=self.data)
+
+    def test_retry_after(self):
+        self.server.replies = [(503, '')]
+        self.server.extra_headers = [('Retry-After', '7')]
+        try:
+            self.gcm.request_json(registration_ids=['1'], data=self.data)
+        except GCMUnavailableException as e:
+            self.assertEqual(e.retry_after, 7)
+        else:
+            self.fail('expected GCMUnavailableException')
+
+    def test_gzip(self):
+        self.server.gzip_responses = True
+        gcm = GCM('123api', url=self.server.url, compress=True)
+        reg_ids = ['registration-id-%d' % i for i in range(1000)]
+        res = gcm.request_json(reg_ids, self.data)
+        self.assertEqual(len(res.get_successes(reg_ids)), 1000)
+        headers, body = self.server.requests[0]
+        self.assertEqual(headers.getheader('content-encoding'), 'gzip')
+        self.assertEqual(headers.getheader('accept-encoding'), 'gzip')
+        self.assertEqual(json.loads(body)['registration_ids'], reg_ids)
+        self.assertTrue(gcm.pool.bytes_sent < len(body) / 4)
+        self.assertTrue(gcm.pool.bytes_received < len(self.server.json_reply(reg_ids)) / 2)
+        # gunzipped as read, over many reads
+        with patch('transport.READ_CHUNK_SIZE', 64):
+            self.assertEqual(gcm.request_json(reg_ids, self.data).get_successes(reg_ids), reg_ids)
+        # small bodies are not worth compressing
+        gcm.request_plaintext('1', self.data)
+        self.assertEqual(self.server.requests[2][0].getheader('content-encoding'), None)
+        gcm.close()
+
+    def test_gzip_rejected(self):
+        self.server.accept_gzip = False
+        gcm = GCM('123api', url=self.server.url, compress=True)
+        reg_ids = ['registration-id-%d' % i for i in range(1000)]
+        for i in range(2):
+            self.assertEqual(len(gcm.request_json(reg_ids, self.data).get_successes(reg_ids)), 1000)
+        self.assertFalse(gcm.pool.compress)
+        self.assertEqual([headers.getheader('content-encoding') for headers, body in self.server.requests],
+                         ['gzip', None, None])
+        gcm.close()
+
+    def test_connection_refused(self):
+        self.server.stop()
+        with self.assertRaises(GCMConnectionException):
+            self.gcm.request_json(registration_ids=['1'], data=self.data)
+        self.server = MockGCMServer().start()
+
+
+class AsyncGCMTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockGCMServer().start()
+        self.gcm = AsyncGCM('123api', max_concurrency=4, url=self.server.url)
+        self.gcm.BACKOFF_INITIAL_DELAY_MS = 2
+        self.data = {'param1': '1'}
+
+    def tearDown(self):
+        self.gcm.close()
+        self.server.stop()
+
+    def test_request_json(self):
+        future = self.gcm.request_json(['1', '2'], self.data)
+        res = future.result(timeout=5)
+        self.assertEqual(res.get_successes(['1', '2']), ['1', '2'])
+
+    def test_plaintext_retry_does_not_block(self):
+        self.server.replies = [(503, ''), (503, ''), (200, 'id=1\nregistration_id=99')]
+        future = self.gcm.request_plaintext('1234', self.data)
+        self.assertEqual(future.result(timeout=5), '99')
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.data, {'param1': '1'})
+
+    def test_plaintext_retries_exhausted(self):
+        self.server.replies = [(503, '')] * 2
+        future = self.gcm.request_plaintext('1234', self.data, tries=2)
+        self.assertIsInstance(future.exception(timeout=5), IOError)
+
+    def test_plaintext_no_retry_error(self):
+        self.server.replies = [(200, 'Error=NotRegistered')]
+        future = self.gcm.request_plaintext('1234', self.data)
+        self.assertIsInstance(future.exception(timeout=5), GCMNotRegisteredException)
+
+    def test_send_bulk(self):
+        self.server.replies = [(503, '')]
+        future = self.gcm.send_bulk((str(i) for i in xrange(5500)), self.data)
+        res = future.result(timeout=10)
+        self.assertEqual(res.num_batches, 6)
+        self.assertEqual(len(res.successes) + len(res.resend_ids), 5500)
+        self.assertEqual(len(res.resend_ids), 1000)
+
+    def test_send_bulk_fatal(self):
+        self.server.replies = [(401, '')]
+        future = self.gcm.send_bulk(['1', '2'], self.data)
+        self.assertIsInstance(future.exception(timeout=5), GCMAuthenticationException)
+
+    def test_plaintext_batch(self):
+        self.server.canonical_rate = 0.2
+        self.server.not_registered_rate = 0.2
+        self.server.unavailable_rate = 0.2
+        messages = [(str(i), {'n': str(i)}) for i in range(50)] + [('', {'n': 'x'}), ('big', {'n': 'x' * 5000})]
+        results = self.gcm.request_plaintext_batch(iter(messages), tries=10).result(timeout=10)
+        self.assertEqual([r.registration_id for r in results], [m[0] for m in messages])
+        self.assertIsInstance(results[-2].error, GCMMissingRegistrationException)
+        self.assertIsInstance(results[-1].error, GCMMessageTooBigException)
+        results = results[:-2]
+        errors = [r.error for r in results if not r.is_ok()]
+        self.assertTrue(errors)
+        self.assertTrue(all(isinstance(e, GCMNotRegisteredException) for e in errors))
+        self.assertTrue([r for r in results if r.canonical_id and r.canonical_id.startswith('canonical-')])
+        # every device got its own data, retried ones included
+        sent = set(body for headers, body in self.server.requests)
+        self.assertTrue(all('data.n=%s' % i in ' '.join(sent) for i in range(50)))
+
+    def test_plaintext_batch_retries_independently(self):
+        # the first two sends are Unavailable; the other devices go out while those wait
+        self.gcm.BACKOFF_INITIAL_DELAY_MS = 200
+        self.server.replies = [(200, 'Error=Unavailable'), (200, 'Error=Unavailable')]
+        future = self.gcm.request_plaintext_batch([(str(i), self.data) for i in range(10)])
+        results = future.result(timeout=10)
+        self.assertTrue(all(r.is_ok() for r in results))
+        sent = [urlparse.parse_qs(body)['registration_id'][0] for headers, body in self.server.requests]
+        self.assertEqual(len(sent), 12)
+        self.assertEqual(sorted(set(sent[:10])), [str(i) for i in range(10)])
+
+    def test_plaintext_batch_auth_error(self):
+        self.server.replies = [(401, '')] * 20
+        future = self.gcm.request_plaintext_batch([(str(i), self.data) for i in range(10)])
+        self.assertIsInstance(future.exception(timeout=5), GCMAuthenticationException)
+
+    def test_plaintext_batch_of_failures(self):
+        # each failing at once, without a request; none may recurse
+        results = self.gcm.request_plaintext_batch(('', self.data) for i in xrange(3000)).result(timeout=10)
+        self.assertEqual(len(results), 3000)
+        self.assertTrue(all(isinstance(r.error, GCMMissingRegistrationException) for r in results))
+
+    def test_plaintext_registration_store(self):
+        store = RegistrationStore()
+        store.record_canonical('old', 'new')
+        store.record_unregistered('dead')
+        self.gcm.registration_store = store
+        self.assertEqual(self.gcm.request_plaintext('old', self.data).result(timeout=5), 'new')
+        self.assertIsInstance(self.gcm.request_plaintext('dead', self.data).exception(timeout=5),
+                              GCMNotRegisteredException)
+        self.server.replies = [(200, 'id=1\nregistration_id=newer')]
+        results = self.gcm.request_plaintext_batch([('new', self.data), ('dead', self.data)]).result(timeout=5)
+        self.assertEqual(results[0].canonical_id, 'newer')
+        self.assertIsInstance(results[1].error, GCMNotRegisteredException)
+        self.assertEqual(store.lookup('old'), 'newer')
+        sent = [urlparse.parse_qs(body)['registration_id'][0] for headers, body in self.server.requests]
+        self.assertEqual(sent, ['new', 'new'])
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockGCMServer().start()
+        self.metrics = MetricsCollector()
+        self.gcm = GCM('123api', url=self.server.url, listener=self.metrics)
+        self.addCleanup(patch.stopall)
+        patch('time.sleep').start()
+
+    def tearDown(self):
+        self.gcm.close()
+        self.server.stop()
+
+    def test_send_path_events(self):
+        self.server.replies = [(503, ''), (200, 'id=1'), (200, json.dumps({
+            'success': 1, 'failure': 1, 'canonical_ids': 1,
+            'results': [{'message_id': '1', 'registration_id': '9'}, {'error': 'NotRegistered'}]}))]
+        self.gcm.request_plaintext('1234', {'param1': '1'})
+        self.gcm.request_json(['1', '2'], {'param1': '1'})
+
+        values = self.metrics.snapshot()
+        self.assertEqual(values['requests'], 3)
+        self.assertEqual(values['request_bytes'], sum(len(body) for headers, body in self.server.requests))
+        self.assertEqual(values['status_503'], 1)
+        self.assertEqual(values['status_200'], 2)
+        self.assertEqual(values['errors'], 1)
+        self.assertEqual(values['retries'], 1)
+        self.assertEqual(values['retry_delay_count'], 1)
+        self.assertEqual(values['request_latency_count'], 3)
+        self.assertEqual(values['result_canonical'], 1)
+        self.assertEqual(values['result_unregister'], 1)
+        self.assertEqual(values['result_success'], 0)
+
+    def test_connection_error_has_no_status(self):
+        self.server.stop()
+        with self.assertRaises(GCMConnectionException):
+            self.gcm.request_json(['1'], {'param1': '1'})
+        self.server = MockGCMServer().start()
+        self.assertEqual(self.metrics.snapshot()['errors'], 1)
+        self.assertNotIn('status_200', self.metrics.snapshot())
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in [0.001] * 98 + [0.3, 100]:
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(50), 0.001)
+        self.assertEqual(histogram.percentile(99), 0.5)
+        self.assertEqual(histogram.percentile(100), 120)
+        self.assertEqual(histogram.count, 100)
+
+
+class RateLimitTest(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(100, burst=5)
+        for i in range(5):
+            self.assertTrue(bucket.acquire(timeout=0))
+        self.assertFalse(bucket.acquire(timeout=0))
+        start = time.time()
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(0.005 < time.time() - start < 0.5)
+
+    def test_concurrency_limiter(self):
+        limiter = ConcurrencyLimiter(2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire(timeout=0.01))
+        limiter.set_limit(3)
+        self.assertTrue(limiter.acquire(timeout=0))
+        limiter.release()
+        self.assertEqual(limiter.active, 2)
+
+    def test_requests_pass_limiter(self):
+        server = MockGCMServer().start()
+        limiter = ConcurrencyLimiter(1)
+        try:
+            gcm = GCM('123api', url=server.url, limiter=limiter)
+            gcm.request_json(['1'], {'param1': '1'})
+            server.replies = [(401, '')]
+            with self.assertRaises(GCMAuthenticationException):
+                gcm.request_json(['1'], {'param1': '1'})
+            self.assertEqual(limiter.active, 0)
+        finally:
+            server.stop()
+
+    def test_aimd(self):
+        bucket = TokenBucket(100)
+        controller = AIMDController(bucket, min_limit=10, max_limit=102, cooldown=60)
+        controller.results({GCM_response_wrapper.SUCCESS: 99, GCM_response_wrapper.RESEND: 1})
+        controller.results({GCM_response_wrapper.SUCCESS: 99, GCM_response_wrapper.RESEND: 1})
+        controller.results({GCM_response_wrapper.SUCCESS: 1000})
+        self.assertEqual(bucket.limit, 102)
+        controller.results({GCM_response_wrapper.SUCCESS: 50, GCM_response_wrapper.RESEND: 50})
+        self.assertEqual(bucket.limit, 51)
+        # within the cooldown further bad news is ignored
+        controller.request_end(True, 503, 0.1, GCMUnavailableException())
+        self.assertEqual(bucket.limit, 51)
+        controller._last_decrease = 0
+        controller.request_end(True, 503, 0.1, GCMUnavailableException())
+        self.assertEqual(bucket.limit, 25.5)
+        controller._last_decrease = 0
+        controller.request_end(True, 500, 0.1, GCMUnavailableException())
+        self.assertEqual(bucket.limit, 12.75)
+        controller._last_decrease = 0
+        controller.congested()
+        self.assertEqual(bucket.limit, 10)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockGCMServer().start()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        self.gcm = GCM('123api', url=self.server.url, breaker=self.breaker)
+        self.data = {'param1': '1'}
+        self.addCleanup(patch.stopall)
+        patch('time.sleep').start()
+
+    def tearDown(self):
+        self.gcm.close()
+        self.server.stop()
+
+    def test_opens_and_fails_fast(self):
+        self.server.replies = [(503, ''), (200, 'id=1'), (503, ''), (401, ''), (503, '')]
+        self.gcm.request_plaintext('1234', self.data)
+        with self.assertRaises(GCMUnavailableException):
+            self.gcm.request_json(['1'], self.data)
+        with self.assertRaises(GCMAuthenticationException):
+            self.gcm.request_json(['1'], self.data)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        with self.assertRaises(GCMUnavailableException):
+            self.gcm.request_json(['1'], self.data)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        # the plaintext retry loop gives up at once instead of backing off
+        with self.assertRaises(GCMCircuitOpenException) as cm:
+            self.gcm.request_plaintext('1234', self.data)
+        self.assertTrue(50 < cm.exception.retry_after <= 60)
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_half_open_probe(self):
+        self.server.replies = [(503, '')] * 4
+        for i in range(3):
+            with self.assertRaises(GCMUnavailableException):
+                self.gcm.request_json(['1'], self.data)
+        self.breaker._opened_at -= 61
+        # failed probe reopens the circuit
+        with self.assertRaises(GCMUnavailableException):
+            self.gcm.request_json(['1'], self.data)
+        with self.assertRaises(GCMCircuitOpenException):
+            self.gcm.request_json(['1'], self.data)
+        self.breaker._opened_at -= 61
+        self.assertTrue(self.breaker.available())
+        self.assertTrue(self.breaker.allow())
+        # the probe is taken
+        self.assertFalse(self.breaker.available())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.gcm.request_json(['1'], self.data)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_malformed_request_is_not_an_outage(self):
+        self.server.replies = [(400, '')] * 5
+        for i in range(5):
+            with self.assertRaises(GCMMalformedJsonException):
+                self.gcm.request_json(['1'], self.data)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_shared_per_api_key(self):
+        self.assertIs(CircuitBreaker.shared('key-a'), CircuitBreaker.shared('key-a'))
+        self.assertIsNot(CircuitBreaker.shared('key-a'), CircuitBreaker.shared('key-b'))
+
+
+class MockGCMServerTest(unittest.TestCase):
+    def test_result_rates(self):
+        server = MockGCMServer(unavailable_rate=0.5, canonical_rate=0.5, seed=3).start()
+        try:
+            gcm = GCM('123api', url=server.url)
+            reg_ids = [str(i) for i in range(1000)]
+            res = gcm.request_json(reg_ids, {'param1': '1'})
+            resends = res.get_resend_ids(reg_ids)
+            canonical = res.get_canonical_ids(reg_ids)
+            self.assertTrue(400 < len(resends) < 600)
+            self.assertEqual(len(resends) + len(canonical), 1000)
+            self.assertFalse(res.get_unregister_errors(reg_ids))
+        finally:
+            server.stop()
+
+    def test_5xx_rate(self):
+        server = MockGCMServer(error_5xx_rate=1, retry_after=3).start()
+        try:
+            with self.assertRaises(GCMUnavailableException):
+                GCM('123api', url=server.url).request_json(['1'], {'param1': '1'})
+        finally:
+            server.stop()
+
+
+class RegistrationStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'regs')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lookup_and_apply(self):
+        store = RegistrationStore()
+        store.record_canonical('old', 'new')
+        store.record_unregistered('dead')
+        self.assertEqual(store.lookup('old'), 'new')
+        self.assertEqual(store.lookup('dead'), None)
+        self.assertEqual(store.lookup('other'), 'other')
+        self.assertEqual(list(store.apply(['a', 'old', 'dead', 'b'])), ['a', 'new', 'b'])
+        # chains are followed to their end
+        store.record_canonical('new', 'newer')
+        store.record_canonical('older', 'old')
+        self.assertEqual(store.lookup('older'), 'newer')
+        store.record_unregistered('newer')
+        self.assertEqual(list(store.apply(['older', 'a'])), ['a'])
+        store.record_canonical('x', 'y')
+        store.record_canonical('y', 'x')
+        self.assertTrue(store.lookup('x') in ('x', 'y'))
+
+    def test_interned_canonical_ids(self):
+        store = RegistrationStore(max_entries=3)
+        for i in range(3):
+            store.record_canonical(str(i), 'new')
+        self.assertEqual(store._canonical_ids, ['new'])
+        store.record_unregistered('3')
+        store.record_unregistered('4')
+        store.record_unregistered('5')
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store._canonical_index, {})
+
+    def test_lru_eviction_and_ttl(self):
+        store = RegistrationStore(max_entries=2)
+        store.record_unregistered('1')
+        store.record_unregistered('2')
+        store.lookup('1')
+        store.record_unregistered('3')
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.lookup('2'), '2')
+        self.assertEqual(store.lookup('1'), None)
+
+        store = RegistrationStore(ttl=-1)
+        store.record_unregistered('1')
+        self.assertEqual(store.lookup('1'), '1')
+        self.assertEqual(len(store), 0)
+
+    def test_persistence(self):
+        store = RegistrationStore(path=self.path)
+        store.record_canonical('old', 'new')
+        store.record_unregistered('dead')
+        store.record_canonical('dead', 'revived')
+        store.close()
+        with open(self.path, 'a') as f:
+            f.write('torn')
+
+        store = RegistrationStore(path=self.path)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.lookup('old'), 'new')
+        self.assertEqual(store.lookup('dead'), 'revived')
+        store.compact()
+        store.close()
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_flush_callback(self):
+        flushed = []
+        store = RegistrationStore(flush_callback=flushed.append, flush_size=2)
+        for i in range(3):
+            store.record_unregistered(str(i))
+        self.assertEqual(flushed, [[('0', None), ('1', None)]])
+        store.flush()
+        self.assertEqual(flushed[1], [('2', None)])
+
+    def test_flush_callback_failure(self):
+        flushed = []
+        def callback(changes):
+            # not under the store's lock, so it may look ids up
+            self.assertEqual(store.lookup(changes[0][0]), None)
+            if not flushed:
+                flushed.append(None)
+                raise IOError('database down')
+            flushed.append(changes)
+        store = RegistrationStore(flush_callback=callback, flush_size=2)
+        self.addCleanup(patch.stopall)
+        patch('regstore.log').start()
+        store.record_unregistered('0')
+        store.record_unregistered('1')
+        # kept for the next flush
+        self.assertEqual(store._pending, [('0', None), ('1', None)])
+        store.record_unregistered('2')
+        store.record_unregistered('3')
+        self.assertEqual(flushed[1:], [[('0', None), ('1', None)], [('2', None)]])
+        store.flush()
+        self.assertEqual(flushed[3:], [[('3', None)]])
+        self.assertEqual(store._pending, [])
+
+    def test_send_bulk(self):
+        server = MockGCMServer(not_registered_rate=0.5, canonical_rate=0.5, seed=5).start()
+        try:
+            store = RegistrationStore()
+            gcm = GCM('123api', url=server.url, registration_store=store)
+            reg_ids = [str(i) for i in range(100)]
+            gcm.send_bulk(reg_ids, {'param1': '1'})
+            self.assertEqual(len(store), 100)
+
+            dead = [reg_id for reg_id in reg_ids if store.lookup(reg_id) is None]
+            gcm.send_bulk(reg_ids, {'param1': '1'})
+            sent = json.loads(server.requests[-1][1])['registration_ids']
+            self.assertEqual(len(sent), 100 - len(dead))
+            self.assertTrue(all(reg_id.startswith('canonical-') for reg_id in sent))
+
+            with self.assertRaises(GCMNotRegisteredException):
+                gcm.request_plaintext(dead[0], {'param1': '1'})
+            self.assertEqual(len(server.requests), 2)
+        finally:
+            server.stop()
+
+    def test_outcomes_under_ids_given(self):
+        server = MockGCMServer().start()
+        try:
+            store = RegistrationStore()
+            store.record_canonical('old', 'new')
+            store.record_unregistered('dead')
+            gcm = GCM('123api', url=server.url, registration_store=store)
+            result = gcm.send_bulk(['old', 'dead', 'x'], {'param1': '1'})
+            self.assertEqual(json.loads(server.requests[-1][1])['registration_ids'], ['new', 'x'])
+            self.assertEqual(result.successes, ['old', 'x'])
+            self.assertEqual(result.canonical_ids, [('old', 'new')])
+            self.assertEqual(result.unregister_errors, ['dead'])
+
+            server.unavailable_rate = 1.0
+            gcm.backoff_delays = lambda: iter([0, 0])
+            result = MulticastRetrier(gcm, max_attempts=2).send(['old', 'dead', 'x'], {'param1': '1'})
+            self.assertEqual(result.resend_ids, ['old', 'x'])
+            self.assertEqual(result.unregister_errors, ['dead'])
+
+            dispatcher = MulticastDispatcher(gcm, max_workers=1)
+            result = GCM_bulk_result()
+            batch, = dispatcher.dispatch(['old', 'dead', 'x'], {'param1': '1'}, result=result)
+            dispatcher.shutdown()
+            self.assertEqual((batch.registration_ids, batch.given_ids), (['new', 'x'], ['old', 'x']))
+            self.assertEqual(result.unregister_errors, ['dead'])
+        finally:
+            server.stop()
+
+class StreamTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_read_registration_ids(self):
+        self.assertEqual(list(read_registration_ids(['1\n', '\n', ' 2\n'])), ['1', '2'])
+        self.assertEqual(list(read_registration_ids(['"1"\n', '{"registration_id": "2"}\n', '{}\n'], 'jsonl')),
+                         ['1', '2'])
+        self.assertEqual(list(read_registration_ids(['{"token": "3"}'], 'jsonl', 'token')), ['3'])
+        self.assertEqual(list(read_registration_ids(['a,b\n', '1,2\n', '3,\n'], 'csv', 'b')), ['2'])
+        self.assertEqual(list(read_registration_ids(['1,2\n', '3,4\n'], 'csv', '1')), ['2', '4'])
+        # the header row is never taken for an id
+        self.assertEqual(list(read_registration_ids(['registration_id\n', '1\n', '2\n'], 'csv')), ['1', '2'])
+        with self.assertRaises(GCMException):
+            list(read_registration_ids(['1\n', '2\n'], 'csv'))
+        with self.assertRaises(GCMException):
+            list(read_registration_ids(['a,b\n'], 'csv', 'c'))
+
+    def test_cli_needs_data(self):
+        for data in (None, '[1]', '{'):
+            argv = ['--api-key', 'k', '--input', 'ids.txt', '--out', self.dir]
+            if data is not None:
+                argv += ['--data', data]
+            with patch('sys.stderr'):
+                with self.assertRaises(SystemExit):
+                    main(argv)
+
+    def test_send_stream(self):
+        server = MockGCMServer(unavailable_rate=0.2, canonical_rate=0.1, not_registered_rate=0.1, seed=2).start()
+        try:
+            gcm = GCM('123api', url=server.url)
+            gcm.backoff_delays = lambda: iter([0, 0])
+            writer = send_stream(gcm, (str(i) for i in xrange(2500)), self.dir, {'param1': '1'},
+                                 max_attempts=2)
+            self.assertEqual(sum(writer.counts.values()), 2500)
+            self.assertEqual(writer.successes, [])
+            lines = {}
+            for name in os.listdir(self.dir):
+                with open(os.path.join(self.dir, name)) as f:
+                    lines[name] = f.read().splitlines()
+            self.assertEqual(len(lines['failed.tsv']), writer.counts['error'])
+            self.assertTrue(all(line.endswith('\tUnavailable') for line in lines['failed.tsv']))
+            self.assertTrue(all(line.endswith('\tNotRegistered') for line in lines['unregister.tsv']))
+            self.assertEqual(len(lines['canonical.tsv'][0].split('\t')), 2)
+            self.assertEqual(sorted(sum(([line.split('\t')[0] for line in v] for v in lines.values()), [])),
+                             sorted(str(i) for i in xrange(2500)))
+        finally:
+            server.stop()
+
+    def test_send_stream_with_store(self):
+        server = MockGCMServer().start()
+        try:
+            store = RegistrationStore()
+            store.record_canonical('old', 'new')
+            store.record_unregistered('dead')
+            gcm = GCM('123api', url=server.url, registration_store=store)
+            journal = SendJournal(os.path.join(self.dir, 'journal'))
+            writer = send_stream(gcm, ['old', 'dead', 'x'], os.path.join(self.dir, 'out'), {'param1': '1'},
+                                 journal=journal)
+            lines = {}
+            for name in os.listdir(writer.directory):
+                with open(os.path.join(writer.directory, name)) as f:
+                    lines[name] = f.read()
+            self.assertEqual(lines['success.txt'], 'x\n')
+            self.assertEqual(lines['canonical.tsv'], 'old\tnew\n')
+            self.assertEqual(lines['unregister.tsv'], 'dead\tNotRegistered\n')
+            self.assertEqual(SendJournal(journal.path).watermark, 3)
+        finally:
+            server.stop()
+
+class SendJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+        self.server = MockGCMServer().start()
+        self.gcm = GCM('123api', url=self.server.url)
+        self.gcm.backoff_delays = lambda: iter([0, 0])
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def sent_ids(self):
+        return [reg_id for headers, body in self.server.requests
+                for reg_id in json.loads(body)['registration_ids']]
+
+    def test_resume_after_fatal_error(self):
+        reg_ids = [str(i) for i in xrange(3500)]
+        self.server.replies = [(200, self.server.json_reply(reg_ids[:1000])),
+                               (200, self.server.json_reply(reg_ids[1000:2000])),
+                               (401, '')]
+        journal = SendJournal(self.path)
+        with self.assertRaises(GCMAuthenticationException):
+            send_stream(self.gcm, iter(reg_ids), self.dir, {'param1': '1'}, journal=journal)
+        journal.close()
+
+        journal = SendJournal(self.path)
+        self.assertEqual(journal.watermark, 2000)
+        writer = send_stream(self.gcm, iter(reg_ids), self.dir, {'param1': '1'}, journal=journal)
+        journal.close()
+        self.assertEqual(writer.counts['success'], 1500)
+        # the batch that hit the 401 is sent again, the two acknowledged before it are not
+        self.assertTrue(self.sent_ids() == reg_ids[:3000] + reg_ids[2000:])
+        with open(os.path.join(self.dir, 'success.txt')) as f:
+            self.assertEqual(f.read().split(), reg_ids)
+        self.assertEqual(SendJournal(self.path).watermark, 3500)
+
+    def test_requeue_given_up_ids(self):
+        self.server.unavailable_rate = 0.3
+        journal = SendJournal(self.path)
+        writer = send_stream(self.gcm, (str(i) for i in xrange(100)), self.dir, {'param1': '1'},
+                             max_attempts=1, journal=journal)
+        journal.close()
+        failed = writer.counts['error']
+        self.assertTrue(failed > 0)
+
+        self.server.unavailable_rate = 0
+        del self.server.requests[:]
+        journal = SendJournal(self.path)
+        writer = send_stream(self.gcm, (str(i) for i in xrange(100)), self.dir, {'param1': '1'}, journal=journal)
+        journal.close()
+        self.assertEqual(writer.counts['success'], failed)
+        self.assertEqual(len(self.sent_ids()), failed)
+
+    def test_unsynced_outcomes_are_resent(self):
+        journal = SendJournal(self.path, sync_every=10 ** 6, sync_interval=10 ** 6)
+        for reg_id in journal.resume(['a', 'b', 'c', 'b']):
+            journal.acknowledge(reg_id)
+            if reg_id == 'c':
+                journal.sync()
+                synced = os.path.getsize(self.path)
+        journal.close()
+        # the process died before the last 'b' was synced
+        with open(self.path, 'r+') as f:
+            f.truncate(synced)
+        journal = SendJournal(self.path)
+        self.assertEqual(journal.watermark, 3)
+        self.assertEqual(list(journal.resume(['a', 'b', 'c', 'b'])), ['b'])
+
+    def test_given_up_id_resent_once(self):
+        journal = SendJournal(self.path)
+        sent = journal.resume(['a', 'b', 'c', 'd'])
+        self.assertEqual(list(sent), ['a', 'b', 'c', 'd'])
+        journal.give_up('c')
+        journal.acknowledge('d')
+        journal.sync()
+        # crash with 'a' and 'b' in flight
+        journal = SendJournal(self.path)
+        self.assertEqual(list(journal.resume(['a', 'b', 'c', 'd'])), ['c', 'a', 'b'])
+
+    def test_filtered_ids_acknowledged(self):
+        store = RegistrationStore()
+        store.record_canonical('a', 'b')
+        store.lookup = MagicMock(wraps=store.lookup)
+        self.gcm.registration_store = store
+        self.gcm.deduplicator = Deduplicator()
+        journal = SendJournal(self.path)
+        writer = send_stream(self.gcm, ['a', 'b', 'c'], self.dir, {'param1': '1'}, journal=journal)
+        journal.close()
+        # looked up once each; 'b' is sent once and every position is final
+        self.assertEqual(store.lookup.call_count, 3)
+        self.assertEqual(self.sent_ids(), ['b', 'c'])
+        self.assertEqual([writer.counts[status] for status in ('success', 'canonical', DUPLICATE)], [1, 1, 1])
+        with open(os.path.join(self.dir, 'canonical.tsv')) as f:
+            self.assertEqual(f.read(), 'a\tb\n')
+        self.assertEqual(SendJournal(self.path).watermark, 3)
+
+class ShardedSenderTest(unittest.TestCase):
+    def test_send(self):
+        server = MockGCMServer(unavailable_rate=0.1, canonical_rate=0.1, not_registered_rate=0.1, seed=4).start()
+        # the workers fork with it
+        self.addCleanup(patch.stopall)
+        patch.object(GCM, 'BACKOFF_INITIAL_DELAY_MS', 10).start()
+        try:
+            metrics = MetricsCollector()
+            sender = ShardedSender('123api', processes=2, chunk_size=1500, metrics=metrics, url=server.url)
+            res = sender.send((str(i) for i in xrange(5000)), {'param1': '1'})
+            self.assertEqual(len(res.successes) + len(res.unregister_errors) + len(res.resend_ids), 5000)
+            self.assertTrue(res.canonical_ids)
+            self.assertTrue(res.num_batches >= 6)
+            self.assertEqual(metrics.counters['requests'], len(server.requests))
+            self.assertEqual(metrics.histograms['request_latency'].count, len(server.requests))
+            self.assertEqual(metrics.counters['result_unregister'], len(res.unregister_errors))
+        finally:
+            server.stop()
+
+    def test_fatal_error(self):
+        server = MockGCMServer().start()
+        server.replies = [(401, '')] * 10
+        try:
+            with self.assertRaises(GCMAuthenticationException):
+                ShardedSender('123api', processes=2, url=server.url).send(['1', '2'], {'param1': '1'})
+        finally:
+            server.stop()
+
+    def test_template_uses_json_codec(self):
+        codec = get_codec('json')
+        self.addCleanup(patch.stopall)
+        gcm = patch('sharded.GCM').start()
+        pool = patch('sharded.multiprocessing.Pool').start()
+        pool.return_value.apply_async.return_value.get.return_value = (1, [('1', 'success', None)], None)
+        res = ShardedSender('123api', processes=1, json_codec=codec).send(['1'], {'param1': '1'})
+        self.assertEqual(res.successes, ['1'])
+        self.assertFalse(gcm.called)
+        self.assertIs(pool.call_args[0][2][2].codec, codec)
+
+    def test_worker_keeps_listener(self):
+        server = MockGCMServer().start()
+        self.addCleanup(_worker.clear)
+        try:
+            listener = MetricsCollector()
+            template = PayloadTemplate({'param1': '1'})
+            _init_worker('123api', {'url': server.url, 'listener': listener}, template, 1, None, 1, True)
+            num_batches, outcomes, metrics = _send_chunk(['1', '2'])
+            self.assertEqual(num_batches, 1)
+            self.assertEqual(metrics.counters['requests'], 1)
+            self.assertEqual(listener.counters['requests'], 1)
+            _worker['gcm'].close()
+        finally:
+            server.stop()
+
+class DeliveryQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockGCMServer().start()
+        self.gcm = GCM('123api', url=self.server.url)
+
+    def tearDown(self):
+        self.gcm.close()
+        self.server.stop()
+
+    def payloads(self):
+        return [json.loads(body) for headers, body in self.server.requests]
+
+    def test_groups_identical_messages(self):
+        queue = DeliveryQueue(self.gcm, linger=10)
+        futures = [queue.send(['%d-%d' % (n, i) for i in range(400)], {'param1': '1'}) for n in range(3)]
+        # full groups go out without lingering
+        self.assertEqual(len(futures[0].result(timeout=5).successes), 400)
+        queue.close()
+        self.assertEqual(sorted(len(payload['registration_ids']) for payload in self.payloads()), [200, 1000])
+
+    def test_collapse_key_coalescing(self):
+        queue = DeliveryQueue(self.gcm, linger=0.1)
+        old = queue.send(['a', 'b'], {'score': '1'}, collapse_key='score')
+        new = queue.send('a', {'score': '2'}, collapse_key='score')
+        other = queue.send('a', {'chat': '1'}, collapse_key='chat')
+        self.assertEqual(old.result(timeout=5).superseded, ['a'])
+        self.assertEqual(old.result().successes, ['b'])
+        self.assertEqual(new.result(timeout=5).successes, ['a'])
+        self.assertEqual(other.result(timeout=5).successes, ['a'])
+        queue.close()
+        sent = sorted((payload['data'].items()[0], payload['registration_ids']) for payload in self.payloads())
+        self.assertEqual(sent, [(('chat', '1'), ['a']), (('score', '1'), ['b']), (('score', '2'), ['a'])])
+
+    def test_priority(self):
+        queue = DeliveryQueue(self.gcm, max_workers=1, linger=10)
+        queue.send('1', {'param1': 'low'}, priority=DeliveryQueue.LOW)
+        queue.send('2', {'param1': 'high'}, priority=DeliveryQueue.HIGH)
+        self.assertEqual(queue.pending(), 2)
+        queue.close()
+        self.assertEqual([payload['data']['param1'] for payload in self.payloads()], ['high', 'low'])
+
+    def test_deadlines(self):
+        queue = DeliveryQueue(self.gcm, linger=0.1)
+        expired = queue.send('1', {'param1': '1'}, deadline=0)
+        self.assertEqual(expired.result(timeout=5).expired, ['1'])
+        self.assertEqual(self.server.requests, [])
+
+        queue.send('2', {'param1': '1'}, collapse_key='k', time_to_live=100).result(timeout=5)
+        self.assertTrue(self.payloads()[0]['time_to_live'] < 100)
+        # under a sec left: never a time_to_live of 0, which GCM would take as its 4 week default
+        queue.send('3', {'param1': '1'}, collapse_key='k', time_to_live=100, deadline=0.5).result(timeout=5)
+        self.assertEqual(self.payloads()[1]['time_to_live'], 1)
+        queue.close()
+
+    def test_message_over_many_chunks(self):
+        # the chunks of one message resolve it from several workers at once
+        self.addCleanup(sys.setcheckinterval, sys.getcheckinterval())
+        sys.setcheckinterval(1)
+        gcm = GCM('123api', url=self.server.url, pool_size=8)
+        queue = DeliveryQueue(gcm, max_workers=8, linger=0)
+        for n in range(5):
+            future = queue.send(['%d-%d' % (n, i) for i in range(8000)], {'param1': str(n)})
+            self.assertEqual(len(future.result(timeout=10).successes), 8000)
+        queue.close()
+        gcm.close()
+
+    def test_rewritten_ids(self):
+        store = RegistrationStore()
+        store.record_canonical('old', 'new')
+        store.record_unregistered('dead')
+        self.gcm.registration_store = store
+        queue = DeliveryQueue(self.gcm, linger=0)
+        result = queue.send(['old', 'new', 'dead'], {'param1': '1'}).result(timeout=5)
+        queue.close()
+        self.assertEqual(self.payloads()[0]['registration_ids'], ['new'])
+        self.assertEqual(result.successes, ['old', 'new'])
+        self.assertEqual(result.canonical_ids, [('old', 'new')])
+        self.assertEqual(result.unregister_errors, ['dead'])
+
+class PayloadGrouperTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockGCMServer().start()
+        self.gcm = GCM('123api', url=self.server.url)
+
+    def tearDown(self):
+        self.gcm.close()
+        self.server.stop()
+
+    def payloads(self):
+        return [json.loads(body) for headers, body in self.server.requests]
+
+    def test_groups_identical_payloads(self):
+        records = [('%d' % i, {'team': 'red', 'n': '1'} if i % 2 else {'n': '1', 'team': 'red'}) for i in range(1500)]
+        records.insert(7, ('solo', {'team': 'blue'}))
+        grouper = PayloadGrouper(self.gcm)
+        results = list(grouper.send(records))
+        self.assertEqual([record for record, status, extra in results], records)
+        self.assertTrue(all(status == GCM_response_wrapper.SUCCESS for record, status, extra in results))
+        self.assertEqual((grouper.num_multicasts, grouper.num_singles), (1, 1))
+        sizes = sorted(len(payload['registration_ids']) for payload in self.payloads())
+        self.assertEqual(sizes, [1, 500, 1000])
+
+    def test_maps_outcomes_back_to_records(self):
+        self.gcm.registration_store = RegistrationStore()
+        self.gcm.registration_store.record_unregistered('dead')
+        self.server.replies = [(200, json.dumps({'success': 1, 'failure': 1, 'canonical_ids': 1, 'results': [
+            {'message_id': '1', 'registration_id': 'new'}, {'error': 'MismatchSenderId'}]}))]
+        users = [{'id': 'a', 'name': 'x'}, {'id': 'b', 'name': 'x'}, {'id': 'dead', 'name': 'x'},
+                 {'id': 'a', 'name': 'x'}]
+        grouper = PayloadGrouper(self.gcm, min_group_size=2)
+        results = list(grouper.send(users, split=lambda user: (user['id'], {'hello': user['name']})))
+        self.assertEqual([(record['id'], status, extra) for record, status, extra in results], [
+            ('a', GCM_response_wrapper.CANONICAL, 'new'),
+            ('b', GCM_response_wrapper.ERROR, 'MismatchSenderId'),
+            ('dead', GCM_response_wrapper.UNREGISTER, 'NotRegistered'),
+            ('a', GCM_response_wrapper.CANONICAL, 'new')])
+        self.assertEqual(self.payloads()[0]['registration_ids'], ['a', 'b'])
+
+    def test_rewritten_ids_looked_up_once(self):
+        store = RegistrationStore()
+        store.record_canonical('old', 'new')
+        store.lookup = MagicMock(wraps=store.lookup)
+        self.gcm.registration_store = store
+        records = [('old', {'param1': '1'}), ('new', {'param1': '1'}), ('x', {'param1': '1'})]
+        results = list(PayloadGrouper(self.gcm).send(records))
+        self.assertEqual([(status, extra) for record, status, extra in results], [
+            (GCM_response_wrapper.CANONICAL, 'new'), (GCM_response_wrapper.SUCCESS, None),
+            (GCM_response_wrapper.SUCCESS, None)])
+        self.assertEqual(store.lookup.call_count, 3)
+        self.assertEqual(self.payloads()[0]['registration_ids'], ['new', 'x'])
+
+    def test_missing_results(self):
+        self.server.replies = [(200, json.dumps({'success': 1, 'failure': 0, 'canonical_ids': 0, 'results': [
+            {'message_id': '1'}]}))]
+        results = list(PayloadGrouper(self.gcm).send([('a', {'param1': '1'}), ('b', {'param1': '1'})]))
+        self.assertEqual([(record[0], status, extra) for record, status, extra in results], [
+            ('a', GCM_response_wrapper.SUCCESS, None), ('b', GCM_response_wrapper.ERROR, 'MissingResult')])
+
+    def test_windows_and_too_big(self):
+        records = [('1', {'param1': '1'}), ('2', {'param1': 'x' * 5000}), ('3', {'param1': '1'})]
+        results = list(PayloadGrouper(self.gcm, window=2).send(records))
+        self.assertEqual([status for record, status, extra in results], [
+            GCM_response_wrapper.SUCCESS, GCM_response_wrapper.ERROR, GCM_response_wrapper.SUCCESS])
+        self.assertEqual(results[1][2], 'MessageTooBig')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_fatal_error(self):
+        self.server.replies = [(401, '')] * 10
+        with self.assertRaises(GCMAuthenticationException):
+            list(PayloadGrouper(self.gcm).send([('1', {'param1': '1'}), ('2', {'param1': '1'})]))
+
+class DeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockGCMServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def sent_ids(self):
+        return [json.loads(body)['registration_ids'] for headers, body in self.server.requests]
+
+    def test_window(self):
+        dedup = Deduplicator(window=60)
+        self.assertEqual(list(dedup.apply(['1', '2', '1'], {'param1': '1'})), ['1', '2'])
+        self.assertEqual(list(dedup.apply(['1', '2', '3'], {'param1': '1'})), ['3'])
+        # same ids, another message: not a duplicate
+        self.assertEqual(list(dedup.apply(['1'], {'param1': '2'})), ['1'])
+        self.assertEqual(list(dedup.apply(['1'], {'param1': '1'}, collapse_key='k')), ['1'])
+        self.assertEqual(dedup.suppressed, 3)
+        dedup.forget(['2'], {'param1': '1'})
+        self.assertEqual(list(dedup.apply(['2'], {'param1': '1'})), ['2'])
+
+        expiring = Deduplicator(window=0)
+        self.assertEqual(list(expiring.apply(['1', '1'], {'param1': '1'})), ['1', '1'])
+
+    def test_bounded(self):
+        dedup = Deduplicator(max_entries=100)
+        list(dedup.apply((str(i) for i in range(1000)), {'param1': '1'}))
+        self.assertEqual(len(dedup), 100)
+        self.assertEqual(list(dedup.apply(['0', '999'], {'param1': '1'})), ['0'])
+
+    def test_gcm_sends(self):
+        dedup = Deduplicator()
+        gcm = GCM('123api', url=self.server.url, deduplicator=dedup)
+        res = gcm.send_bulk(['1', '2', '1'], {'param1': '1'})
+        self.assertEqual(res.successes, ['1', '2'])
+        template = gcm.payload_template({'param1': '1'})
+        res = MulticastRetrier(gcm).send(['2', '3'], template)
+        self.assertEqual(res.successes, ['3'])
+        self.assertEqual(self.sent_ids(), [['1', '2'], ['3']])
+        self.assertEqual(dedup.suppressed, 2)
+
+        records = [('3', {'param1': '1'}), ('4', {'param1': '1'})]
+        results = list(PayloadGrouper(gcm).send(records))
+        self.assertEqual([status for record, status, extra in results], [DUPLICATE, GCM_response_wrapper.SUCCESS])
+        gcm.close()
+
+    def test_duplicates_reported(self):
+        gcm = GCM('123api', url=self.server.url, deduplicator=Deduplicator())
+        res = gcm.send_bulk(['1', '2', '1'], {'param1': '1'})
+        self.assertEqual(res.duplicates, ['1'])
+        # every id a duplicate: an empty result, not an error
+        res = MulticastRetrier(gcm).send(['1', '2'], {'param1': '1'})
+        self.assertEqual((res.num_batches, res.successes, res.duplicates), (0, [], ['1', '2']))
+        results = list(PayloadGrouper(gcm).send([('1', {'param1': '1'})]))
+        self.assertEqual(results[0][1], DUPLICATE)
+        queue = DeliveryQueue(gcm, linger=0)
+        self.assertEqual(queue.send(['2', '3'], {'param1': '1'}).result(timeout=5).duplicates, ['2'])
+        queue.close()
+        self.assertEqual(self.sent_ids(), [['1', '2'], ['3']])
+        with self.assertRaises(GCMMissingRegistrationException):
+            gcm.send_bulk([], {'param1': '1'})
+        gcm.close()
+
+    def test_undelivered_forgotten(self):
+        gcm = GCM('123api', url=self.server.url, deduplicator=Deduplicator())
+        gcm.BACKOFF_INITIAL_DELAY_MS = 1
+        self.server.replies = [(503, '')]
+        res = gcm.send_bulk(['1', '2'], {'param1': '1'})
+        self.assertEqual(res.resend_ids, ['1', '2'])
+        self.assertEqual(gcm.send_bulk(res.resend_ids, {'param1': '1'}).successes, ['1', '2'])
+
+        self.server.replies = [(503, '')]
+        res = MulticastRetrier(gcm, max_attempts=1).send(['3'], {'param1': '1'})
+        self.assertEqual(res.resend_ids, ['3'])
+        self.server.replies = [(401, '')]
+        with self.assertRaises(GCMAuthenticationException):
+            MulticastRetrier(gcm).send(['4'], {'param1': '1'})
+        self.assertEqual(MulticastRetrier(gcm).send(['3', '4'], {'param1': '1'}).successes, ['3', '4'])
+        gcm.close()
+
+class _Gate(object):
+    """
+    limiter that hands out no tokens until opened
+    """
+    def __init__(self):
+        self.opened = threading.Event()
+
+    def acquire(self, timeout=None):
+        return self.opened.is_set()
+
+    def release(self):
+        pass
+
+class SenderRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = MockGCMServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def sent_keys(self):
+        return [headers.getheader('authorization') for headers, body in self.server.requests]
+
+    def test_fair_across_keys(self):
+        router = SenderRouter(max_workers=1, url=self.server.url)
+        router.add_key('big', 'big-api', pool_size=1)
+        router.add_key('small', 'small-api', pool_size=1)
+        big = router.send('big', [str(i) for i in range(5000)], {'param1': '1'})
+        small = router.send('small', ['1'], {'param1': '1'})
+        self.assertEqual(len(small.result(timeout=5).successes), 1)
+        self.assertEqual(len(big.result(timeout=5).successes), 5000)
+        router.close()
+        self.assertTrue('key=small-api' in self.sent_keys()[:2])
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_rate_limit_per_key(self):
+        router = SenderRouter(max_workers=2, url=self.server.url)
+        gate = _Gate()
+        router.add_key('slow', 'slow-api', rate=gate)
+        router.add_key('fast', 'fast-api')
+        slow = router.send('slow', [str(i) for i in range(3000)], {'param1': '1'})
+        fast = router.send('fast', [str(i) for i in range(3000)], {'param1': '1'})
+        self.assertEqual(len(fast.result(timeout=5).successes), 3000)
+        # out of tokens: nothing was sent for slow
+        self.assertFalse(slow.done())
+        self.assertFalse('key=slow-api' in self.sent_keys())
+        gate.opened.set()
+        self.assertEqual(len(slow.result(timeout=5).successes), 3000)
+        router.close()
+
+    def test_ids_read_lazily(self):
+        router = SenderRouter(max_workers=2, url=self.server.url)
+        gate = _Gate()
+        router.add_key('a', 'a-api', rate=gate)
+        read = []
+
+        def ids():
+            for i in xrange(100000):
+                read.append(i)
+                yield str(i)
+        future = router.send('a', ids(), {'param1': '1'})
+        # no more than the batch waiting for a token
+        self.assertEqual(len(read), 1000)
+        self.assertEqual(self.server.requests, [])
+        gate.opened.set()
+        self.assertEqual(len(future.result(timeout=10).successes), 100000)
+        self.assertEqual(len(self.server.requests), 100)
+        router.close()
+
+    def test_slow_ids_hold_up_no_other_key(self):
+        router = SenderRouter(max_workers=2, url=self.server.url)
+        router.add_key('slow', 'slow-api')
+        router.add_key('fast', 'fast-api')
+        more = threading.Event()
+
+        def ids():
+            for i in xrange(1000):
+                yield str(i)
+            more.wait(5)
+            yield 'last'
+        slow = router.send('slow', ids(), {'param1': '1'})
+        # one worker is stuck reading ids, outside the router's lock
+        fast = router.send('fast', ['1'], {'param1': '1'})
+        self.assertEqual(fast.result(timeout=2).successes, ['1'])
+        self.assertFalse(slow.done())
+        more.set()
+        self.assertEqual(len(slow.result(timeout=5).successes), 1001)
+        router.close()
+
+    def test_all_duplicates(self):
+        router = SenderRouter(url=self.server.url, deduplicator=Deduplicator())
+        router.add_key('a', 'a-api')
+        router.send('a', ['1', '2'], {'param1': '1'}).result(timeout=5)
+        future = router.send('a', ['2', '1'], {'param1': '1'})
+        self.assertTrue(future.done())
+        self.assertEqual(future.result().duplicates, ['2', '1'])
+        with self.assertRaises(GCMMissingRegistrationException):
+            router.send('a', [], {'param1': '1'})
+        router.close()
+
+    def test_mismatch_and_retries(self):
+        router = SenderRouter(url=self.server.url)
+        route = router.add_key('a', 'a-api')
+        route.gcm.BACKOFF_INITIAL_DELAY_MS = 10
+        self.server.replies = [(200, json.dumps({'success': 0, 'failure': 2, 'canonical_ids': 0, 'results': [
+            {'error': 'MismatchSenderId'}, {'error': 'Unavailable'}]}))]
+        result = router.send('a', ['1', '2'], {'param1': '1'}).result(timeout=5)
+        self.assertEqual(result.key, 'a')
+        self.assertEqual(result.mismatched, ['1'])
+        self.assertEqual(result.successes, ['2'])
+        self.assertEqual(route.mismatches, 1)
+        self.assertEqual(router.route('a').gcm.api_key, 'a-api')
+        router.close()
+
+    def test_half_open_circuit(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        router = SenderRouter(max_workers=2, max_attempts=1, url=self.server.url)
+        router.add_key('a', 'a-api', breaker=breaker)
+        breaker.record_failure()
+        # half-open, with its probe in flight elsewhere
+        self.assertTrue(breaker.allow())
+        # workers that take a batch anyway get it refused, and requeue it without spending an attempt
+        available = patch.object(breaker, 'available', return_value=True)
+        available.start()
+        future = router.send('a', ['1', '2'], {'param1': '1'})
+        time.sleep(0.1)
+        available.stop()
+        time.sleep(0.1)
+        self.assertFalse(future.done())
+        self.assertEqual(self.server.requests, [])
+        breaker.record_success()
+        result = future.result(timeout=5)
+        self.assertEqual((result.successes, result.resend_ids, result.num_batches), (['1', '2'], [], 1))
+        router.close()
+
+    def test_fatal_error(self):
+        router = SenderRouter(max_workers=1, url=self.server.url)
+        router.add_key('a', 'a-api')
+        self.server.replies = [(401, '')]
+        with self.assertRaises(GCMAuthenticationException):
+            router.send('a', ['1'], {'param1': '1'}).result(timeout=5)
+        # failing to fold in a response fails the message too, and the worker lives on
+        with patch.object(RoutedResult, 'add_response', side_effect=ValueError('broken')):
+            with self.assertRaises(ValueError):
+                router.send('a', ['1'], {'param1': '1'}).result(timeout=5)
+        self.assertEqual(router.send('a', ['1'], {'param1': '1'}).result(timeout=5).successes, ['1'])
+        with self.assertRaises(KeyError):
+            router.send('b', ['1'], {'param1': '1'})
+        router.close()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,198 @@
+import httplib
+import socket
+import threading
+import time
+import urlparse
+import zlib
+from cStringIO import StringIO
+from collections import deque
+
+
+# wbits for zlib to read and write gzip framing
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+READ_CHUNK_SIZE = 16384
+
+# errors that mean a kept-alive socket was closed under us by the server
+STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest,
+                           httplib.ResponseNotReady, socket.error)
+
+
+class PooledConnection(object):
+    """
+    An httplib connection plus the bookkeeping the pool needs to decide whether to reuse it.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.num_requests = 0
+        self.last_used = time.time()
+
+    def close(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+
+
+class HTTPConnectionPool(object):
+    """
+    A small pool of persistent HTTP/1.1 keep-alive connections to a single host,
+    so consecutive requests skip the TCP and TLS handshakes.
+
+    :param url: endpoint to POST to, e.g. GCM_URL
+    :param maxsize: maximum number of simultaneous connections; callers block when all are in use
+    :param idle_timeout: secs an idle connection may sit in the pool before it is discarded
+    :param max_requests: requests served by one connection before it is closed and replaced
+    :param timeout: socket timeout in secs, None for the global default
+    :param compress: gzip request bodies of at least compress_min_bytes; turned off for good if the
+                     server answers 415 Unsupported Media Type. Gzip responses are always accepted.
+    """
+    def __init__(self, url, maxsize=4, idle_timeout=30.0, max_requests=1000, timeout=None,
+                 compress=False, compress_min_bytes=1024, compress_level=6):
+        parsed = urlparse.urlparse(url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self.num_connections = 0  # connections opened over the pool's lifetime
+        self.bytes_sent = 0       # request body bytes on the wire, after compression
+        self.bytes_received = 0   # response body bytes on the wire, before decompression
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        if self.timeout is None:
+            conn = cls(self.host, self.port)
+        else:
+            conn = cls(self.host, self.port, timeout=self.timeout)
+        with self._lock:
+            self.num_connections += 1
+        return PooledConnection(conn)
+
+    def _get_connection(self):
+        """
+        pop the most recently used idle connection that has not expired, else open a new one.
+        """
+        now = time.time()
+        expired = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate = self._idle.pop()
+                if now - candidate.last_used > self.idle_timeout:
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+        for candidate in expired:
+            candidate.close()
+        if conn is None:
+            conn = self._new_connection()
+        return conn
+
+    def _put_connection(self, conn):
+        conn.last_used = time.time()
+        with self._lock:
+            self._idle.append(conn)
+
+    def request(self, body, headers, method='POST'):
+        """
+        Send one request over a pooled connection, transparently reconnecting once
+        if a reused connection turns out to be dead.
+
+        :return tuple( status, dict of lower-cased response headers, body string )
+        :raises socket.error, httplib.HTTPException: on connection failures
+        """
+        headers = dict(headers, **{'Accept-Encoding': 'gzip'})
+        if self.compress and len(body) >= self.compress_min_bytes:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, GZIP_WBITS)
+            status, response_headers, data = self._request(
+                compressor.compress(body) + compressor.flush(),
+                dict(headers, **{'Content-Encoding': 'gzip'}), method)
+            if status != 415:
+                return status, response_headers, data
+            self.compress = False
+        return self._request(body, headers, method)
+
+    def _request(self, body, headers, method):
+        self._slots.acquire()
+        try:
+            conn = self._get_connection()
+            while True:
+                reused = conn.num_requests > 0
+                try:
+                    return self._send(conn, method, body, headers)
+                except socket.timeout:
+                    # the request may have been delivered; never resend it blindly
+                    conn.close()
+                    raise
+                except STALE_CONNECTION_ERRORS:
+                    conn.close()
+                    if not reused:
+                        raise
+                    conn = self._new_connection()
+                except Exception:
+                    conn.close()
+                    raise
+        finally:
+            self._slots.release()
+
+    def _send(self, conn, method, body, headers):
+        conn.connection.request(method, self.path, body, headers)
+        response = conn.connection.getresponse()
+        data = self._read_body(response)
+        conn.num_requests += 1
+        with self._lock:
+            self.bytes_sent += len(body)
+        if response.will_close or conn.num_requests >= self.max_requests:
+            conn.close()
+        else:
+            self._put_connection(conn)
+        return response.status, dict(response.getheaders()), data
+
+    def _read_body(self, response):
+        """
+        read the response body, gunzipping it READ_CHUNK_SIZE bytes at a time as it arrives if it is
+        compressed: neither the compressed body nor a list of decompressed pieces is held whole
+        """
+        if response.getheader('content-encoding', '').lower() != 'gzip':
+            data = response.read()
+            with self._lock:
+                self.bytes_received += len(data)
+            return data
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        body = StringIO()
+        received = 0
+        while True:
+            chunk = response.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            body.write(decompressor.decompress(chunk))
+        body.write(decompressor.flush())
+        with self._lock:
+            self.bytes_received += received
+        return body.getvalue()
+
+    def close(self):
+        """
+        close all idle connections. The pool stays usable and reconnects on the next request.
+        """
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn in idle:
+            conn.close()
@@ -1,8 +1,7 @@
 from datetime import datetime
-import time
-from django.utils.encoding import smart_str
 from gcm import GCM
-from gcm.gcm import GCMRetriableException
+from gcm.gcm import smart_str
+from gcm.retry import MulticastRetrier
 
 MY_EXCELLENT_GCM_KEY = 'my excellent gcm key'   # replace with your key, or supply it via another means
 
@@ -28,53 +27,37 @@ def send_notification(ids, devices_by_reg_id, payload, max_attempts=3):
     delay_while_idle = False
     time_to_live = 3600
 
-    for i in xrange(max_attempts):
-        try:
-            gcm_response = GCM(MY_EXCELLENT_GCM_KEY).request_json(
-                ids, payload, collapse_key, delay_while_idle, time_to_live)
-
-            parse_response(devices_by_reg_id, gcm_response, ids)
-
-            should_retry = gcm_response.has_resends()
-            if should_retry:
-                ids = gcm_response.get_resend_ids(ids)  # reset ids for next try
-                if i < max_attempts - 1:
-                    time.sleep(0.20) # TODO back off exponentially
-                else:
-                    break  # record failures below
-            else:
-                return True  # FINISHED!  successes already recorded
-
-        except GCMRetriableException:
-            if i < max_attempts - 1:
-                time.sleep(0.20) # TODO back off exponentially
-            else:
-                break
+    try:
+        # resends Unavailable ids in merged batches, with exponential backoff between attempts
+        retrier = MulticastRetrier(GCM(MY_EXCELLENT_GCM_KEY), max_attempts=max_attempts)
+        result = retrier.send(ids, payload, collapse_key, delay_while_idle, time_to_live)
+    except Exception as e:
+        print('problem with gcm: %s' % smart_str(e))
+        return False
 
-        except Exception as e:
-            print('problem with gcm: %s' % smart_str(e))
-            break
+    parse_response(devices_by_reg_id, result)
+    if not result.has_resends():
+        return True  # FINISHED!  successes already recorded
 
     # the attempt failed if we got here.
-    for fail_id in ids:
-        if devices_by_reg_id.has_key(fail_id):
+    for fail_id in result.resend_ids:
+        if fail_id in devices_by_reg_id:
             d = devices_by_reg_id[fail_id]
             # record_fail(d.user_id, d.id)
     return False
 
-def parse_response(devices_by_reg_id, gcm_response, ids):
-    for (old_reg_id, canonical_id) in gcm_response.get_canonical_ids(ids):
-        if devices_by_reg_id.has_key(old_reg_id):
+def parse_response(devices_by_reg_id, result):
+    for (old_reg_id, canonical_id) in result.canonical_ids:
+        if old_reg_id in devices_by_reg_id:
             d = devices_by_reg_id[old_reg_id]
             d.registration_id = canonical_id # Replace reg_id with canonical_id in your database
             d.save()
-    for old_invalid_id in gcm_response.get_unregister_errors(ids):
-        if devices_by_reg_id.has_key(old_invalid_id):
+    for old_invalid_id in result.unregister_errors:
+        if old_invalid_id in devices_by_reg_id:
             d = devices_by_reg_id[old_invalid_id]
             d.registration_id = ''
             d.save()  # this should happen right away, since all future notifications should be skipped
-    for success_id in gcm_response.get_successes(ids):
-        if devices_by_reg_id.has_key(success_id):
+    for success_id in result.successes:
+        if success_id in devices_by_reg_id:
             d = devices_by_reg_id[success_id]
             # record_success(d.user_id, d.id)
-